@@ -0,0 +1,204 @@
+import asyncio
+import functools
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from dotenv import load_dotenv
+
+import storage
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+# Threads running database reads for async handlers and routes. Writes have one thread of their own.
+READ_THREADS = int(os.getenv("STORAGE_READ_THREADS", 4))
+MAX_BATCH = 500  # writes committed together at most
+RELOAD_CHECK_INTERVAL = 1.0  # seconds between snapshot version checks
+
+_readers = ThreadPoolExecutor(READ_THREADS, thread_name_prefix="storage-read")
+_writer = ThreadPoolExecutor(1, thread_name_prefix="storage-write")
+
+
+async def read(function, *args):
+    """Run a storage read in the storage thread pool, keeping the event loop free."""
+    return await asyncio.get_running_loop().run_in_executor(_readers, functools.partial(function, *args))
+
+
+class GroupCommitter:
+    """Runs storage writes on one thread, committing concurrent ones together.
+
+    Writes submitted while a batch is being committed wait for the next
+    batch, so under load many writes share one transaction and one fsync
+    instead of each paying for their own.
+    """
+
+    def __init__(self):
+        self._pending = []  # (function, args, future)
+        self._task = None
+        self.writes = 0
+        self.batches = 0
+        self.largest_batch = 0
+
+    def submit(self, function, *args) -> asyncio.Future:
+        """Queue a storage write. Must be called from the event loop."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((function, args, future))
+        if self._task is None:
+            self._task = loop.create_task(self._flush())
+        return future
+
+    async def _flush(self) -> None:
+        loop = asyncio.get_running_loop()
+        try:
+            while self._pending:
+                batch, self._pending = self._pending[:MAX_BATCH], self._pending[MAX_BATCH:]
+                calls = [(function, args) for function, args, _ in batch]
+                try:
+                    results = await loop.run_in_executor(_writer, storage.run_batch, calls)
+                except Exception as e:  # the commit itself failed
+                    logger.error(f"Failed to commit {len(batch)} storage writes: {e}")
+                    results = [(None, e)] * len(batch)
+                for (_, _, future), (result, error) in zip(batch, results):
+                    if future.done():
+                        continue
+                    if error is not None:
+                        future.set_exception(error)
+                    else:
+                        future.set_result(result)
+                self.writes += len(batch)
+                self.batches += 1
+                self.largest_batch = max(self.largest_batch, len(batch))
+        finally:
+            self._task = None
+
+    def stats(self) -> dict:
+        return {
+            "writes": self.writes,
+            "batches": self.batches,
+            "pending": len(self._pending),
+            "largest_batch": self.largest_batch,
+            "writes_per_batch": round(self.writes / self.batches, 2) if self.batches else 0.0,
+        }
+
+
+committer = GroupCommitter()
+
+
+async def write(function, *args):
+    """Run a storage write through the group committer and return its result."""
+    return await committer.submit(function, *args)
+
+
+def _log_failure(future: asyncio.Future) -> None:
+    if not future.cancelled() and future.exception() is not None:
+        logger.error(f"Background storage write failed: {future.exception()}")
+
+
+def write_later(function, *args) -> asyncio.Future:
+    """Queue a storage write without waiting for it. Failures are logged."""
+    future = committer.submit(function, *args)
+    future.add_done_callback(_log_failure)
+    return future
+
+
+class Snapshot:
+    """Read-only copy of stored data, loaded in the storage thread pool.
+
+    The data is reloaded when `version()` changes, checked at most once per
+    RELOAD_CHECK_INTERVAL; call invalidate() after a write so this process
+    sees it right away. Every caller gets the same object, so it must not
+    be modified.
+    """
+
+    def __init__(self, load, version):
+        self._load = load
+        self._version = version
+        self._data = None
+        self._loaded_version = None
+        self._checked_at = 0.0
+        self._lock = asyncio.Lock()
+
+    def invalidate(self) -> None:
+        self._checked_at = 0.0
+
+    async def get(self):
+        if self._data is not None and time.monotonic() - self._checked_at < RELOAD_CHECK_INTERVAL:
+            return self._data
+        async with self._lock:  # one reload at a time; waiters get its result
+            if self._data is None or time.monotonic() - self._checked_at >= RELOAD_CHECK_INTERVAL:
+                self._checked_at = time.monotonic()
+                version = await read(self._version)
+                if version != self._loaded_version:
+                    self._data = await read(self._load)
+                    self._loaded_version = version
+        return self._data
+
+
+class BackgroundSnapshot:
+    """Like Snapshot, but read without awaiting, for per-message lookups.
+
+    current() returns the loaded data right away; once RELOAD_CHECK_INTERVAL
+    has passed it also starts a version check in the storage thread pool,
+    which swaps in freshly loaded data when the version changed. Call
+    refresh() after a write so this process sees it right away, and once
+    on startup so the first lookup doesn't load on the event loop.
+    """
+
+    def __init__(self, load, version):
+        self._load = load
+        self._version = version
+        self._data = None
+        self._loaded_version = None
+        self._checked_at = 0.0
+        self._lock = asyncio.Lock()
+        self._task = None
+
+    def peek(self):
+        """The loaded data, or None before the first load."""
+        return self._data
+
+    def current(self):
+        if self._data is None:
+            # Used before the first refresh(), e.g. by scripts and tests.
+            self._checked_at = time.monotonic()
+            self._loaded_version = self._version()
+            self._data = self._load()
+        elif time.monotonic() - self._checked_at >= RELOAD_CHECK_INTERVAL and self._task is None:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:  # a worker thread; the event loop reloads it
+                return self._data
+            self._task = loop.create_task(self._reload())
+        return self._data
+
+    async def _reload(self) -> None:
+        try:
+            await self.refresh(force=False)
+        except Exception as e:
+            logger.error(f"Failed to reload snapshot: {e}")
+        finally:
+            self._task = None
+
+    async def refresh(self, force: bool = True):
+        """Reload the data if the version changed, checking now unless `force` is False."""
+        async with self._lock:  # one reload at a time
+            if force or self._data is None or time.monotonic() - self._checked_at >= RELOAD_CHECK_INTERVAL:
+                self._checked_at = time.monotonic()
+                version = await read(self._version)
+                if version != self._loaded_version:
+                    data = await read(self._load)
+                    self._data, self._loaded_version = data, version
+        return self._data
+
+    def advance(self, data, changes: int, version) -> None:
+        """Record that `data` was updated in place for our own `changes`, now stored as `version`.
+
+        If another writer changed the data too, or `data` was replaced by a
+        reload meanwhile, the next check reloads instead.
+        """
+        if data is self._data and version == self._loaded_version + changes:
+            self._loaded_version = version
@@ -1,17 +1,35 @@
+import asyncio
+import hashlib
+import hmac
 import os
+import secrets
+import time
+from collections import OrderedDict
 from datetime import datetime, timedelta, timezone
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, HTTPException, Request, status
 from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 from dotenv import load_dotenv
 
+import async_storage
+import storage
+
 load_dotenv()
 
 # --- Configuration ---
+# Read once at startup; restart the API to change credentials.
 SECRET_KEY = os.getenv("SECRET_KEY")
+API_USER = os.getenv("API_USER")
+API_PASSWORD = os.getenv("API_PASSWORD")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
+AUTH_CACHE_SIZE = int(os.getenv("AUTH_CACHE_SIZE", 1024))  # verified tokens and API keys kept in memory
+API_KEY_PREFIX = "tmb_"  # API keys look like tmb_<id>_<secret>
+API_KEY_CHECK_INTERVAL = 1.0  # seconds between checks for revoked API keys
+API_KEY_REJECTED_TTL = 60.0  # seconds a wrong API key is refused without checking it again
+API_KEY_MAX_FAILURES = 5  # wrong secrets from one client per window before its further guesses are refused
+API_KEY_FAILURE_WINDOW = 60.0
 
 # --- Hashing ---
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
@@ -26,6 +44,15 @@ def get_password_hash(password):
     """Hash a password."""
     return pwd_context.hash(password)
 
+def authenticate_user(username: str, password: str) -> bool:
+    """Check login credentials against API_USER and API_PASSWORD."""
+    if not API_USER or not API_PASSWORD:
+        return False
+    # Compare both in constant time so a wrong username takes as long as a wrong password.
+    user_ok = hmac.compare_digest(username.encode(), API_USER.encode())
+    password_ok = hmac.compare_digest(password.encode(), API_PASSWORD.encode())
+    return user_ok and password_ok
+
 def create_access_token(data: dict, expires_delta: timedelta | None = None):
     """Create a new access token."""
     to_encode = data.copy()
@@ -37,22 +64,193 @@ def create_access_token(data: dict, expires_delta: timedelta | None = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-async def get_current_user(token: str = Depends(oauth2_scheme)):
-    """Dependency to get the current user from a token."""
+
+# --- Verification Cache ---
+class VerificationCache:
+    """Bounded LRU of credentials that were already verified.
+
+    Entries are keyed by the SHA-256 digest of the credential, so raw tokens
+    and API keys aren't kept in memory, and expire with the token's `exp`.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self._entries = OrderedDict()  # digest -> (user, expires_at)
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _digest(credential: str) -> bytes:
+        return hashlib.sha256(credential.encode()).digest()
+
+    def get(self, credential: str):
+        digest = self._digest(credential)
+        entry = self._entries.get(digest)
+        if entry is None or entry[1] <= time.time():
+            if entry is not None:
+                del self._entries[digest]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(digest)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, credential: str, user: dict, expires_at: float) -> None:
+        digest = self._digest(credential)
+        self._entries[digest] = (user, expires_at)
+        self._entries.move_to_end(digest)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        return {"cached": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+class FailedClients:
+    """Counts wrong API key secrets per client address in fixed windows.
+
+    Once a client has API_KEY_MAX_FAILURES in the current window, its further
+    attempts are refused without running bcrypt, so guessing with unique junk
+    secrets can't keep the thread pool busy. Keyed by the sender rather than
+    the key, so a guesser can't lock the key's owner out.
+    """
+
+    def __init__(self, limit: int, window: float, size: int):
+        self.limit = limit
+        self.window = window
+        self.size = size
+        self._failures = {}  # client address -> (failures, window started at)
+        self.refused = 0
+
+    def blocked(self, client: str) -> bool:
+        failures, started = self._failures.get(client, (0, 0.0))
+        if failures < self.limit or time.monotonic() - started >= self.window:
+            return False
+        self.refused += 1
+        return True
+
+    def record(self, client: str) -> None:
+        now = time.monotonic()
+        if client not in self._failures and len(self._failures) >= self.size:
+            self._failures = {
+                key: entry for key, entry in self._failures.items() if now - entry[1] < self.window
+            }
+            if len(self._failures) >= self.size:
+                self._failures.clear()  # every client is failing: start over rather than grow
+        failures, started = self._failures.get(client, (0, now))
+        if now - started >= self.window:
+            failures, started = 0, now
+        self._failures[client] = (failures + 1, started)
+
+
+verified = VerificationCache(AUTH_CACHE_SIZE)
+rejected = VerificationCache(AUTH_CACHE_SIZE)  # wrong API keys, so retrying one costs no bcrypt
+failed_clients = FailedClients(API_KEY_MAX_FAILURES, API_KEY_FAILURE_WINDOW, AUTH_CACHE_SIZE)
+_verifying = {}  # API key -> task checking it, so a burst of requests runs bcrypt once
+_api_keys_version = None
+_api_keys_checked_at = 0.0
+
+
+async def _check_revocations() -> None:
+    # API keys revoked by any worker drop out of this worker's cache within API_KEY_CHECK_INTERVAL.
+    global _api_keys_version, _api_keys_checked_at
+    if time.monotonic() - _api_keys_checked_at < API_KEY_CHECK_INTERVAL:
+        return
+    _api_keys_checked_at = time.monotonic()
+    version = await async_storage.read(storage.api_keys_version)
+    if version != _api_keys_version:
+        if _api_keys_version is not None:
+            verified.clear()
+        _api_keys_version = version
+
+
+def _decode_token(token: str):
+    """Verify a JWT; returns (user, expires_at) or None."""
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except JWTError:
+        return None
+    username = payload.get("sub")
+    # In a real app, you would fetch the user from a database here
+    # For this app, just confirming the username exists is enough.
+    if username is None or username != API_USER:
+        return None
+    return {"username": username}, float(payload.get("exp", 0))
+
+
+async def _verify_api_key(api_key: str, client: str):
+    """Verify an API key against its stored hash; returns (user, expires_at) or None."""
+    key_id, _, secret = api_key[len(API_KEY_PREFIX):].partition("_")
+    if not key_id.isdigit() or not secret:
+        return None
+    row = await async_storage.read(storage.get_api_key, int(key_id))
+    if row is None or failed_clients.blocked(client):
+        return None
+    # bcrypt is slow on purpose; keep it off the event loop.
+    if not await asyncio.to_thread(pwd_context.verify, secret, row["key_hash"]):
+        failed_clients.record(client)
+        rejected.put(api_key, False, time.time() + API_KEY_REJECTED_TTL)
+        return None
+    return {"username": f"key:{row['name']}", "api_key_id": row["id"]}, float("inf")
+
+
+async def create_api_key(name: str) -> dict:
+    """Store a new API key. Only its hash is kept, so the returned key can't be shown again."""
+    secret = secrets.token_urlsafe(32)
+    key_hash = await asyncio.to_thread(get_password_hash, secret)
+    row = await async_storage.write(storage.add_api_key, name, key_hash)
+    return {**row, "key": f"{API_KEY_PREFIX}{row['id']}_{secret}"}
+
+
+async def revoke_api_key(key_id: int) -> bool:
+    """Delete an API key. Returns False if it didn't exist."""
+    if not await async_storage.write(storage.delete_api_key, key_id):
+        return False
+    verified.clear()  # other workers notice within API_KEY_CHECK_INTERVAL
+    return True
+
+
+async def list_api_keys() -> list:
+    return await async_storage.read(storage.load_api_keys)
+
+
+async def get_current_user(request: Request, token: str = Depends(oauth2_scheme)):
+    """Dependency to get the current user from a token or API key."""
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
+    is_api_key = token.startswith(API_KEY_PREFIX)
+    if is_api_key:
+        await _check_revocations()
+    user = verified.get(token)
+    if user is not None:
+        return user
+    if is_api_key:
+        if rejected.get(token) is not None:
             raise credentials_exception
-    except JWTError:
+        task = _verifying.get(token)
+        if task is None:
+            client = request.client.host if request.client else ""
+            task = _verifying[token] = asyncio.ensure_future(_verify_api_key(token, client))
+            task.add_done_callback(lambda _: _verifying.pop(token, None))
+        result = await asyncio.shield(task)
+    else:
+        result = _decode_token(token)
+    if result is None:
         raise credentials_exception
-    # In a real app, you would fetch the user from a database here
-    # For this app, just confirming the username exists is enough.
-    if username != os.getenv("API_USER"):
-         raise credentials_exception
-    return {"username": username}
+    user, expires_at = result
+    verified.put(token, user, expires_at)
+    return user
+
+
+def stats() -> dict:
+    return {
+        **verified.stats(),
+        "rejected_cached": rejected.stats()["cached"],
+        "refused_key_guesses": failed_clients.refused,
+    }
@@ -0,0 +1,371 @@
+"""Benchmarks for the bot and API, run against a local fake Bot API server.
+
+Starts fake_telegram.py, points the bot at it, and drives the real
+handlers and API routes with generated users and updates in a throwaway
+database. Results are printed and saved as JSON; pass an earlier result
+file with --compare to fail on regressions. Run from backend/:
+
+    python benchmark.py                          # every benchmark
+    python benchmark.py broadcast keywords --quick
+    python benchmark.py --compare benchmark-results/baseline.json
+
+Benchmarks:
+    broadcast    broadcast throughput vs. number of recipients
+    keywords     handle_message latency vs. number of keyword rules
+    start_spike  /start throughput when many new users arrive at once
+    api_stats    /api/stats latency vs. number of users and chats
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import httpx
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+SIZES = {
+    "broadcast": [1000, 10000, 50000],
+    "keywords": [10, 100, 1000, 10000],
+    "start_spike": [1000, 5000, 20000],
+    "api_stats": [10000, 100000, 1000000],
+}
+# The figure each benchmark is compared on, and whether higher is better.
+KEY_METRICS = {
+    "broadcast": ("msg_per_s", True),
+    "keywords": ("p95_ms", False),
+    "start_spike": ("updates_per_s", True),
+    "api_stats": ("p95_ms", False),
+}
+FIRST_USER_ID = 1_000_000_000
+
+
+def _percentiles(samples) -> dict:
+    """p50/p95/p99 and mean of latencies in seconds, in milliseconds."""
+    if len(samples) < 2:
+        samples = list(samples) * 2
+    q = statistics.quantiles(samples, n=100)
+    return {
+        "mean_ms": round(statistics.fmean(samples) * 1000, 3),
+        "p50_ms": round(q[49] * 1000, 3),
+        "p95_ms": round(q[94] * 1000, 3),
+        "p99_ms": round(q[98] * 1000, 3),
+    }
+
+
+def _message_update(update_id, user_id, text) -> dict:
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private", "first_name": "Bench"},
+        "from": {"id": user_id, "is_bot": False, "first_name": "Bench", "last_name": "User", "language_code": "en"},
+        "text": text,
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": update_id, "message": message}
+
+
+class FakeTelegram:
+    """fake_telegram.py running in a subprocess."""
+
+    def __init__(self, port, settings):
+        self.url = f"http://127.0.0.1:{port}"
+        self.port = port
+        self.settings = settings
+        self.process = None
+        self.client = httpx.AsyncClient(base_url=self.url)
+
+    async def start(self):
+        args = [sys.executable, os.path.join(BACKEND_DIR, "fake_telegram.py"), "--port", str(self.port)]
+        for key, value in self.settings.items():
+            args += [f"--{key.replace('_', '-')}", str(value)]
+        self.process = subprocess.Popen(args)
+        for _ in range(100):
+            try:
+                await self.client.get("/_stats")
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.1)
+        raise RuntimeError("Fake Bot API server didn't start")
+
+    async def configure(self, **settings):
+        await self.client.post("/_config", json=settings)
+        await self.client.post("/_reset")
+
+    async def stats(self) -> dict:
+        return (await self.client.get("/_stats")).json()
+
+    async def stop(self):
+        await self.client.aclose()
+        if self.process:
+            self.process.terminate()
+            self.process.wait()
+
+
+class Benchmarks:
+    """The benchmarks, sharing one bot application and fake server."""
+
+    def __init__(self, args, fake: FakeTelegram):
+        self.args = args
+        self.fake = fake
+        self.next_update_id = 1
+        self.next_user_id = FIRST_USER_ID
+        # Imported here, after the environment points them at the temporary data directory.
+        import bot
+        import jobs
+        import main
+        import storage
+        import webhook
+        self.bot, self.jobs, self.main, self.storage, self.webhook = bot, jobs, main, storage, webhook
+        self.app = main.ptb_app
+
+    async def start(self):
+        await self.app.initialize()
+        self.storage.claim_subscribers()  # this process runs the bot
+        await self.app.start()  # consumes the update queue, for the /start spike
+
+    async def stop(self):
+        await self.app.stop()
+        await self.app.shutdown()
+
+    def _update(self, user_id, text) -> dict:
+        update = _message_update(self.next_update_id, user_id, text)
+        self.next_update_id += 1
+        return update
+
+    async def _process(self, user_id, text) -> float:
+        """Run a message through every handler and return how long it took."""
+        from telegram import Update
+        update = Update.de_json(self._update(user_id, text), self.app.bot)
+        started = time.perf_counter()
+        await self.app.process_update(update)
+        return time.perf_counter() - started
+
+    def _new_users(self, count) -> range:
+        users = range(self.next_user_id, self.next_user_id + count)
+        self.next_user_id += count
+        return users
+
+    async def broadcast(self, size) -> dict:
+        await self.fake.configure(
+            latency=self.args.latency, forbidden_rate=self.args.forbidden_rate,
+            retry_after_rate=self.args.retry_after_rate, rate_limit=self.args.rate_limit,
+        )
+        job = self.jobs.BroadcastJob.create(self._new_users(size), {"text": "Benchmark broadcast"})
+        started = time.perf_counter()
+        await self.bot.run_broadcast_job(self.app.bot, job)
+        elapsed = time.perf_counter() - started
+        fake = await self.fake.stats()
+        return {
+            "recipients": size,
+            "seconds": round(elapsed, 3),
+            "msg_per_s": round(job.state["sent"] / elapsed, 1),
+            "sent": job.state["sent"],
+            "failed": job.state["failed"],
+            "retry_after": fake.get("retry_after", 0),
+            "forbidden": fake.get("forbidden", 0),
+        }
+
+    async def keywords(self, size) -> dict:
+        await self.fake.configure(latency=0, jitter=0, forbidden_rate=0, retry_after_rate=0, rate_limit=0)
+        conn = self.storage.get_connection()
+        with conn:
+            conn.execute("DELETE FROM keywords")
+        self.storage.save_keywords(
+            {"keyword": f"keyword{i}", "response": f"Reply {i}", "priority": i % 7} for i in range(size)
+        )
+        await self.bot.keyword_matcher.refresh()
+        user_id = self._new_users(1)[0]
+        texts = [
+            f"hello keyword{i * 7919 % size} how are you" if i % 2 else "a message that matches nothing at all"
+            for i in range(self.args.messages)
+        ]
+        await self._process(user_id, texts[0])  # builds the keyword index
+        samples = [await self._process(user_id, text) for text in texts]
+        replies = (await self.fake.stats()).get("sendMessage", 0)
+        expected = sum(1 for text in texts if text.startswith("hello"))
+        if replies != expected:
+            # Dropped or deduplicated messages would only time the drop path.
+            raise RuntimeError(f"keywords: {replies} replies sent for {expected} matching messages")
+        return {"keywords": size, "messages": len(samples), "replies": replies, **_percentiles(samples)}
+
+    async def start_spike(self, size) -> dict:
+        await self.fake.configure(
+            latency=self.args.latency, forbidden_rate=0, retry_after_rate=0, rate_limit=0,
+        )
+        processor = self.bot.update_processor
+        before = processor.processed
+        updates = [self._update(user_id, "/start spike") for user_id in self._new_users(size)]
+        started = time.perf_counter()
+        accepted = sum(self.webhook.enqueue_update(self.app, update) for update in updates)
+        while processor.processed - before < accepted:
+            await asyncio.sleep(0.01)
+        elapsed = time.perf_counter() - started
+        return {
+            "updates": size,
+            "accepted": accepted,
+            "rejected": size - accepted,
+            "seconds": round(elapsed, 3),
+            "updates_per_s": round(accepted / elapsed, 1),
+        }
+
+    async def api_stats(self, size) -> dict:
+        import auth
+        subscribers = self.storage.get_subscribers()
+        missing = size - len(subscribers)
+        if missing > 0:
+            subscribers.add_many(self._new_users(missing))
+        conn = self.storage.get_connection()
+        with conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO chats (chat_id, title, type) VALUES (?, ?, 'group')",
+                ((str(-chat), f"Chat {chat}") for chat in range(1, size // 10 + 1)),
+            )
+        token = auth.create_access_token({"sub": os.environ["API_USER"]})
+        transport = httpx.ASGITransport(app=self.main.app)
+        samples = []
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://benchmark", headers={"Authorization": f"Bearer {token}"}
+        ) as client:
+            for _ in range(self.args.requests):
+                started = time.perf_counter()
+                response = await client.get("/api/stats")
+                samples.append(time.perf_counter() - started)
+                response.raise_for_status()
+        body = response.json()
+        return {"users": body["user_count"], "chats": body["chat_count"], "requests": len(samples), **_percentiles(samples)}
+
+
+def compare(results: dict, baseline_path: str, tolerance: float) -> list:
+    """Return a line for every result that got worse than the baseline by more than `tolerance`."""
+    with open(baseline_path, "r") as f:
+        baseline = json.load(f)["results"]
+    regressions = []
+    for name, rows in results.items():
+        metric, higher_is_better = KEY_METRICS[name]
+        previous = {json.dumps(row["size"]): row for row in baseline.get(name, [])}
+        for row in rows:
+            old = previous.get(json.dumps(row["size"]))
+            if not old or not old[metric]:
+                continue
+            change = (row[metric] - old[metric]) / old[metric]
+            if (-change if higher_is_better else change) > tolerance:
+                regressions.append(f"{name} size={row['size']}: {metric} {old[metric]} -> {row[metric]} ({change:+.0%})")
+    return regressions
+
+
+async def run(args) -> dict:
+    fake = FakeTelegram(args.port, {
+        "latency": args.latency, "forbidden_rate": args.forbidden_rate,
+        "retry_after_rate": args.retry_after_rate, "rate_limit": args.rate_limit,
+    })
+    await fake.start()
+    benchmarks = None
+    results = {}
+    try:
+        benchmarks = Benchmarks(args, fake)
+        await benchmarks.start()
+        for name in args.benchmarks:
+            results[name] = []
+            sizes = sorted({max(size // 10, 1) for size in SIZES[name]}) if args.quick else SIZES[name]
+            for size in sizes:
+                row = {"size": size, **await getattr(benchmarks, name)(size)}
+                print(f"{name:12} {json.dumps(row)}", flush=True)
+                results[name].append(row)
+    finally:
+        if benchmarks:
+            await benchmarks.stop()
+        await fake.stop()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("benchmarks", nargs="*", help=f"benchmarks to run (default: all of {', '.join(SIZES)})")
+    parser.add_argument("--quick", action="store_true", help="run every size divided by 10")
+    parser.add_argument("--port", type=int, default=8081, help="port for the fake Bot API server")
+    parser.add_argument("--latency", type=float, default=0.02, help="simulated Bot API latency in seconds")
+    parser.add_argument("--forbidden-rate", type=float, default=0.02, help="share of recipients that blocked the bot")
+    parser.add_argument("--retry-after-rate", type=float, default=0.0, help="share of sends answered with 429")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="sends/s the fake server allows; 0 for no limit")
+    parser.add_argument("--send-rate", type=float, default=5000, help="the send engine's global rate (BROADCAST_RATE)")
+    parser.add_argument("--concurrency", type=int, default=20, help="parallel senders (BROADCAST_CONCURRENCY)")
+    parser.add_argument("--messages", type=int, default=2000, help="messages per keyword benchmark")
+    parser.add_argument("--requests", type=int, default=200, help="requests per /api/stats benchmark")
+    parser.add_argument("--output", help="result file (default: benchmark-results/<timestamp>.json)")
+    parser.add_argument("--compare", help="earlier result file; exit with 1 if a result regressed")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed regression before failing (0.2 = 20%%)")
+    args = parser.parse_args()
+    args.benchmarks = args.benchmarks or list(SIZES)
+    unknown = set(args.benchmarks) - set(SIZES)
+    if unknown:
+        parser.error(f"unknown benchmarks: {', '.join(sorted(unknown))}")
+
+    output = args.output or os.path.join(
+        "benchmark-results", f"benchmark-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+    )
+    output = os.path.abspath(output)
+    baseline = os.path.abspath(args.compare) if args.compare else None
+
+    # Isolate every data file in a temporary directory and point the bot at the fake server.
+    data_dir = tempfile.mkdtemp(prefix="bot-benchmark-")
+    os.environ.update({
+        "TELEGRAM_TOKEN": "123456:benchmark",
+        "TELEGRAM_API_URL": f"http://127.0.0.1:{args.port}",
+        "WEBHOOK_URL": "",
+        "SECRET_KEY": "benchmark",
+        "API_USER": "benchmark",
+        "OWNER_ID": "0",
+        "DB_FILE": os.path.join(data_dir, "bot.db"),
+        "SUBSCRIBERS_FILE": os.path.join(data_dir, "users.log"),
+        "JOBS_DIR": os.path.join(data_dir, "jobs"),
+        "MEDIA_DIR": os.path.join(data_dir, "media"),
+        "BROADCAST_RATE": str(args.send_rate),
+        "BROADCAST_PER_CHAT_INTERVAL": "0",
+        "BROADCAST_CONCURRENCY": str(args.concurrency),
+        # Flood control off: the benchmarks send far more per user than it allows.
+        "INBOUND_USER_RATE": "0",
+        "INBOUND_CHAT_RATE": "0",
+        "INBOUND_SHED_QUEUE_DEPTH": "0",
+        "START_COALESCE_SECONDS": "0",
+        "KEYWORD_REPLY_TTL": "0",
+    })
+    sys.path.insert(0, BACKEND_DIR)
+    os.chdir(data_dir)  # so the legacy JSON files in backend/ aren't imported
+    try:
+        started_at = datetime.now().isoformat(timespec="seconds")
+        results = asyncio.run(run(args))
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump({
+            "started_at": started_at,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "settings": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+            "results": results,
+        }, f, indent=2)
+    print(f"Results saved to {output}")
+
+    if baseline:
+        regressions = compare(results, baseline, args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        if regressions:
+            sys.exit(1)
+        print("No regressions")
+
+
+if __name__ == "__main__":
+    main()
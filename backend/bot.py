@@ -1,25 +1,79 @@
+import asyncio
+import functools
+import html
 import logging
 import os
-import json
 import re
+import time
 from datetime import timedelta
 from dotenv import load_dotenv
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Update
+from telegram.error import BadRequest
 from telegram.ext import (
     Application,
+    ApplicationHandlerStop,
+    ChatMemberHandler,
     CommandHandler,
     MessageHandler,
+    TypeHandler,
     filters,
     ContextTypes,
-    PicklePersistence,
     ConversationHandler,
     CallbackQueryHandler,
 )
 
+import async_storage
+import jobs
+import metrics
+import pickers
+import throttle
+import webhook
+from broadcaster import Broadcaster
+from keywords import KeywordMatcher
+from persistence import SQLitePersistence
+from processor import ChatLaneUpdateProcessor
+from recipients import InactiveRecipients
+from segments import SOURCE_MAX_LENGTH, SegmentIndex
+from scheduler import Scheduler, describe, next_run_after, parse_recurrence, parse_time
+from templates import CompiledTemplate, TemplateCache
+from storage import (
+    load_templates,
+    load_templates_page,
+    templates_version,
+    save_template,
+    delete_template_from_file,
+    load_chats,
+    load_chats_page,
+    save_chat,
+    chats_version,
+    load_counters,
+    load_keyword_rules,
+    get_keyword,
+    save_keyword,
+    save_keywords,
+    delete_keyword,
+    keywords_version,
+    get_user_ids,
+    add_user_id,
+    add_user_ids,
+    claim_subscribers,
+    release_subscribers,
+    import_user_profiles,
+    save_user_profile,
+    count_users,
+    add_scheduled_job,
+    load_scheduled_jobs,
+    count_scheduled_jobs,
+    cancel_scheduled_job,
+    claim_scheduled_broadcast,
+)
+
 # Load environment variables from .env file
 load_dotenv()
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 OWNER_ID = int(os.getenv("OWNER_ID", 0))
+# Bot API server to use instead of api.telegram.org, e.g. a local one for benchmarks.
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "").rstrip("/")
 
 # Enable logging
 logging.basicConfig(
@@ -28,88 +82,92 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # --- Constants ---
-USERS_FILE = "users.json"
-KEYWORDS_FILE = "keywords.json"
-CHATS_FILE = "chats.json"
-TEMPLATES_FILE = "templates.json"
-
 # Conversation states
 SELECTING_CHAT, SELECTING_TEMPLATE = range(2)
 
-# --- Helper Functions ---
-def load_templates():
-    """Load templates from the storage file."""
-    try:
-        with open(TEMPLATES_FILE, "r") as f:
-            return json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        return {}
-
-def save_template(name, content, button_text=None, button_url=None):
-    """Save a template to the storage file, with optional button data."""
-    templates = load_templates()
-    template_data = {"content": content}
-    if button_text and button_url:
-        template_data["button_text"] = button_text
-        template_data["button_url"] = button_url
-    templates[name] = template_data
-    with open(TEMPLATES_FILE, "w") as f:
-        json.dump(templates, f, indent=4)
-
-def delete_template_from_file(name):
-    """Delete a template from the storage file."""
-    templates = load_templates()
-    if name in templates:
-        del templates[name]
-        with open(TEMPLATES_FILE, "w") as f:
-            json.dump(templates, f, indent=4)
-        return True
-    return False
-
-def load_chats():
-    """Load chats from the storage file."""
-    try:
-        with open(CHATS_FILE, "r") as f:
-            return json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        return {}
-
-def save_chat(chat_id, chat_title, chat_type):
-    """Save a chat to the storage file."""
-    chats = load_chats()
-    chats[str(chat_id)] = {"title": chat_title, "type": chat_type}
-    with open(CHATS_FILE, "w") as f:
-        json.dump(chats, f, indent=4)
-
-def load_keywords():
-    """Load keywords from the storage file."""
-    try:
-        with open(KEYWORDS_FILE, "r") as f:
-            return json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        return {}
+# Shared send engine; Telegram's rate limits apply per bot token.
+broadcaster = Broadcaster()
 
-def get_user_ids():
-    """Load user IDs from the storage file."""
-    try:
-        with open(USERS_FILE, "r") as f:
-            return set(json.load(f))
-    except (FileNotFoundError, json.JSONDecodeError):
-        return set()
-
-def add_user_id(user_id):
-    """Add a user ID to the storage file."""
-    user_ids = get_user_ids()
-    if user_id not in user_ids:
-        user_ids.add(user_id)
-        with open(USERS_FILE, "w") as f:
-            json.dump(list(user_ids), f)
+# Broadcast jobs running in this process. They aren't created with
+# Application.create_task, because stop() would wait for them to finish.
+broadcast_tasks = set()
+
+# Durable scheduler for /schedule messages, started from the API's startup hook.
+scheduler = Scheduler()
+
+# Updates from different chats run in parallel; each chat's updates stay in order.
+update_processor = ChatLaneUpdateProcessor()
+
+# Updates received but not handled yet: waiting in the queue, or for their chat's lane.
+update_queue = asyncio.Queue(maxsize=webhook.UPDATE_QUEUE_SIZE)
+
+# Flood control, run before any other handler; drops are counted by reason.
+inbound = throttle.InboundThrottle(OWNER_ID, lambda: update_queue.qsize() + update_processor.queued)
+
+# Keyword matches and replies of the last few seconds, so repeated keywords are answered once.
+reply_cache = throttle.ReplyCache()
+
+# Keyword auto-replies, compiled once and rebuilt when the stored keywords change.
+keyword_matcher = KeywordMatcher(load_keyword_rules, keywords_version)
+
+# Users who blocked the bot and chats it can't post in; broadcasts skip them.
+inactive = InactiveRecipients()
+
+# Bitmap index of subscriber attributes for segmented broadcasts, on the bot's process only.
+segment_index = SegmentIndex()
+
+# Templates compiled once and reloaded when the stored templates change.
+template_cache = TemplateCache()
+
+# Saved chats for the chat lists, loaded off the event loop and reloaded when they change.
+chat_cache = async_storage.Snapshot(load_chats, chats_version)
+
+# Sorted indexes behind the /send pickers and the chat and template lists,
+# rebuilt only when the cached chats or templates are reloaded.
+chat_index = pickers.IndexCache(
+    lambda chats: [(f"{chat['title'] or chat_id} ({chat['type']})", chat_id) for chat_id, chat in chats.items()]
+)
+template_index = pickers.IndexCache(lambda templates: [(name, name) for name in templates])
+
+# Stored counts for the statistics, reloaded when chats or inactive recipients change.
+count_cache = async_storage.Snapshot(
+    functools.partial(load_counters, ("chats", "inactive_users", "inactive_chats")),
+    functools.partial(load_counters, ("chats_version", "inactive_version")),
+)
+
+async def get_counts() -> dict:
+    """Subscribed users and saved chats, with how many of each are active."""
+    stored = await count_cache.get()
+    user_count = await async_storage.read(count_users)
+    inactive_counts = {"users": stored["inactive_users"], "chats": stored["inactive_chats"]}
+    return {
+        "user_count": user_count,
+        "chat_count": stored["chats"],
+        **inactive.counts(user_count, stored["chats"], inactive_counts),
+    }
+
+async def import_users(rows) -> int:
+    """Subscribe imported users and store their profiles. Returns how many were new."""
+    by_id = {row["user_id"]: row for row in rows}
+    new = [by_id[user_id] for user_id in add_user_ids(by_id)]
+    if new:
+        await async_storage.write(import_user_profiles, new)
+        for row in new:
+            segment_index.on_import(row["user_id"], row["language_code"], row["source"])
+    return len(new)
 
 # --- Command Handlers ---
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Send a welcome message and add the user to the user list."""
     user = update.effective_user
+    # Deep links like t.me/<bot>?start=<source> arrive as the /start argument.
+    source = context.args[0][:SOURCE_MAX_LENGTH] if context.args else None
     add_user_id(user.id)
+    await async_storage.write(
+        save_user_profile, user.id, user.first_name, user.last_name, user.username, user.language_code, source
+    )
+    segment_index.on_start(user.id, user.language_code, source)
+    inactive.reactivate(user.id)
 
     welcome_message = (
         f"Hello {user.mention_html()}! Welcome to your new marketing bot.\n\n"
@@ -125,7 +183,11 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         "--- Messaging ---\n"
         "/broadcast &lt;message&gt; - Sends a message to all users.\n"
         "/send - Interactively send a template to a saved chat.\n"
-        "/schedule &lt;time&gt; &lt;target&gt; &lt;message&gt; - Schedules a message.\n"
+        "/schedule &lt;time&gt; &lt;target&gt; &lt;message&gt; - Schedules a message. "
+        "The target can be a chat, all, or a segment like segment:lang=es.\n"
+        "/schedule_every &lt;interval|cron&gt; &lt;target&gt; &lt;message&gt; - Schedules a recurring message.\n"
+        "/scheduled - Lists scheduled messages.\n"
+        "/unschedule &lt;id&gt; - Cancels a scheduled message.\n"
         "--- Other ---\n"
         "/stats - Show bot statistics.\n"
     )
@@ -154,28 +216,61 @@ async def add_template(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         if not (button_text and button_url):
             await update.message.reply_text("Button text and URL must both be provided if you use the button syntax.")
             return
-        save_template(name, content, button_text, button_url)
+
+    try:
+        CompiledTemplate(name, {"content": content})
+    except ValueError as e:
+        await update.message.reply_text(f"Invalid template: {e}")
+        return
+
+    await async_storage.write(save_template, name, content, button_text, button_url)
+    await template_cache.refresh()
+    if button_text:
         await update.message.reply_text(f"Template '{name}' with button saved successfully.")
     else:
-        save_template(name, content)
         await update.message.reply_text(f"Template '{name}' saved successfully.")
 
+async def reply_list(update: Update, header: str, entries, total: int, command: str) -> None:
+    """Send list entries in as few messages as fit, cut off with a hint to narrow it down."""
+    messages, shown = pickers.chunk_messages(header, entries)
+    if shown < total:
+        messages.append(f"…and {total - shown} more. Use /{command} &lt;first letters&gt; to narrow the list.")
+    for message in messages:
+        await update.message.reply_html(message)
+
 async def list_templates(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """(Owner only) Lists all message templates."""
+    """(Owner only) Lists message templates, optionally those whose name starts with the argument."""
     if update.effective_user.id != OWNER_ID:
         return
-    templates = load_templates()
+    templates = template_cache.all()
+    problems = template_cache.problems()
+    if problems:
+        lines = "".join(f"{html.escape(name)}: {html.escape(problem)}\n" for name, problem in sorted(problems.items()))
+        await update.message.reply_html(f"<b>Templates that can't be sent:</b>\n{lines}Fix or delete them.")
     if not templates:
-        await update.message.reply_text("No templates saved yet. Use /add_template to create one.")
+        if not problems:
+            await update.message.reply_text("No templates saved yet. Use /add_template to create one.")
         return
-    message = "<b>Saved Templates:</b>\n\n"
-    for name, data in templates.items():
-        message += f"<b>Name:</b> {name}\n"
-        message += f"<b>Content:</b> {data['content']}\n"
-        if "button_text" in data:
-            message += f"<b>Button:</b> [{data['button_text']}]({data['button_url']})\n"
-        message += "--------------------\n"
-    await update.message.reply_html(message)
+    index = template_index.get(templates)
+    matches = index.matches(" ".join(context.args))
+
+    def entries():
+        for position in matches:
+            name = index.entries[position][1]
+            data = templates[name].data
+            # Content is shown as its HTML source, shortened, so a long template can't overflow the message.
+            entry = (
+                f"<b>Name:</b> {html.escape(pickers.shorten(name))}\n"
+                f"<b>Content:</b> {html.escape(pickers.shorten(data['content']))}\n"
+            )
+            if data.get("button_text"):
+                button_text, button_url = pickers.shorten(data["button_text"]), pickers.shorten(data["button_url"])
+                entry += f"<b>Button:</b> [{html.escape(button_text)}]({html.escape(button_url)})\n"
+            if "media_type" in data:
+                entry += f"<b>Media:</b> {data['media_type']} ({len(data['media'])} file(s))\n"
+            yield entry + "--------------------\n"
+
+    await reply_list(update, "<b>Saved Templates:</b>\n\n", entries(), len(matches), "list_templates")
 
 async def delete_template(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """(Owner only) Deletes a message template."""
@@ -185,7 +280,8 @@ async def delete_template(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         await update.message.reply_text("Usage: /delete_template <name>")
         return
     name = context.args[0]
-    if delete_template_from_file(name):
+    if await async_storage.write(delete_template_from_file, name):
+        await template_cache.refresh()
         await update.message.reply_text(f"Template '{name}' deleted successfully.")
     else:
         await update.message.reply_text(f"Template '{name}' not found.")
@@ -195,13 +291,13 @@ async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if update.effective_user.id != OWNER_ID:
         return
 
-    user_ids = get_user_ids()
-    chats = load_chats()
-
+    counts = await get_counts()
     message = (
         "<b>Bot Statistics:</b>\n\n"
-        f"<b>Subscribed Users:</b> {len(user_ids)}\n"
-        f"<b>Saved Chats:</b> {len(chats)}\n"
+        f"<b>Subscribed Users:</b> {counts['user_count']}\n"
+        f"<b>Active Users:</b> {counts['active_users']} ({counts['inactive_users']} inactive)\n"
+        f"<b>Saved Chats:</b> {counts['chat_count']}\n"
+        f"<b>Active Chats:</b> {counts['active_chats']} ({counts['inactive_chats']} inactive)\n"
     )
 
     await update.message.reply_html(message)
@@ -219,7 +315,8 @@ async def add_chat(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         await update.message.reply_text("This command can only be used in a group or channel.")
         return
 
-    save_chat(chat.id, chat.title, chat.type)
+    await async_storage.write(save_chat, chat.id, chat.title, chat.type)
+    chat_cache.invalidate()
     await update.message.reply_text(f"Success! Chat '{chat.title}' ({chat.type}) has been saved.")
 
 async def list_chats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -229,19 +326,64 @@ async def list_chats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
         await update.message.reply_text("You are not authorized to use this command.")
         return
 
-    chats = load_chats()
+    chats = await chat_cache.get()
     if not chats:
         await update.message.reply_text("No chats have been saved yet. Use /add_chat in a group or channel to save it.")
         return
-
-    message = "<b>Saved Chats:</b>\n\n"
-    for chat_id, chat_info in chats.items():
-        message += f"<b>Title:</b> {chat_info['title']}\n"
-        message += f"<b>Type:</b> {chat_info['type']}\n"
-        message += f"<b>ID:</b> <code>{chat_id}</code>\n"
-        message += "--------------------\n"
-
-    await update.message.reply_html(message)
+    index = chat_index.get(chats)
+    matches = index.matches(" ".join(context.args))
+
+    def entries():
+        for position in matches:
+            chat_id = index.entries[position][1]
+            chat_info = chats[chat_id]
+            yield (
+                f"<b>Title:</b> {html.escape(chat_info['title'] or '')}\n"
+                f"<b>Type:</b> {chat_info['type']}\n"
+                f"<b>ID:</b> <code>{chat_id}</code>\n"
+                "--------------------\n"
+            )
+
+    await reply_list(update, "<b>Saved Chats:</b>\n\n", entries(), len(matches), "list_chats")
+
+# --- Interactive Send ---
+# The destination and template are picked from paged keyboards; typing text
+# while one is open filters it to the entries starting with that text.
+async def show_picker(context: ContextTypes.DEFAULT_TYPE, kind: str, query: str = "", page: int = 0):
+    """Render a page of the chat or template picker and remember its choices.
+
+    Returns the message text and the keyboard, which is None if nothing matches.
+    """
+    index = chat_index.get(await chat_cache.get()) if kind == "chats" else template_index.get(template_cache.all())
+    previous = context.user_data.get("picker") or {}
+    tag = (previous.get("tag", 0) + 1) % 1000
+    keyboard, slots = pickers.render_page(index, query, page, tag)
+    context.user_data["picker"] = {"kind": kind, "query": query, "tag": tag, "slots": slots}
+    what = "destination" if kind == "chats" else "message template"
+    if keyboard is None:
+        return f"Nothing starts with '{query}'. Type another search, or /cancel.", None
+    matching = f"{len(index.matches(query))} matching '{query}'" if query else f"{len(index)}"
+    return f"Please select a {what} ({matching}). Type to search.", keyboard
+
+async def picker_choice(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle a picker button: turn the page, or return the chosen value (None otherwise)."""
+    query = update.callback_query
+    picker = context.user_data.get("picker")
+    button = pickers.parse_callback(query.data)
+    if picker is None:
+        await query.answer()
+        await query.edit_message_text("This menu has expired. Please start again with /send.")
+        return None
+    if button is None or button[1] != picker["tag"]:
+        await query.answer("This menu is out of date; use the latest one." if button else None)
+        return None
+    await query.answer()
+    action, _, number = button
+    if action == pickers.PAGE:
+        text, keyboard = await show_picker(context, picker["kind"], picker["query"], number)
+        await query.edit_message_text(text, reply_markup=keyboard)
+        return None
+    return picker["slots"][number] if number < len(picker["slots"]) else None
 
 async def send_interactive(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Starts the interactive process to send a message."""
@@ -249,69 +391,61 @@ async def send_interactive(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         await update.message.reply_text("You are not authorized to use this command.")
         return ConversationHandler.END
 
-    chats = load_chats()
-    if not chats:
+    if not await chat_cache.get():
         await update.message.reply_text("No chats saved. Use /add_chat in a group/channel first.")
         return ConversationHandler.END
 
-    keyboard = []
-    for chat_id, chat_info in chats.items():
-        keyboard.append([InlineKeyboardButton(f"{chat_info['title']} ({chat_info['type']})", callback_data=chat_id)])
-
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.message.reply_text("Please select a destination:", reply_markup=reply_markup)
-
+    text, keyboard = await show_picker(context, "chats")
+    await update.message.reply_text(text, reply_markup=keyboard)
     return SELECTING_CHAT
 
+async def search_picker(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Filters the open picker to the entries starting with the typed text."""
+    picker = context.user_data.get("picker")
+    if picker is None:
+        return ConversationHandler.END
+    text, keyboard = await show_picker(context, picker["kind"], update.message.text.strip())
+    await update.message.reply_text(text, reply_markup=keyboard)
+    return SELECTING_CHAT if picker["kind"] == "chats" else SELECTING_TEMPLATE
+
 async def select_chat_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Handles chat selection and asks for template selection."""
-    query = update.callback_query
-    await query.answer()
-
-    chat_id = query.data
+    chat_id = await picker_choice(update, context)
+    if chat_id is None:
+        return SELECTING_CHAT if "picker" in context.user_data else ConversationHandler.END
     context.user_data['selected_chat_id'] = chat_id
 
-    templates = load_templates()
-    if not templates:
-        await query.edit_message_text("No templates found. Please add one with /add_template.")
+    text, keyboard = await show_picker(context, "templates")
+    if keyboard is None:
+        await update.callback_query.edit_message_text("No templates found. Please add one with /add_template.")
+        context.user_data.clear()
         return ConversationHandler.END
 
-    keyboard = []
-    for name in templates.keys():
-        keyboard.append([InlineKeyboardButton(name, callback_data=name)])
-
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await query.edit_message_text("Please select a message template:", reply_markup=reply_markup)
-
+    await update.callback_query.edit_message_text(text, reply_markup=keyboard)
     return SELECTING_TEMPLATE
 
 async def select_template_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Handles template selection and sends the message."""
     query = update.callback_query
-    await query.answer()
-
-    template_name = query.data
+    template_name = await picker_choice(update, context)
+    if template_name is None:
+        return SELECTING_TEMPLATE if "picker" in context.user_data else ConversationHandler.END
     chat_id = context.user_data.get('selected_chat_id')
 
-    templates = load_templates()
-    template = templates.get(template_name)
+    template = template_cache.get(template_name)
+    problem = template_cache.problem(template_name)
+    if problem:
+        await query.edit_message_text(f"Template '{template_name}' can't be sent: {problem}")
+        context.user_data.clear()
+        return ConversationHandler.END
 
     if not chat_id or not template:
         await query.edit_message_text("Error: Could not find chat or template. Please start again.")
+        context.user_data.clear()
         return ConversationHandler.END
 
-    reply_markup = None
-    if "button_text" in template and "button_url" in template:
-        button = InlineKeyboardButton(template["button_text"], url=template["button_url"])
-        reply_markup = InlineKeyboardMarkup([[button]])
-
     try:
-        await context.bot.send_message(
-            chat_id=chat_id,
-            text=template['content'],
-            reply_markup=reply_markup,
-            parse_mode='HTML' # Assume content might have HTML
-        )
+        await broadcaster.send(chat_id, lambda cid: template.send(context.bot, cid))
         await query.edit_message_text(f"Message sent successfully to chat ID {chat_id}.")
     except Exception as e:
         logger.error(f"Failed to send interactive message to {chat_id}: {e}")
@@ -338,75 +472,217 @@ async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         await update.message.reply_text("Please provide a message to broadcast. Usage: /broadcast <message>")
         return
 
-    user_ids = get_user_ids()
+    user_ids = await async_storage.read(get_user_ids)
     if not user_ids:
         await update.message.reply_text("No users have started the bot yet.")
         return
 
-    success_count = 0
-    failure_count = 0
-    for uid in user_ids:
-        try:
-            await context.bot.send_message(chat_id=uid, text=message)
-            success_count += 1
-        except Exception as e:
-            logger.error(f"Failed to send message to {uid}: {e}")
-            failure_count += 1
+    # The recipient snapshot can be megabytes; write it off the event loop.
+    job = await asyncio.to_thread(jobs.BroadcastJob.create, user_ids, {"text": message}, update.effective_chat.id, inactive)
+    await update.message.reply_text(
+        f"Broadcast started to {job.state['total']} users ({job.state['skipped']} inactive skipped).\nJob ID: {job.id}"
+    )
+    # Run in the background so the handler doesn't block other updates.
+    start_broadcast_job(context.bot, job)
+
+def template_payload(template: CompiledTemplate) -> dict:
+    """Broadcast job payload that sends a template. The job keeps its own copy."""
+    return {"template": {"name": template.name, **template.data}}
+
+def broadcast_sender(bot, payload: dict):
+    """Return the send function for a broadcast job payload."""
+    if "template" in payload:
+        data = dict(payload["template"])
+        template = CompiledTemplate(data.pop("name"), data)
+        return lambda uid: template.send(bot, uid)
+    return lambda uid: bot.send_message(chat_id=uid, **payload)
+
+def record_result(job: jobs.BroadcastJob, index, chat_id, message, error) -> None:
+    """Record a recipient's result on the job, marking permanent failures inactive."""
+    if error is not None:
+        inactive.record_failure(chat_id, error)
+    messages = message if isinstance(message, (list, tuple)) else [message] if message else []
+    job.record(index, error is None, chat_id, str(error) if error else None, [m.message_id for m in messages])
+
+async def run_broadcast_job(bot, job: jobs.BroadcastJob) -> None:
+    """Send a saved broadcast job from its cursor and report the outcome."""
+    try:
+        result = await broadcaster.run(
+            job.recipients(),
+            broadcast_sender(bot, job.state["payload"]),
+            on_result=lambda index, chat_id, message, error: record_result(job, index, chat_id, message, error),
+        )
+    except asyncio.CancelledError:
+        await job.suspend()
+        raise
+    await job.finish()
+
+    report_chat_id = job.state.get("report_chat_id")
+    if report_chat_id:
+        await bot.send_message(
+            chat_id=report_chat_id,
+            text=f"Broadcast finished.\nSent: {job.state['sent']}\nFailed: {job.state['failed']}\n"
+                 f"Time: {result.elapsed:.1f}s ({result.rate:.1f} msg/s)",
+        )
 
-    await update.message.reply_text(f"Broadcast finished.\nSent: {success_count}\nFailed: {failure_count}")
+def start_broadcast_job(bot, job: jobs.BroadcastJob) -> None:
+    """Run a broadcast job in the background."""
+    task = asyncio.create_task(run_broadcast_job(bot, job))
+    broadcast_tasks.add(task)
+    task.add_done_callback(broadcast_tasks.discard)
+
+def ledger_editor(bot, job_payload: dict, text: str):
+    """Return the coroutine function that edits one delivered (chat_id, message_id) to `text`.
+
+    Messages sent from a template are re-rendered from it with the new
+    content, keeping its button and placeholders; media get a new caption.
+    """
+    template = None
+    if "template" in job_payload:
+        data = dict(job_payload["template"])
+        template = CompiledTemplate(data.pop("name"), dict(data, content=text))
+
+    async def edit(target):
+        chat_id, message_id = target
+        try:
+            if template is None:
+                return await bot.edit_message_text(text, chat_id=chat_id, message_id=message_id)
+            kwargs = await template.render_for(chat_id)
+            if template.media_type:
+                return await bot.edit_message_caption(
+                    chat_id=chat_id, message_id=message_id, caption=kwargs["text"], parse_mode=kwargs["parse_mode"],
+                    reply_markup=None if template.media_type == "album" else kwargs["reply_markup"],
+                )
+            return await bot.edit_message_text(chat_id=chat_id, message_id=message_id, **kwargs)
+        except BadRequest as e:
+            if "not modified" not in e.message.lower():
+                raise
+    return edit
+
+async def run_ledger_operation(bot, operation: jobs.LedgerOperation) -> None:
+    """Edit or delete every message a broadcast job delivered, through the send engine."""
+    if operation.state["action"] == "edit":
+        job = await asyncio.to_thread(jobs.BroadcastJob.load, operation.state["job_id"])
+        act = ledger_editor(bot, job.state["payload"], operation.state["payload"]["text"])
+    else:
+        act = lambda target: bot.delete_message(chat_id=target[0], message_id=target[1])
+    targets = await asyncio.to_thread(operation.targets)  # reads the whole ledger
+    try:
+        await broadcaster.run(
+            targets,
+            act,
+            on_result=lambda index, target, message, error: operation.record(*target, error is None),
+            key=lambda target: target[0],
+        )
+    except asyncio.CancelledError:
+        await operation.finish("stopped")
+        raise
+    await operation.finish()
+
+def start_ledger_operation(bot, operation: jobs.LedgerOperation) -> None:
+    """Run a bulk edit or delete in the background."""
+    task = asyncio.create_task(run_ledger_operation(bot, operation))
+    broadcast_tasks.add(task)
+    task.add_done_callback(broadcast_tasks.discard)
+
+def resume_broadcast_jobs(application: Application) -> int:
+    """Restart broadcast jobs that were interrupted by a shutdown."""
+    pending = jobs.pending_jobs()
+    for job in pending:
+        logger.info(f"Resuming broadcast job {job.id} at {job.state['cursor']}/{job.state['total']}")
+        start_broadcast_job(application.bot, job)
+    return len(pending)
+
+async def stop_broadcast_jobs() -> None:
+    """Stop running broadcast jobs at their checkpoint so the next start resumes them."""
+    for task in list(broadcast_tasks):
+        task.cancel()
+    await asyncio.gather(*broadcast_tasks, return_exceptions=True)
+
+async def throttle_inbound(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Drop updates from users and chats that send too much, and non-commands while overloaded."""
+    reason = inbound.check(update)
+    if reason is not None:
+        inbound.drop(reason)
+        raise ApplicationHandlerStop
+
+async def track_activity(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Record when subscribers were last seen, for activity segments."""
+    user = update.effective_user
+    if user and not user.is_bot:
+        segment_index.touch(user.id, user.language_code)
+
+async def track_my_chat_member(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Mark chats inactive when the bot is blocked or removed, and active again when it is back."""
+    member = update.my_chat_member
+    status = member.new_chat_member.status
+    if status in ("kicked", "left"):
+        reason = "blocked" if member.chat.type == "private" else "forbidden"
+        inactive.mark(member.chat.id, reason, f"Bot status changed to {status}")
+    elif status in ("member", "administrator"):
+        inactive.reactivate(member.chat.id)
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle keyword-based auto-replies."""
-    message_text = update.message.text.lower()
-    keywords = load_keywords()
-
-    for keyword, response in keywords.items():
-        # Using \b for word boundary to avoid partial matches
-        if re.search(r'\b' + re.escape(keyword.lower()) + r'\b', message_text):
-            await update.message.reply_text(response)
-            return # Respond once per message
-
-def parse_time(time_str: str) -> int:
-    """Parse a time string like 1d2h3m4s into seconds."""
-    parts = re.findall(r'(\d+)([dhms])', time_str.lower())
-    if not parts:
-        return 0
-
-    total_seconds = 0
-    for value, unit in parts:
-        value = int(value)
-        if unit == 'd':
-            total_seconds += value * 86400
-        elif unit == 'h':
-            total_seconds += value * 3600
-        elif unit == 'm':
-            total_seconds += value * 60
-        elif unit == 's':
-            total_seconds += value
-    return total_seconds
-
-async def scheduled_task(context: ContextTypes.DEFAULT_TYPE):
-    """Callback function for scheduled jobs."""
-    job = context.job
-    target = job.data['target']
-    message = job.data['message']
-    bot = context.bot
-
-    logger.info(f"Executing scheduled job to target {target}")
-
-    if target == "all":
-        user_ids = get_user_ids()
-        for uid in user_ids:
-            try:
-                await bot.send_message(chat_id=uid, text=message)
-            except Exception as e:
-                logger.error(f"Failed to send scheduled message to user {uid}: {e}")
+    language_code = update.effective_user.language_code if update.effective_user else None
+    text = update.message.text
+    response = reply_cache.match(text, language_code, keyword_matcher.match)
+    if response is None:
+        return
+    if not reply_cache.first_reply(update.effective_chat.id, update.message.message_id):
+        inbound.drop("duplicate_reply")
+        return
+    await update.message.reply_text(response) # Respond once per message
+
+async def start_scheduled_broadcast(bot, job: dict) -> None:
+    """Start the broadcast job for a scheduled message to all users or a segment.
+
+    A one-shot message stores the broadcast's ID before creating it, so if
+    the bot stops before the message is marked done, the next run finds
+    the broadcast (resumed on startup) instead of sending it again.
+    """
+    broadcast_id = job.get("broadcast_id")
+    if broadcast_id and await asyncio.to_thread(jobs.BroadcastJob.load, broadcast_id):
+        logger.info(f"Scheduled job {job['id']} already started broadcast job {broadcast_id}")
+        return
+    if job["target"] == "all":
+        recipients = await async_storage.read(get_user_ids)
+    else:
+        try:
+            recipients = segment_index.members(job["target"][len("segment:"):])
+        except ValueError as e:
+            logger.error(f"Scheduled job {job['id']} has an invalid segment: {e}")
+            return
+    if not job["recurrence"] and not broadcast_id:
+        broadcast_id = jobs.new_job_id()
+        if not await async_storage.write(claim_scheduled_broadcast, job["id"], broadcast_id):
+            logger.info(f"Scheduled job {job['id']} was cancelled or started elsewhere")
+            return
+    broadcast_job = await asyncio.to_thread(
+        jobs.BroadcastJob.create, recipients, {"text": job["message"]}, None, inactive, broadcast_id
+    )
+    start_broadcast_job(bot, broadcast_job)
+
+async def scheduled_task(bot, job: dict) -> None:
+    """Send a scheduled message when the scheduler fires it."""
+    target = job['target']
+    message = job['message']
+
+    logger.info(f"Executing scheduled job {job['id']} to target {target}")
+
+    if target == "all" or target.startswith("segment:"):
+        await start_scheduled_broadcast(bot, job)
     else:
         try:
-            await bot.send_message(chat_id=target, text=message)
+            await broadcaster.send(target, lambda cid: bot.send_message(chat_id=cid, text=message))
         except Exception as e:
+            inactive.record_failure(target, e)
             logger.error(f"Failed to send scheduled message to target {target}: {e}")
 
+async def start_scheduler(application: Application) -> None:
+    """Load pending scheduled messages and start firing them."""
+    await scheduler.start(lambda job: scheduled_task(application.bot, job))
+
 async def schedule_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """(Owner only) Schedule a message."""
     if update.effective_user.id != OWNER_ID:
@@ -426,19 +702,92 @@ async def schedule_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         await update.message.reply_text("Invalid time format. Please use a format like 1d2h3m4s.")
         return
 
-    context.job_queue.run_once(
-        scheduled_task,
-        when=delay,
-        data={'target': target, 'message': message},
-        name=f"schedule_{update.effective_message.message_id}"
+    job = await scheduler.add(target, message, time.time() + delay)
+
+    await update.message.reply_text(f"Message #{job['id']} scheduled to be sent to {target} in {time_str}.")
+
+async def schedule_recurring(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """(Owner only) Schedule a message that repeats on an interval or a cron expression."""
+    if update.effective_user.id != OWNER_ID:
+        await update.message.reply_text("You are not authorized to use this command.")
+        return
+
+    # Either "<interval> <target> <message>" or "<5 cron fields> <target> <message>".
+    args = context.args
+    spec_len = 1 if args and re.fullmatch(r"(\d+[dhms])+", args[0].lower()) else 5
+    if len(args) < spec_len + 2:
+        await update.message.reply_text(
+            "Usage: /schedule_every <interval|cron expression> <target|all> <message>\n"
+            "Examples: /schedule_every 1d all Daily news\n"
+            "/schedule_every 0 9 * * 1 all Monday update"
+        )
+        return
+
+    try:
+        recurrence = parse_recurrence(" ".join(args[:spec_len]))
+    except ValueError as e:
+        await update.message.reply_text(f"Invalid schedule: {e}")
+        return
+    target = args[spec_len]
+    message = " ".join(args[spec_len + 1:])
+
+    first_run = next_run_after(recurrence, time.time(), time.time())
+    job = await scheduler.add(target, message, first_run, recurrence)
+    await update.message.reply_html(
+        f"Recurring message #{job['id']} scheduled for {html.escape(target)}.\n"
+        f"Next run: {describe(job)['next_run_at']}"
     )
 
-    await update.message.reply_text(f"Message scheduled to be sent to {target} in {time_str}.")
+async def list_scheduled(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """(Owner only) Lists the next pending scheduled messages."""
+    if update.effective_user.id != OWNER_ID:
+        return
+    pending = scheduler.pending(limit=20)
+    if not pending:
+        await update.message.reply_text("No messages are scheduled.")
+        return
+    message = f"<b>Scheduled Messages ({len(scheduler)} pending):</b>\n\n"
+    for job in pending:
+        message += f"<b>#{job['id']}</b> to {html.escape(job['target'])} at {describe(job)['next_run_at']}\n"
+        if job['recurrence']:
+            message += f"<b>Repeats:</b> {html.escape(job['recurrence'])}\n"
+        message += f"{html.escape(job['message'][:100])}\n"
+        message += "--------------------\n"
+    await update.message.reply_html(message)
+
+async def unschedule(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """(Owner only) Cancels a scheduled message."""
+    if update.effective_user.id != OWNER_ID:
+        return
+    if not context.args or not context.args[0].lstrip("#").isdigit():
+        await update.message.reply_text("Usage: /unschedule <id>")
+        return
+    job_id = int(context.args[0].lstrip("#"))
+    if await scheduler.cancel(job_id):
+        await update.message.reply_text(f"Scheduled message #{job_id} cancelled.")
+    else:
+        await update.message.reply_text(f"Scheduled message #{job_id} not found.")
 
 def create_application() -> Application:
     """Create and configure the Telegram bot application."""
-    persistence = PicklePersistence(filepath="persistence.pickle")
-    application = Application.builder().token(TELEGRAM_TOKEN).persistence(persistence).build()
+    persistence = SQLitePersistence()
+    builder = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        .persistence(persistence)
+        .update_queue(update_queue)
+        .concurrent_updates(update_processor)
+    )
+    if TELEGRAM_API_URL:
+        builder = builder.base_url(f"{TELEGRAM_API_URL}/bot").base_file_url(f"{TELEGRAM_API_URL}/file/bot")
+    if webhook.is_enabled():
+        # Updates are pushed to the FastAPI webhook route, so no polling updater.
+        builder = builder.updater(None)
+    application = builder.build()
+
+    # Run before the other handlers for every update, flood control first.
+    application.add_handler(TypeHandler(Update, throttle_inbound), group=-2)
+    application.add_handler(TypeHandler(Update, track_activity), group=-1)
 
     # on different commands - answer in Telegram
     application.add_handler(CommandHandler("start", start))
@@ -450,19 +799,31 @@ def create_application() -> Application:
     application.add_handler(CommandHandler("stats", stats))
     application.add_handler(CommandHandler("broadcast", broadcast))
     application.add_handler(CommandHandler("schedule", schedule_message))
+    application.add_handler(CommandHandler("schedule_every", schedule_recurring))
+    application.add_handler(CommandHandler("scheduled", list_scheduled))
+    application.add_handler(CommandHandler("unschedule", unschedule))
 
     # Setup ConversationHandler for interactive send
     conv_handler = ConversationHandler(
         entry_points=[CommandHandler("send", send_interactive)],
         states={
-            SELECTING_CHAT: [CallbackQueryHandler(select_chat_callback)],
-            SELECTING_TEMPLATE: [CallbackQueryHandler(select_template_callback)],
+            SELECTING_CHAT: [
+                CallbackQueryHandler(select_chat_callback),
+                MessageHandler(filters.TEXT & ~filters.COMMAND, search_picker),
+            ],
+            SELECTING_TEMPLATE: [
+                CallbackQueryHandler(select_template_callback),
+                MessageHandler(filters.TEXT & ~filters.COMMAND, search_picker),
+            ],
         },
         fallbacks=[CommandHandler("cancel", cancel)],
     )
     application.add_handler(conv_handler)
 
+    application.add_handler(ChatMemberHandler(track_my_chat_member, ChatMemberHandler.MY_CHAT_MEMBER))
+
     # Add the message handler for keywords
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
 
+    metrics.instrument_handlers(application)
     return application
@@ -0,0 +1,206 @@
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+
+from dotenv import load_dotenv
+from telegram.error import RetryAfter
+
+import metrics
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+# Telegram allows roughly 30 messages per second overall and 1 per second per chat.
+GLOBAL_RATE = float(os.getenv("BROADCAST_RATE", 30))
+PER_CHAT_INTERVAL = float(os.getenv("BROADCAST_PER_CHAT_INTERVAL", 1))
+CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", 20))
+MAX_RETRIES = 5
+RATE_WINDOW = 10  # seconds used to compute the current msg/s
+
+
+def retry_after_seconds(error: RetryAfter) -> float:
+    """Return the back-off requested by a RetryAfter error in seconds."""
+    value = error.retry_after
+    if hasattr(value, "total_seconds"):
+        return value.total_seconds()
+    return float(value)
+
+
+class TokenBucket:
+    """Global token bucket shared by every send that goes through the engine."""
+
+    def __init__(self, rate: float, capacity: float = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float) -> None:
+        """Stop handing out tokens for the given number of seconds."""
+        resume_at = time.monotonic() + seconds
+        if resume_at > self._paused_until:
+            self._paused_until = resume_at
+            self._updated = resume_at
+            self._tokens = 0
+
+    async def acquire(self) -> None:
+        """Wait until a token is available and take it."""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class ChatLimiter:
+    """Spaces out consecutive sends to the same chat."""
+
+    def __init__(self, interval: float, max_tracked: int = 10000):
+        self.interval = interval
+        self.max_tracked = max_tracked
+        self._next_slot = {}
+
+    async def wait(self, chat_id) -> None:
+        """Reserve the next free slot for a chat and sleep until it arrives."""
+        now = time.monotonic()
+        if len(self._next_slot) > self.max_tracked:
+            self._next_slot = {k: v for k, v in self._next_slot.items() if v > now}
+        slot = max(now, self._next_slot.get(chat_id, 0.0))
+        self._next_slot[chat_id] = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+
+class BroadcastResult:
+    """Outcome of a fan-out run."""
+
+    def __init__(self):
+        self.sent = 0
+        self.failed = 0
+        self.started = time.monotonic()
+        self.finished = None
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished or time.monotonic()) - self.started
+
+    @property
+    def rate(self) -> float:
+        """Achieved messages per second."""
+        elapsed = self.elapsed
+        return self.sent / elapsed if elapsed > 0 else 0.0
+
+
+class Broadcaster:
+    """Rate-limited, concurrent send engine.
+
+    Every send waits for the per-chat limiter and the global token bucket.
+    A RetryAfter pauses the bucket for everyone and the same recipient is retried.
+    """
+
+    def __init__(self, rate: float = GLOBAL_RATE, per_chat_interval: float = PER_CHAT_INTERVAL,
+                 concurrency: int = CONCURRENCY):
+        self.bucket = TokenBucket(rate)
+        self.chats = ChatLimiter(per_chat_interval)
+        self.concurrency = concurrency
+        self.sent_total = 0
+        self.failed_total = 0
+        self.retry_after_total = 0
+        self._recent = deque(maxlen=int(rate * RATE_WINDOW) or 1)
+
+    async def send(self, chat_id, send, key=None):
+        """Send a single message to chat_id through the limiters.
+
+        `send` is a coroutine function taking the chat ID, e.g.
+        ``lambda cid: bot.send_message(chat_id=cid, text=text)``. When chat_id
+        is some other target, `key(chat_id)` gives the chat to space sends by.
+        """
+        for attempt in range(MAX_RETRIES):
+            await self.chats.wait(key(chat_id) if key else chat_id)
+            await self.bucket.acquire()
+            started = time.perf_counter()
+            try:
+                message = await send(chat_id)
+            except RetryAfter as e:
+                delay = retry_after_seconds(e)
+                self.retry_after_total += 1
+                metrics.retry_afters.inc()
+                logger.warning(f"Flood limit hit sending to {chat_id}, pausing all sends for {delay}s")
+                self.bucket.pause(delay)
+                if attempt == MAX_RETRIES - 1:
+                    self.failed_total += 1
+                    metrics.sends.inc("failed")
+                    metrics.send_failures.inc(type(e).__name__)
+                    raise
+                continue
+            except Exception as e:
+                self.failed_total += 1
+                metrics.sends.inc("failed")
+                metrics.send_failures.inc(type(e).__name__)
+                raise
+            finally:
+                metrics.send_seconds.observe(time.perf_counter() - started)
+            self.sent_total += 1
+            metrics.sends.inc("sent")
+            self._recent.append(time.monotonic())
+            return message
+
+    async def run(self, recipients, send, on_result=None, key=None) -> BroadcastResult:
+        """Send to every chat ID in `recipients` with bounded concurrency.
+
+        `on_result(index, chat_id, message, error)` is called after each recipient,
+        with `error` set to None on success. See `send()` for `key`.
+        """
+        result = BroadcastResult()
+        pending = enumerate(recipients)
+
+        async def worker():
+            for index, chat_id in pending:
+                message, error = None, None
+                try:
+                    message = await self.send(chat_id, send, key)
+                    result.sent += 1
+                except Exception as e:
+                    logger.error(f"Failed to send message to {chat_id}: {e}")
+                    error = e
+                    result.failed += 1
+                if on_result:
+                    on_result(index, chat_id, message, error)
+
+        await asyncio.gather(*(worker() for _ in range(self.concurrency)))
+        result.finished = time.monotonic()
+        logger.info(
+            f"Broadcast finished: {result.sent} sent, {result.failed} failed "
+            f"in {result.elapsed:.1f}s ({result.rate:.1f} msg/s)"
+        )
+        return result
+
+    def current_rate(self) -> float:
+        """Messages per second achieved over the last few seconds."""
+        now = time.monotonic()
+        recent = [t for t in self._recent if now - t <= RATE_WINDOW]
+        if len(recent) < 2:
+            return 0.0
+        return len(recent) / max(now - recent[0], 1e-6)
+
+    def stats(self) -> dict:
+        """Return counters for the API."""
+        return {
+            "sent": self.sent_total,
+            "failed": self.failed_total,
+            "retry_after": self.retry_after_total,
+            "current_rate": round(self.current_rate(), 2),
+            "rate_limit": self.bucket.rate,
+        }
@@ -0,0 +1,84 @@
+import json
+from collections import OrderedDict
+
+from fastapi import HTTPException, Request, Response, status
+
+import async_storage
+
+# --- Configuration ---
+CACHED_BODIES = 64  # rendered response bodies kept per worker
+MAX_PAGE_SIZE = 1000
+
+
+def _matches(if_none_match: str, etag: str) -> bool:
+    # Weak comparison, as If-None-Match requires: W/"x" matches "x".
+    if if_none_match.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == etag.removeprefix("W/") for tag in if_none_match.split(","))
+
+
+def _render(load):
+    return json.dumps(load(), separators=(",", ":")).encode()
+
+
+class VersionedResponses:
+    """JSON responses for data identified by a storage version counter.
+
+    The ETag is derived from the version, so a client that already has the
+    current data gets a 304 without the data being loaded or serialized, and
+    every worker agrees on it. Rendered bodies are kept by ETag, so clients
+    without a cached copy share one serialization per version.
+    """
+
+    def __init__(self, size: int = CACHED_BODIES):
+        self.size = size
+        self._bodies = OrderedDict()  # etag -> bytes
+        self.not_modified = 0
+        self.hits = 0
+        self.renders = 0
+
+    async def respond(self, request: Request, etag: str, load) -> Response:
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+        if _matches(request.headers.get("if-none-match", ""), etag):
+            self.not_modified += 1
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+        body = self._bodies.get(etag)
+        if body is None:
+            body = await async_storage.read(_render, load)
+            self.renders += 1
+            self._bodies[etag] = body
+            while len(self._bodies) > self.size:
+                self._bodies.popitem(last=False)
+        else:
+            self._bodies.move_to_end(etag)
+            self.hits += 1
+        return Response(body, media_type="application/json", headers=headers)
+
+    def stats(self) -> dict:
+        return {
+            "not_modified": self.not_modified,
+            "cache_hits": self.hits,
+            "renders": self.renders,
+            "cached": len(self._bodies),
+        }
+
+
+responses = VersionedResponses()
+
+
+async def listing(request: Request, name: str, version, load_all, load_page, cursor: int = 0, limit: int = None):
+    """A stored collection, or one page of it when `limit` is given, as a conditional response.
+
+    Pages look like {name: {...}, "next_cursor": ...}; pass next_cursor back
+    as `cursor` for the following page until it is null.
+    """
+    if limit is not None and not 1 <= limit <= MAX_PAGE_SIZE:
+        raise HTTPException(status_code=422, detail=f"limit must be between 1 and {MAX_PAGE_SIZE}")
+    current = await async_storage.read(version)
+    if limit is None:
+        return await responses.respond(request, f'W/"{name}-{current}"', load_all)
+
+    def load():
+        items, next_cursor = load_page(cursor, limit)
+        return {name: items, "next_cursor": next_cursor}
+    return await responses.respond(request, f'W/"{name}-{current}-{cursor}-{limit}"', load)
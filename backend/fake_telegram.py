@@ -0,0 +1,185 @@
+"""Local stand-in for the Telegram Bot API, used by benchmark.py.
+
+Answers the Bot API methods the bot calls with plausible results, after a
+simulated network latency. Sends can fail like the real API: with 403
+Forbidden for a fixed share of chat IDs (users who blocked the bot), and
+with 429 retry_after once a global rate limit is exceeded or at random.
+
+    python fake_telegram.py --port 8081 --latency 0.05 --forbidden-rate 0.02
+
+Point the bot at it with TELEGRAM_API_URL=http://127.0.0.1:8081. The
+behaviour can be changed while running with POST /_config, and the call
+counters are read from GET /_stats and cleared with POST /_reset.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import time
+from collections import Counter
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+app = FastAPI(title="Fake Telegram Bot API")
+
+config = {
+    "latency": 0.02,  # seconds added to every send
+    "jitter": 0.01,  # up to this many extra seconds, at random
+    "rate_limit": 0.0,  # sends per second before answering 429; 0 for no limit
+    "retry_after": 1,  # seconds requested in 429 answers
+    "retry_after_rate": 0.0,  # share of sends answered 429 at random
+    "forbidden_rate": 0.0,  # share of chat IDs that blocked the bot
+}
+stats = Counter()
+_message_ids = itertools.count(1)
+_bucket = {"tokens": 0.0, "updated": time.monotonic()}
+
+BOT_USER = {
+    "id": 100000001,
+    "is_bot": True,
+    "first_name": "Benchmark",
+    "username": "benchmark_bot",
+    "can_join_groups": True,
+    "can_read_all_group_messages": False,
+    "supports_inline_queries": False,
+}
+SEND_PREFIXES = ("send", "copy", "forward", "edit", "delete")
+
+
+def _error(code, description, parameters=None):
+    body = {"ok": False, "error_code": code, "description": description}
+    if parameters:
+        body["parameters"] = parameters
+    return JSONResponse(body, status_code=code)
+
+
+def _rate_limited() -> bool:
+    rate = config["rate_limit"]
+    if not rate:
+        return False
+    now = time.monotonic()
+    _bucket["tokens"] = min(rate, _bucket["tokens"] + (now - _bucket["updated"]) * rate)
+    _bucket["updated"] = now
+    if _bucket["tokens"] < 1:
+        return True
+    _bucket["tokens"] -= 1
+    return False
+
+
+def _blocked(chat_id) -> bool:
+    # Spread over consecutive IDs with a multiplicative hash, but the same for every call.
+    try:
+        return int(chat_id) * 2654435761 % 2**32 < config["forbidden_rate"] * 2**32
+    except ValueError:
+        return False
+
+
+def _message(params, extra=None):
+    chat_id = params.get("chat_id", 0)
+    message = {
+        "message_id": next(_message_ids),
+        "date": int(time.time()),
+        "chat": {"id": int(chat_id) if str(chat_id).lstrip("-").isdigit() else 0, "type": "private"},
+        "from": BOT_USER,
+    }
+    if "text" in params:
+        message["text"] = params["text"]
+    if "caption" in params:
+        message["caption"] = params["caption"]
+    message.update(extra or {})
+    return message
+
+
+def _file(kind):
+    file_id = f"{kind}-{next(_message_ids)}"
+    return {"file_id": file_id, "file_unique_id": file_id, "file_size": 1}
+
+
+def _result(method, params):
+    if method == "getMe":
+        return BOT_USER
+    if method == "getWebhookInfo":
+        return {"url": "", "has_custom_certificate": False, "pending_update_count": 0}
+    if method == "sendPhoto":
+        return _message(params, {"photo": [dict(_file("photo"), width=1, height=1)]})
+    if method == "sendVideo":
+        return _message(params, {"video": dict(_file("video"), width=1, height=1, duration=1)})
+    if method == "sendDocument":
+        return _message(params, {"document": _file("document")})
+    if method == "sendMediaGroup":
+        media = json.loads(params.get("media", "[]"))
+        return [
+            _message(params, {"photo": [dict(_file("photo"), width=1, height=1)]} if item.get("type") == "photo"
+                     else {"video": dict(_file("video"), width=1, height=1, duration=1)})
+            for item in media
+        ]
+    if method.startswith(("send", "copy", "forward", "edit")):
+        return _message(params)
+    return True
+
+
+@app.post("/bot{token}/{method}")
+async def call(token: str, method: str, request: Request):
+    if request.headers.get("content-type", "").startswith("application/json"):
+        params = await request.json()
+    else:
+        params = dict(await request.form())
+    stats[method] += 1
+
+    if method == "getUpdates":
+        # Nothing to deliver; wait like a long poll so polling doesn't spin.
+        await asyncio.sleep(min(float(params.get("timeout") or 0), 1.0))
+        return {"ok": True, "result": []}
+
+    if method.startswith(SEND_PREFIXES):
+        delay = config["latency"] + random.uniform(0, config["jitter"])
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if _rate_limited() or random.random() < config["retry_after_rate"]:
+            stats["retry_after"] += 1
+            retry_after = max(int(config["retry_after"]), 1)
+            return _error(429, f"Too Many Requests: retry after {retry_after}", {"retry_after": retry_after})
+        if _blocked(params.get("chat_id", "")):
+            stats["forbidden"] += 1
+            return _error(403, "Forbidden: bot was blocked by the user")
+        stats["ok"] += 1
+    return {"ok": True, "result": _result(method, params)}
+
+
+@app.get("/_stats")
+async def get_stats():
+    return dict(stats)
+
+
+@app.post("/_reset")
+async def reset_stats():
+    stats.clear()
+    return dict(stats)
+
+
+@app.post("/_config")
+async def update_config(request: Request):
+    changes = await request.json()
+    unknown = set(changes) - set(config)
+    if unknown:
+        return _error(400, f"Unknown settings: {', '.join(sorted(unknown))}")
+    config.update({key: float(value) for key, value in changes.items()})
+    return config
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    for key, value in config.items():
+        parser.add_argument(f"--{key.replace('_', '-')}", type=float, default=value)
+    args = parser.parse_args()
+    config.update({key: getattr(args, key) for key in config})
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
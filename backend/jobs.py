@@ -0,0 +1,454 @@
+import asyncio
+import json
+import logging
+import os
+import struct
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from dotenv import load_dotenv
+
+from ledger import DELETE_FAILED, DELETED, DELIVERED, EDIT_FAILED, EDITED, FAILED, DeliveryLedger
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+# --- Constants ---
+JOBS_DIR = os.getenv("JOBS_DIR", "jobs")
+CHECKPOINT_EVERY = 200  # recipients between checkpoints
+RECORD = struct.Struct("<q")  # one signed 64-bit chat ID per recipient
+READ_CHUNK = 4096  # recipients per read when resuming
+EVENT_QUEUE_SIZE = 1000  # per-recipient events buffered for each progress stream
+
+# Jobs and ledger operations currently running in this process, for live progress.
+active_jobs = {}
+active_operations = {}
+
+# Checkpoints are written off the event loop on one thread, so each job's
+# ledger records and cursor reach the disk in the order they were taken.
+_checkpoints = ThreadPoolExecutor(1, thread_name_prefix="job-checkpoint")
+
+
+def new_job_id():
+    return uuid.uuid4().hex
+
+
+def _state_path(job_id):
+    return os.path.join(JOBS_DIR, f"{job_id}.json")
+
+
+def _recipients_path(job_id):
+    return os.path.join(JOBS_DIR, f"{job_id}.recipients")
+
+
+def _ledger_path(job_id):
+    return os.path.join(JOBS_DIR, f"{job_id}.ledger")
+
+
+def _operation_path(operation_id):
+    return os.path.join(JOBS_DIR, f"{operation_id}.operation")
+
+
+def _write_atomic(path, data):
+    """Write JSON to a temp file and rename it over the target."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def _save(ledger, records, path, state):
+    """Append ledger records, then save the state that counts them. Runs on the checkpoint thread."""
+    try:
+        ledger.write(records)
+        _write_atomic(path, state)
+    except OSError as e:
+        logger.error(f"Failed to checkpoint {path}: {e}")
+
+
+class BroadcastJob:
+    """A broadcast persisted to disk so it can be resumed after a restart.
+
+    Recipients are stored as fixed-width records, so resuming seeks straight
+    to the cursor. The cursor only covers recipients whose result is known;
+    anything sent after the last checkpoint may be sent again on resume.
+    """
+
+    def __init__(self, state):
+        self.state = state
+        self._done = {}  # index -> success, for results ahead of the cursor
+        self._since_checkpoint = 0
+        self._run_started = None
+        self._run_start_cursor = state["cursor"]
+        self._subscribers = set()
+        self.dropped_events = 0
+        self.ledger = DeliveryLedger(_ledger_path(state["id"]))
+
+    @property
+    def id(self):
+        return self.state["id"]
+
+    @classmethod
+    def create(cls, recipients, payload, report_chat_id=None, skip=(), job_id=None):
+        """Snapshot the recipients, leaving out any in `skip`, and save a new job.
+
+        The job exists once its state file is written, after the snapshot,
+        so a `job_id` reserved in advance can be passed again after a crash.
+        """
+        os.makedirs(JOBS_DIR, exist_ok=True)
+        job_id = job_id or new_job_id()
+        total = skipped = 0
+        with open(_recipients_path(job_id), "wb") as f:
+            for chat_id in recipients:
+                if chat_id in skip:
+                    skipped += 1
+                    continue
+                f.write(RECORD.pack(int(chat_id)))
+                total += 1
+        now = time.time()
+        job = cls({
+            "id": job_id,
+            "status": "running",
+            "payload": payload,
+            "report_chat_id": report_chat_id,
+            "total": total,
+            "skipped": skipped,
+            "cursor": 0,
+            "sent": 0,
+            "failed": 0,
+            "rate": 0.0,
+            "created_at": now,
+            "updated_at": now,
+        })
+        job.checkpoint()
+        return job
+
+    @classmethod
+    def load(cls, job_id):
+        """Load a job from disk, or return None if it doesn't exist."""
+        if not job_id.isalnum():
+            return None
+        try:
+            with open(_state_path(job_id), "r") as f:
+                return cls(json.load(f))
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def recipients(self):
+        """Yield the chat IDs that haven't been confirmed yet, starting at the cursor."""
+        self._run_started = time.monotonic()
+        self._run_start_cursor = self.state["cursor"]
+        active_jobs[self.id] = self
+        with open(_recipients_path(self.id), "rb") as f:
+            f.seek(self.state["cursor"] * RECORD.size)
+            while True:
+                chunk = f.read(READ_CHUNK * RECORD.size)
+                if not chunk:
+                    return
+                for (chat_id,) in RECORD.iter_unpack(chunk):
+                    yield chat_id
+
+    def record(self, offset, success, chat_id=None, error=None, message_ids=()):
+        """Record the result for the recipient at `offset` from where this run started.
+
+        The IDs of the delivered messages (several for an album) go to the delivery ledger.
+        """
+        index = self._run_start_cursor + offset
+        self._done[index] = success
+        if chat_id is not None:
+            if success:
+                for message_id in message_ids:
+                    self.ledger.append(chat_id, message_id, DELIVERED)
+            else:
+                self.ledger.append(chat_id, 0, FAILED)
+        if self._subscribers:
+            self._publish({"index": index, "chat_id": chat_id, "ok": success, "error": error})
+        cursor = self.state["cursor"]
+        while cursor in self._done:
+            if self._done.pop(cursor):
+                self.state["sent"] += 1
+            else:
+                self.state["failed"] += 1
+            cursor += 1
+        self.state["cursor"] = cursor
+        self._since_checkpoint += 1
+        if self._since_checkpoint >= CHECKPOINT_EVERY:
+            self._checkpoint_later()
+
+    def subscribe(self):
+        """Return a queue that receives an event for each recipient result."""
+        queue = asyncio.Queue(EVENT_QUEUE_SIZE)
+        self._subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue):
+        self._subscribers.discard(queue)
+
+    def _publish(self, event):
+        for queue in self._subscribers:
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                # A slow reader misses events rather than holding up the send.
+                self.dropped_events += 1
+
+    def _update_rate(self):
+        if self._run_started is not None:
+            elapsed = time.monotonic() - self._run_started
+            processed = self.state["cursor"] - self._run_start_cursor
+            if elapsed > 0:
+                self.state["rate"] = round(processed / elapsed, 2)
+
+    def _snapshot(self):
+        self._update_rate()
+        self.state["updated_at"] = time.time()
+        self._since_checkpoint = 0
+        return self.ledger, self.ledger.take(), _state_path(self.id), dict(self.state)
+
+    def checkpoint(self):
+        """Persist the cursor and counters, after the ledger entries they cover."""
+        _save(*self._snapshot())
+
+    def _checkpoint_later(self):
+        """Checkpoint on the checkpoint thread; returns its future."""
+        return _checkpoints.submit(_save, *self._snapshot())
+
+    async def suspend(self):
+        """Save progress when the job is stopped before finishing."""
+        await asyncio.wrap_future(self._checkpoint_later())
+        active_jobs.pop(self.id, None)
+
+    async def finish(self):
+        """Mark the job as done and drop the recipient snapshot."""
+        self.state["status"] = "done"
+        await asyncio.wrap_future(self._checkpoint_later())
+        active_jobs.pop(self.id, None)
+        try:
+            await asyncio.to_thread(os.remove, _recipients_path(self.id))
+        except FileNotFoundError:
+            pass
+
+    def progress(self):
+        """Return counters and ETA for this job."""
+        self._update_rate()
+        return progress(self.state)
+
+
+def progress(state):
+    """Summarize a job state without touching its recipient list."""
+    remaining = state["total"] - state["cursor"]
+    rate = state.get("rate") or 0
+    eta = round(remaining / rate) if rate and state["status"] == "running" else None
+    return {
+        "id": state["id"],
+        "status": state["status"],
+        "total": state["total"],
+        "sent": state["sent"],
+        "failed": state["failed"],
+        "skipped": state.get("skipped", 0),
+        "remaining": remaining,
+        "rate": rate,
+        "eta_seconds": eta,
+        "created_at": state["created_at"],
+        "updated_at": state["updated_at"],
+    }
+
+
+def list_jobs():
+    """Return the saved state of every job, newest first."""
+    states = []
+    try:
+        names = os.listdir(JOBS_DIR)
+    except FileNotFoundError:
+        return states
+    for name in names:
+        if not name.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(JOBS_DIR, name), "r") as f:
+                states.append(json.load(f))
+        except (OSError, json.JSONDecodeError) as e:
+            logger.error(f"Failed to read job file {name}: {e}")
+    states.sort(key=lambda s: s["created_at"], reverse=True)
+    return states
+
+
+async def list_progress():
+    """Return progress for every job, using live counters for jobs running here."""
+    states = await asyncio.to_thread(list_jobs)
+    return [
+        active_jobs[state["id"]].progress() if state["id"] in active_jobs else progress(state)
+        for state in states
+    ]
+
+
+async def get_progress(job_id):
+    """Return progress for one job, or None if it doesn't exist."""
+    job = active_jobs.get(job_id) or await asyncio.to_thread(BroadcastJob.load, job_id)
+    return job.progress() if job else None
+
+
+async def events(job_id, interval=1.0):
+    """Yield (event, data) pairs describing a job until it stops running.
+
+    While the job runs in this process, every recipient result is yielded as
+    a "recipient" event. A "progress" event with counters and throughput
+    follows every `interval` seconds; other processes only see those,
+    read from the last checkpoint. The last event is "end".
+    """
+    job = active_jobs.get(job_id)
+    queue = job.subscribe() if job else None
+    try:
+        while True:
+            deadline = time.monotonic() + interval
+            while queue is not None:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    yield "recipient", await asyncio.wait_for(queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            if queue is None:
+                await asyncio.sleep(interval)
+            current = await get_progress(job_id)
+            if current is None:
+                return
+            yield "progress", current
+            if current["status"] != "running" or (job is not None and job_id not in active_jobs):
+                while queue is not None and not queue.empty():
+                    yield "recipient", queue.get_nowait()
+                yield "end", current
+                return
+    finally:
+        if job is not None:
+            job.unsubscribe(queue)
+
+
+class LedgerOperation:
+    """A bulk edit or delete of the messages a finished broadcast job delivered.
+
+    The targets are read from the job's delivery ledger, and every result is
+    appended to it, so the ledger always shows each message's latest state.
+    """
+
+    def __init__(self, state):
+        self.state = state
+        self.ledger = DeliveryLedger(_ledger_path(state["job_id"]))
+        self._started = time.monotonic()
+        self._since_checkpoint = 0
+
+    @property
+    def id(self):
+        return self.state["id"]
+
+    @classmethod
+    def create(cls, job_id, action, payload):
+        """Start an 'edit' or 'delete' of job_id's delivered messages."""
+        now = time.time()
+        return cls({
+            "id": uuid.uuid4().hex,
+            "job_id": job_id,
+            "action": action,
+            "payload": payload,
+            "status": "running",
+            "total": 0,
+            "done": 0,
+            "failed": 0,
+            "rate": 0.0,
+            "created_at": now,
+            "updated_at": now,
+        })
+
+    def targets(self):
+        """Return the (chat_id, message_id) pairs to act on and start tracking progress."""
+        targets = self.ledger.live_messages()
+        self.state["total"] = len(targets)
+        active_operations[self.id] = self
+        self.checkpoint()
+        return targets
+
+    def record(self, chat_id, message_id, success):
+        if self.state["action"] == "edit":
+            status = EDITED if success else EDIT_FAILED
+        else:
+            status = DELETED if success else DELETE_FAILED
+        self.ledger.append(chat_id, message_id, status)
+        self.state["done" if success else "failed"] += 1
+        self._since_checkpoint += 1
+        if self._since_checkpoint >= CHECKPOINT_EVERY:
+            _checkpoints.submit(_save, *self._snapshot())
+
+    def _snapshot(self):
+        elapsed = time.monotonic() - self._started
+        if elapsed > 0:
+            self.state["rate"] = round((self.state["done"] + self.state["failed"]) / elapsed, 2)
+        self.state["updated_at"] = time.time()
+        self._since_checkpoint = 0
+        return self.ledger, self.ledger.take(), _operation_path(self.id), dict(self.state)
+
+    def checkpoint(self):
+        _save(*self._snapshot())
+
+    async def finish(self, status="done"):
+        """Save the final counters. An operation stopped early ends as 'stopped'."""
+        self.state["status"] = status
+        await asyncio.wrap_future(_checkpoints.submit(_save, *self._snapshot()))
+        active_operations.pop(self.id, None)
+
+    def progress(self):
+        state = self.state
+        remaining = state["total"] - state["done"] - state["failed"]
+        rate = state["rate"]
+        return {
+            "id": state["id"],
+            "job_id": state["job_id"],
+            "action": state["action"],
+            "status": state["status"],
+            "total": state["total"],
+            "done": state["done"],
+            "failed": state["failed"],
+            "remaining": remaining,
+            "rate": rate,
+            "eta_seconds": round(remaining / rate) if rate and state["status"] == "running" else None,
+            "created_at": state["created_at"],
+            "updated_at": state["updated_at"],
+        }
+
+
+def _ledger_summary(ledger):
+    return ledger.summary() if ledger.exists() else None
+
+
+async def get_ledger_summary(job_id):
+    """Count the messages of a job by their latest status, or None if the job has no ledger."""
+    if not job_id.isalnum():
+        return None
+    if job_id in active_jobs:
+        # The read below gets its own, unbuffered ledger; queue this one's records ahead of it.
+        ledger = active_jobs[job_id].ledger
+        await asyncio.wrap_future(_checkpoints.submit(ledger.write, ledger.take()))
+    return await asyncio.to_thread(_ledger_summary, DeliveryLedger(_ledger_path(job_id)))
+
+
+def _load_operation(operation_id):
+    try:
+        with open(_operation_path(operation_id), "r") as f:
+            return LedgerOperation(json.load(f)).progress()
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+async def get_operation_progress(operation_id):
+    """Return progress for a bulk edit or delete, or None if it doesn't exist."""
+    if operation_id in active_operations:
+        return active_operations[operation_id].progress()
+    if not operation_id.isalnum():
+        return None
+    return await asyncio.to_thread(_load_operation, operation_id)
+
+
+def pending_jobs():
+    """Return jobs that were interrupted before finishing."""
+    return [BroadcastJob(state) for state in list_jobs() if state["status"] == "running"]
@@ -0,0 +1,151 @@
+import logging
+import re
+import time
+
+import async_storage
+
+logger = logging.getLogger(__name__)
+
+# --- Constants ---
+_BOUNDARY = re.compile(r"\b")
+_END = ""  # trie key marking the end of a keyword; never a real character
+
+
+def _locale_matches(rule_locale, language_code) -> bool:
+    if not rule_locale:
+        return True
+    if not language_code:
+        return False
+    language_code = language_code.lower()
+    return language_code == rule_locale or language_code.startswith(rule_locale + "-")
+
+
+class KeywordTrie:
+    """All keywords compiled into character tries.
+
+    A keyword only matches between word boundaries, so the trie is walked only
+    from the positions where `\\b` matches instead of from every character.
+    Case-insensitive keywords are matched against the lowercased text and
+    case-sensitive ones against the original text. Among all keywords found,
+    the highest priority wins, then the one stored first.
+
+    Keywords can be added and removed one at a time without rebuilding.
+    """
+
+    def __init__(self, rules=()):
+        self._roots = {False: {}, True: {}}  # case_sensitive -> trie
+        self._rules = {}  # keyword -> rule dict
+        for rule in rules:
+            self.add(rule)
+
+    def __len__(self) -> int:
+        return len(self._rules)
+
+    @staticmethod
+    def _key(rule) -> str:
+        return rule["keyword"] if rule["case_sensitive"] else rule["keyword"].lower()
+
+    def add(self, rule) -> None:
+        """Insert or replace a keyword rule."""
+        if rule["keyword"] in self._rules:
+            self.remove(rule["keyword"])
+        key = self._key(rule)
+        if not key:
+            return
+        rule = dict(rule, rank=(-rule["priority"], rule["seq"]))
+        self._rules[rule["keyword"]] = rule
+        node = self._roots[rule["case_sensitive"]]
+        for ch in key:
+            node = node.setdefault(ch, {})
+        node.setdefault(_END, set()).add(rule["keyword"])
+
+    def remove(self, keyword) -> bool:
+        """Remove a keyword and prune the trie branch it leaves empty."""
+        rule = self._rules.pop(keyword, None)
+        if rule is None:
+            return False
+        key = self._key(rule)
+        path = [self._roots[rule["case_sensitive"]]]
+        for ch in key:
+            path.append(path[-1][ch])
+        ends = path[-1][_END]
+        ends.discard(keyword)
+        if not ends:
+            del path[-1][_END]
+        for depth in range(len(key), 0, -1):
+            if path[depth]:
+                break
+            del path[depth - 1][key[depth - 1]]
+        return True
+
+    def _search(self, root, text, language_code, best):
+        boundaries = {m.start() for m in _BOUNDARY.finditer(text)}
+        length = len(text)
+        for start in boundaries:
+            if start >= length or text[start] not in root:
+                continue
+            node = root
+            for end in range(start, length):
+                node = node.get(text[end])
+                if node is None:
+                    break
+                ends = node.get(_END)
+                if ends and end + 1 in boundaries:
+                    for keyword in ends:
+                        rule = self._rules[keyword]
+                        if (best is None or rule["rank"] < best["rank"]) and _locale_matches(
+                            rule["locale"], language_code
+                        ):
+                            best = rule
+        return best
+
+    def match(self, text: str, language_code: str = None):
+        """Return the response for the best keyword in text, or None."""
+        best = None
+        if self._roots[False]:
+            best = self._search(self._roots[False], text.lower(), language_code, best)
+        if self._roots[True]:
+            best = self._search(self._roots[True], text, language_code, best)
+        return best["response"] if best else None
+
+
+class KeywordMatcher:
+    """Keeps a compiled KeywordTrie in sync with the stored keywords.
+
+    `load` returns the keyword rules and `version` returns a counter that the
+    store bumps once per changed row. The version is checked at most once per
+    RELOAD_CHECK_INTERVAL and, when it changed in a way `apply()` didn't
+    account for, the trie is rebuilt in the storage thread pool and swapped
+    in; messages are matched against the previous trie meanwhile.
+    """
+
+    def __init__(self, load, version):
+        self._version = version
+        self._snapshot = async_storage.BackgroundSnapshot(lambda: self._compile(load), version)
+
+    @staticmethod
+    def _compile(load) -> KeywordTrie:
+        started = time.perf_counter()
+        trie = KeywordTrie(load())
+        logger.info(f"Compiled {len(trie)} keywords in {(time.perf_counter() - started) * 1000:.1f}ms")
+        return trie
+
+    async def refresh(self) -> None:
+        """Check the version now, rebuilding the trie if another writer changed keywords."""
+        await self._snapshot.refresh()
+
+    async def apply(self, upserted=(), removed=()) -> None:
+        """Update the compiled trie in place after rules were written to the store."""
+        trie = self._snapshot.peek()
+        if trie is None:
+            return
+        for rule in upserted:
+            trie.add(rule)
+        for keyword in removed:
+            trie.remove(keyword)
+        version = await async_storage.read(self._version)
+        self._snapshot.advance(trie, len(upserted) + len(removed), version)
+
+    def match(self, text: str, language_code: str = None):
+        """Return the auto-reply for text, or None if no keyword matches."""
+        return self._snapshot.current().match(text, language_code)
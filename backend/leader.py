@@ -0,0 +1,251 @@
+import asyncio
+import json
+import logging
+import os
+import socket
+import struct
+import uuid
+
+from dotenv import load_dotenv
+from fastapi import HTTPException
+
+import async_storage
+import storage
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+LEASE_NAME = "bot"
+LEASE_TTL = float(os.getenv("LEADER_LEASE_TTL", 15))
+RENEW_INTERVAL = LEASE_TTL / 3
+OUTBOX_POLL_INTERVAL = 0.2
+FORWARD_TIMEOUT = float(os.getenv("FORWARD_TIMEOUT", 30))
+# Unix socket the leader accepts forwarded tasks on; every worker must see the same path.
+LEADER_SOCKET = os.getenv("LEADER_SOCKET") or f"{storage.DB_FILE}.leader.sock"
+_FRAME = struct.Struct(">I")  # length prefix of each JSON message on the socket
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+class LeaderElection:
+    """Elects one uvicorn worker to own the Telegram bot.
+
+    Workers compete for a lease row in the shared database. The holder
+    renews it every RENEW_INTERVAL; if it stops renewing, another worker
+    takes over once LEASE_TTL has passed.
+
+    Other workers forward tasks that need the running bot. Those waiting for
+    a result are sent to the leader's Unix socket (LEADER_SOCKET), one
+    connection each, so a long bulk send doesn't hold up webhook updates.
+    Fire-and-forget notifications go through the outbox table, which the
+    leader drains with one runner per task kind.
+    """
+
+    def __init__(self):
+        self.is_leader = False
+        self._tasks = {}  # kind -> coroutine function(payload) -> JSON-serializable result
+        self._loop_task = None
+        self._outbox_task = None
+        self._server = None
+        self._on_elected = None
+        self._on_demoted = None
+
+    def register(self, kind, handler) -> None:
+        """Register the coroutine function that runs forwarded tasks of this kind on the leader."""
+        self._tasks[kind] = handler
+
+    async def start(self, on_elected, on_demoted) -> None:
+        """Try to become leader right away, then keep competing in the background."""
+        self._on_elected = on_elected
+        self._on_demoted = on_demoted
+        await self._check()
+        self._loop_task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        for task in (self._loop_task, self._outbox_task):
+            if task:
+                task.cancel()
+        if self.is_leader:
+            await self._demote()
+            await self._release()
+
+    async def _check(self) -> None:
+        try:
+            holds_lease = await async_storage.write(storage.acquire_lease, LEASE_NAME, WORKER_ID, LEASE_TTL)
+        except Exception as e:
+            logger.error(f"Failed to renew leader lease: {e}")
+            holds_lease = False
+        if holds_lease and not self.is_leader:
+            logger.info(f"Worker {WORKER_ID} elected leader, starting the bot")
+            self.is_leader = True
+            try:
+                await self._on_elected()
+            except Exception as e:
+                # Don't hold the lease without a running bot; another worker (or this one) tries next.
+                logger.error(f"Worker {WORKER_ID} failed to start the bot, giving up the lease: {e}")
+                await self._demote()
+                await self._release()
+                return
+            await self._listen()
+            self._outbox_task = asyncio.create_task(self._drain_outbox())
+        elif not holds_lease and self.is_leader:
+            logger.error(f"Worker {WORKER_ID} lost the leader lease, stopping the bot")
+            await self._demote()
+
+    async def _demote(self) -> None:
+        self.is_leader = False
+        if self._server:
+            self._server.close()
+            self._server = None
+        if self._outbox_task:
+            self._outbox_task.cancel()
+            self._outbox_task = None
+        try:
+            await self._on_demoted()
+        except Exception as e:
+            logger.error(f"Failed to stop the bot cleanly: {e}")
+
+    async def _release(self) -> None:
+        try:
+            await async_storage.write(storage.release_lease, LEASE_NAME, WORKER_ID)
+        except Exception as e:
+            logger.error(f"Failed to release leader lease: {e}")
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(RENEW_INTERVAL)
+            await self._check()
+
+    async def _run_task(self, kind, payload):
+        handler = self._tasks.get(kind)
+        if handler is None:
+            raise HTTPException(status_code=500, detail=f"Unknown task '{kind}'")
+        return await handler(payload)
+
+    async def _outcome(self, kind, payload) -> dict:
+        """Run a forwarded task, returning its result or error as a JSON-serializable dict."""
+        try:
+            return {"ok": True, "result": await self._run_task(kind, payload)}
+        except HTTPException as e:
+            return {"ok": False, "status_code": e.status_code, "detail": e.detail}
+        except Exception as e:
+            logger.error(f"Forwarded task {kind} failed: {e}")
+            return {"ok": False, "status_code": 500, "detail": str(e)}
+
+    # --- Direct Channel ---
+    async def _listen(self) -> None:
+        try:
+            os.unlink(LEADER_SOCKET)  # left behind by a previous leader
+        except FileNotFoundError:
+            pass
+        try:
+            self._server = await asyncio.start_unix_server(self._serve, LEADER_SOCKET)
+        except OSError as e:
+            logger.error(f"Failed to listen on {LEADER_SOCKET}; other workers can't forward tasks: {e}")
+
+    async def _serve(self, reader, writer) -> None:
+        try:
+            request = await _read_frame(reader)
+            if self.is_leader:
+                outcome = await self._outcome(request["kind"], request["payload"])
+            else:  # demoted while the connection was open
+                outcome = {"ok": False, "status_code": 503, "detail": "This worker no longer runs the bot"}
+            _write_frame(writer, outcome)
+            await writer.drain()
+        except (OSError, asyncio.IncompleteReadError) as e:
+            logger.warning(f"Forwarding connection closed early: {e}")
+        finally:
+            writer.close()
+
+    async def _forward(self, kind, payload):
+        try:
+            reader, writer = await asyncio.open_unix_connection(LEADER_SOCKET)
+        except OSError as e:
+            raise HTTPException(status_code=503, detail=f"The bot worker can't be reached: {e}")
+        try:
+            _write_frame(writer, {"kind": kind, "payload": payload})
+            await writer.drain()
+            outcome = await asyncio.wait_for(_read_frame(reader), FORWARD_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code=504, detail=f"The bot worker didn't finish the {kind} task in time")
+        except (OSError, asyncio.IncompleteReadError) as e:
+            raise HTTPException(status_code=503, detail=f"The bot worker stopped answering: {e}")
+        finally:
+            writer.close()
+        if not outcome["ok"]:
+            raise HTTPException(status_code=outcome["status_code"], detail=outcome["detail"])
+        return outcome["result"]
+
+    # --- Outbox ---
+    async def _drain_outbox(self) -> None:
+        try:
+            interrupted = await async_storage.write(storage.drop_claimed_outbox)
+        except Exception as e:
+            logger.error(f"Failed to clear interrupted forwarded tasks: {e}")
+            interrupted = []
+        for task_id, kind, claimed_by in interrupted:
+            logger.warning(f"Dropped forwarded task {task_id} ({kind}) interrupted on worker {claimed_by}")
+        queues = {}  # kind -> tasks waiting for that kind's runner
+        runners = []
+        try:
+            while True:
+                # A storage error (e.g. "database is locked") must not end the loop
+                # while this worker still leads, or forwarded tasks are never run.
+                try:
+                    tasks = await async_storage.write(storage.claim_outbox, WORKER_ID)
+                except Exception as e:
+                    logger.error(f"Failed to claim forwarded tasks: {e}")
+                    tasks = []
+                for task_id, kind, payload in tasks:
+                    if kind not in queues:
+                        queues[kind] = asyncio.Queue()
+                        runners.append(asyncio.create_task(self._run_outbox(queues[kind])))
+                    queues[kind].put_nowait((task_id, kind, payload))
+                if not tasks:
+                    await asyncio.sleep(OUTBOX_POLL_INTERVAL)
+        finally:
+            for runner in runners:
+                runner.cancel()
+
+    async def _run_outbox(self, queue: asyncio.Queue) -> None:
+        """Run one kind's tasks in the order they were queued."""
+        while True:
+            task_id, kind, payload = await queue.get()
+            outcome = await self._outcome(kind, payload)
+            if not outcome["ok"]:
+                logger.error(f"Forwarded task {task_id} ({kind}) failed: {outcome['detail']}")
+            try:
+                await async_storage.write(storage.complete_outbox, task_id)
+            except Exception as e:
+                # Still claimed, so it isn't run again; the next leader drops it.
+                logger.error(f"Failed to delete finished forwarded task {task_id} ({kind}): {e}")
+
+    async def run_on_leader(self, kind, payload, wait=True):
+        """Run a task on the leader: directly if this worker leads, else forwarded to it.
+
+        With wait=True the task is sent over the leader's socket and its result
+        returned (or its error re-raised as an HTTPException; 503 if no leader
+        can be reached). Otherwise it is queued in the outbox, where the next
+        leader finds it even if none is running, and None is returned.
+        """
+        if self.is_leader:
+            result = await self._run_task(kind, payload)
+            return result if wait else None
+        if not wait:
+            await async_storage.write(storage.enqueue_outbox, kind, payload)
+            return None
+        return await self._forward(kind, payload)
+
+
+def _write_frame(writer, message) -> None:
+    data = json.dumps(message).encode()
+    writer.write(_FRAME.pack(len(data)) + data)
+
+
+async def _read_frame(reader):
+    (length,) = _FRAME.unpack(await reader.readexactly(_FRAME.size))
+    return json.loads(await reader.readexactly(length))
+
+
+election = LeaderElection()
@@ -0,0 +1,84 @@
+import os
+import struct
+
+# --- Constants ---
+RECORD = struct.Struct("<qiB")  # chat ID, message ID (0 if not delivered), status
+READ_CHUNK = 4096  # records per read
+
+DELIVERED, FAILED, EDITED, DELETED, EDIT_FAILED, DELETE_FAILED = range(1, 7)
+STATUS_NAMES = {
+    DELIVERED: "delivered",
+    FAILED: "failed",
+    EDITED: "edited",
+    DELETED: "deleted",
+    EDIT_FAILED: "edit_failed",
+    DELETE_FAILED: "delete_failed",
+}
+
+
+class DeliveryLedger:
+    """Append-only record of what a broadcast job delivered.
+
+    Each record is (chat ID, message ID, status) in 13 bytes, in one file
+    per job. Edits and deletions append a new record for the same message
+    rather than rewriting the old one; the last record for a message is its
+    state. Records are buffered in memory until the owning job checkpoints,
+    which takes them with take() and appends them with write() off the
+    event loop, always before it saves the cursor they cover.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._buffer = bytearray()
+
+    def append(self, chat_id, message_id, status) -> None:
+        self._buffer += RECORD.pack(int(chat_id), message_id or 0, status)
+
+    def take(self) -> bytes:
+        """Return the buffered records and empty the buffer."""
+        data, self._buffer = bytes(self._buffer), bytearray()
+        return data
+
+    def write(self, data: bytes) -> None:
+        """Append records returned by take()."""
+        if data:
+            with open(self.path, "ab") as f:
+                f.write(data)
+
+    def flush(self) -> None:
+        self.write(self.take())
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    def records(self):
+        """Yield every (chat_id, message_id, status) record in append order."""
+        self.flush()
+        try:
+            f = open(self.path, "rb")
+        except FileNotFoundError:
+            return
+        with f:
+            while True:
+                chunk = f.read(READ_CHUNK * RECORD.size)
+                if not chunk:
+                    return
+                usable = len(chunk) - len(chunk) % RECORD.size
+                yield from RECORD.iter_unpack(chunk[:usable])
+
+    def states(self) -> dict:
+        """The latest status of every message, keyed by (chat_id, message_id)."""
+        return {(chat_id, message_id): status for chat_id, message_id, status in self.records()}
+
+    def summary(self) -> dict:
+        counts = {name: 0 for name in STATUS_NAMES.values()}
+        for status in self.states().values():
+            counts[STATUS_NAMES[status]] += 1
+        return counts
+
+    def live_messages(self):
+        """(chat_id, message_id) of delivered messages that weren't deleted, in send order."""
+        return [
+            key for key, status in self.states().items()
+            if status in (DELIVERED, EDITED, EDIT_FAILED, DELETE_FAILED)
+        ]
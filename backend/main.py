@@ -1,37 +1,213 @@
 import asyncio
-import os
+import functools
+import hmac
+import json
+import time
 from datetime import timedelta
-from fastapi import FastAPI, Depends, HTTPException, status
+from typing import Optional
+from fastapi import FastAPI, Depends, HTTPException, Request, Response, UploadFile, status
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.security import OAuth2PasswordRequestForm
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 
+import async_storage
 import auth
 import bot
-from models import TemplateCreate, SendMessageRequest
+import conditional
+import jobs
+import media
+import metrics
+import scheduler
+import segments
+import templates
+import transfer
+import webhook
+from leader import election
+from models import TemplateCreate, SendMessageRequest, BulkSendRequest, LedgerEditRequest, ApiKeyCreate, SegmentTagRequest, KeywordCreate, KeywordBulkUpsert, ScheduleCreate
 
 # --- App Initialization ---
 app = FastAPI(title="Telegram Marketing Bot API")
+app.add_middleware(GZipMiddleware, minimum_size=1000, compresslevel=6)
+app.add_middleware(metrics.MetricsMiddleware)  # added last, so it also times compression
 ptb_app = bot.create_application()
 
+# --- Metrics ---
+metrics.Gauge("telegram_update_queue_depth", "Updates waiting in the update queue.", lambda: ptb_app.update_queue.qsize())
+metrics.Gauge("bot_updates_running", "Updates being handled right now.", lambda: bot.update_processor.running)
+metrics.Gauge("bot_updates_queued", "Updates waiting for their chat's lane.", lambda: bot.update_processor.queued)
+metrics.Gauge("telegram_send_rate", "Messages per second sent over the last few seconds.", bot.broadcaster.current_rate)
+metrics.Gauge("broadcast_jobs_active", "Broadcast jobs being sent by this worker.", lambda: len(jobs.active_jobs))
+metrics.Gauge("storage_writes_pending", "Storage writes waiting for the next group commit.", lambda: async_storage.committer.stats()["pending"])
+metrics.Gauge("leader", "1 if this worker runs the bot.", lambda: int(election.is_leader))
+
 # --- Bot Lifecycle ---
-@app.on_event("startup")
-async def startup_event():
+# With several uvicorn workers, only the elected leader runs the bot. Every
+# worker serves the API from shared storage and forwards work that needs the
+# running bot to the leader (see leader.py).
+async def start_bot():
     await ptb_app.initialize()
+    # Only the worker running the bot appends subscribers; catch up on the previous one's first.
+    await asyncio.to_thread(bot.claim_subscribers)
+    await asyncio.to_thread(bot.segment_index.load)
+    # Load what every update reads before the first one arrives.
+    await bot.keyword_matcher.refresh()
+    await bot.inactive.refresh()
     await ptb_app.start()
+    await webhook.start(ptb_app)
+    bot.resume_broadcast_jobs(ptb_app)
+    await bot.start_scheduler(ptb_app)
+
+async def stop_bot():
+    await bot.scheduler.stop()
+    await bot.stop_broadcast_jobs()
+    await webhook.stop(ptb_app)
+    await ptb_app.stop()
+    await ptb_app.shutdown()
+    await asyncio.to_thread(bot.release_subscribers)
+
+@app.on_event("startup")
+async def startup_event():
+    await bot.template_cache.refresh()
+    await election.start(on_elected=start_bot, on_demoted=stop_bot)
 
 @app.on_event("shutdown")
 async def shutdown_event():
-    await ptb_app.stop()
+    await election.stop()
+
+def usable_template(name: str):
+    """The compiled template, or an HTTPException saying why it can't be sent."""
+    template = bot.template_cache.get(name)
+    if template is None:
+        problem = bot.template_cache.problem(name)
+        if problem:
+            raise HTTPException(status_code=422, detail=f"Template '{name}' can't be sent: {problem}")
+        raise HTTPException(status_code=404, detail="Template not found")
+    return template
+
+# --- Leader Tasks ---
+async def process_update_task(payload):
+    if not webhook.enqueue_update(ptb_app, payload, bot.update_processor.pending):
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Update backlog is full")
+
+async def send_template_task(payload):
+    template = usable_template(payload["template_name"])
+
+    try:
+        await bot.broadcaster.send(payload["chat_id"], lambda cid: template.send(ptb_app.bot, cid))
+    except Exception as e:
+        bot.inactive.record_failure(payload["chat_id"], e)
+        raise HTTPException(status_code=500, detail=str(e))
+
+async def bulk_send_task(payload):
+    template = usable_template(payload["template_name"])
+
+    if payload["audience"] == "chats":
+        recipients = list(await bot.chat_cache.get())
+    elif payload["audience"] == "users":
+        recipients = await async_storage.read(bot.get_user_ids)
+    elif payload["segment"]:
+        try:
+            recipients = bot.segment_index.members(payload["segment"])
+        except ValueError as e:
+            raise HTTPException(status_code=422, detail=str(e))
+    else:
+        recipients = payload["chat_ids"]
+    skip = () if payload["include_inactive"] else bot.inactive
+    # The recipient snapshot can be megabytes; write it off the event loop.
+    job = await asyncio.to_thread(jobs.BroadcastJob.create, recipients, bot.template_payload(template), None, skip)
+    bot.start_broadcast_job(ptb_app.bot, job)
+    return {"job_id": job.id, "total": job.state["total"], "skipped": job.state["skipped"]}
+
+async def ledger_operation_task(payload):
+    job = await asyncio.to_thread(jobs.BroadcastJob.load, payload["job_id"])
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job.id in jobs.active_jobs or job.state["status"] == "running":
+        raise HTTPException(status_code=409, detail="Job is still sending; stop it or wait for it to finish")
+    if not job.ledger.exists():
+        raise HTTPException(status_code=404, detail="Job has no delivery ledger")
+    if payload["action"] == "edit":
+        try:
+            bot.ledger_editor(ptb_app.bot, job.state["payload"], payload["text"])
+        except ValueError as e:
+            raise HTTPException(status_code=422, detail=str(e))
+        operation = jobs.LedgerOperation.create(job.id, "edit", {"text": payload["text"]})
+    else:
+        operation = jobs.LedgerOperation.create(job.id, "delete", {})
+    bot.start_ledger_operation(ptb_app.bot, operation)
+    return {"operation_id": operation.id}
+
+async def segment_count_task(payload):
+    started = time.perf_counter()
+    try:
+        count = bot.segment_index.count(payload["query"])
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    return {"query": payload["query"], "count": count, "elapsed_ms": round((time.perf_counter() - started) * 1000, 2)}
+
+async def tag_users_task(payload):
+    return {"changed": await bot.segment_index.tag(payload["tag"], payload["user_ids"], payload["remove"])}
+
+async def import_users_task(payload):
+    return {"imported": await bot.import_users(payload["users"])}
+
+async def reload_scheduled_task(payload):
+    await bot.scheduler.reload_job(payload["id"])
+
+async def keywords_changed_task(payload):
+    # Patch the matcher that answers messages instead of letting it rebuild every keyword.
+    await bot.keyword_matcher.apply(upserted=payload["upserted"], removed=payload["removed"])
+
+async def templates_changed_task(payload):
+    await bot.template_cache.refresh()
+
+election.register("update", process_update_task)
+election.register("send", send_template_task)
+election.register("bulk_send", bulk_send_task)
+election.register("ledger_operation", ledger_operation_task)
+election.register("segment_count", segment_count_task)
+election.register("tag_users", tag_users_task)
+election.register("import_users", import_users_task)
+election.register("reload_scheduled", reload_scheduled_task)
+election.register("keywords_changed", keywords_changed_task)
+election.register("templates_changed", templates_changed_task)
+
+# --- Telegram Webhook ---
+@app.post(webhook.WEBHOOK_PATH, include_in_schema=False)
+async def telegram_webhook(request: Request):
+    if not webhook.check_secret(request.headers.get("X-Telegram-Bot-Api-Secret-Token")):
+        return Response(status_code=status.HTTP_403_FORBIDDEN)
+    try:
+        data = await request.json()
+    except ValueError:
+        webhook.stats.invalid += 1
+        return Response(status_code=status.HTTP_200_OK)
+    if election.is_leader:
+        accepted = webhook.enqueue_update(ptb_app, data, bot.update_processor.pending)
+    else:
+        # Wait for the leader to queue it, so a full backlog there still reaches Telegram as a 503.
+        try:
+            await election.run_on_leader("update", data)
+            accepted = True
+        except HTTPException as e:
+            if e.status_code != status.HTTP_503_SERVICE_UNAVAILABLE:
+                raise
+            accepted = False
+    if not accepted:
+        # Backlog is full: Telegram redelivers after a non-2xx response.
+        return Response(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            headers={"Retry-After": str(webhook.RETRY_AFTER_SECONDS)},
+        )
+    return Response(status_code=status.HTTP_200_OK)
 
 # --- API Endpoints ---
 
 # Authentication
 @app.post("/api/login", tags=["Authentication"])
 async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends()):
-    api_user = os.getenv("API_USER")
-    api_password = os.getenv("API_PASSWORD")
     # Simplified password check for this single-user admin panel
-    if not (form_data.username == api_user and form_data.password == api_password):
+    if not auth.authenticate_user(form_data.username, form_data.password):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
@@ -43,55 +219,334 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
     )
     return {"access_token": access_token, "token_type": "bearer"}
 
+@app.get("/api/keys", tags=["Authentication"])
+async def list_api_keys(current_user: dict = Depends(auth.get_current_user)):
+    return await auth.list_api_keys()
+
+@app.post("/api/keys", tags=["Authentication"])
+async def create_api_key(request: ApiKeyCreate, current_user: dict = Depends(auth.get_current_user)):
+    api_key = await auth.create_api_key(request.name)
+    return {"status": "success", **api_key}
+
+@app.delete("/api/keys/{key_id}", tags=["Authentication"])
+async def revoke_api_key(key_id: int, current_user: dict = Depends(auth.get_current_user)):
+    if await auth.revoke_api_key(key_id):
+        return {"status": "success", "message": f"API key {key_id} revoked."}
+    raise HTTPException(status_code=404, detail="API key not found")
+
+@app.get("/api/auth/stats", tags=["Statistics"])
+async def get_auth_stats(current_user: dict = Depends(auth.get_current_user)):
+    return auth.stats()
+
 # Statistics
 @app.get("/api/stats", tags=["Statistics"])
 async def get_stats(current_user: dict = Depends(auth.get_current_user)):
-    user_count = len(bot.get_user_ids())
-    chat_count = len(bot.load_chats())
-    return {"user_count": user_count, "chat_count": chat_count}
+    return {
+        **await bot.get_counts(),
+        "sending": bot.broadcaster.stats(),
+        "media": media.file_ids.stats(),
+    }
 
 # Chats
 @app.get("/api/chats", tags=["Chats"])
-async def get_chats(current_user: dict = Depends(auth.get_current_user)):
-    return bot.load_chats()
+async def get_chats(
+    request: Request, cursor: int = 0, limit: Optional[int] = None, current_user: dict = Depends(auth.get_current_user)
+):
+    return await conditional.listing(
+        request, "chats", bot.chats_version, bot.load_chats, bot.load_chats_page, cursor, limit
+    )
 
 # Templates
 @app.get("/api/templates", tags=["Templates"])
-async def get_templates(current_user: dict = Depends(auth.get_current_user)):
-    return bot.load_templates()
+async def get_templates(
+    request: Request, cursor: int = 0, limit: Optional[int] = None, current_user: dict = Depends(auth.get_current_user)
+):
+    return await conditional.listing(
+        request, "templates", bot.templates_version, bot.load_templates, bot.load_templates_page, cursor, limit
+    )
+
+@app.get("/api/templates/problems", tags=["Templates"])
+async def get_template_problems(current_user: dict = Depends(auth.get_current_user)):
+    """Stored templates that can't be sent, with the reason. They are still listed by /api/templates."""
+    return bot.template_cache.problems()
+
+async def templates_changed():
+    """Reload the templates here and, without waiting for its next check, on the worker running the bot."""
+    await bot.template_cache.refresh()
+    if not election.is_leader:
+        await election.run_on_leader("templates_changed", {}, wait=False)
 
 @app.post("/api/templates", tags=["Templates"])
 async def create_template(template: TemplateCreate, current_user: dict = Depends(auth.get_current_user)):
-    bot.save_template(template.name, template.content, template.button_text, str(template.button_url) if template.button_url else None)
+    try:
+        templates.CompiledTemplate(template.name, template.model_dump(mode="json"))
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    await async_storage.write(
+        bot.save_template,
+        template.name, template.content, template.button_text, str(template.button_url) if template.button_url else None,
+        template.media_type, template.media,
+    )
+    await templates_changed()
     return {"status": "success", "template_name": template.name}
 
 @app.delete("/api/templates/{template_name}", tags=["Templates"])
 async def delete_template_api(template_name: str, current_user: dict = Depends(auth.get_current_user)):
-    if bot.delete_template_from_file(template_name):
+    if await async_storage.write(bot.delete_template_from_file, template_name):
+        await templates_changed()
         return {"status": "success"}
     else:
         raise HTTPException(status_code=404, detail="Template not found")
 
+# Media
+@app.post("/api/media", tags=["Templates"])
+async def upload_media(file: UploadFile, current_user: dict = Depends(auth.get_current_user)):
+    """Store a file for use in template media. Returns the name to reference it by."""
+    name = await asyncio.to_thread(media.save_upload, file.filename, file.file)
+    return {"status": "success", "media": name}
+
+# Webhook
+@app.get("/api/webhook/stats", tags=["Statistics"])
+async def get_webhook_stats(current_user: dict = Depends(auth.get_current_user)):
+    return webhook.stats.snapshot(ptb_app.update_queue, bot.update_processor.pending)
+
+@app.get("/api/persistence/stats", tags=["Statistics"])
+async def get_persistence_stats(current_user: dict = Depends(auth.get_current_user)):
+    return await ptb_app.persistence.stats()
+
+@app.get("/api/updates/stats", tags=["Statistics"])
+async def get_update_stats(current_user: dict = Depends(auth.get_current_user)):
+    return bot.update_processor.stats()
+
+@app.get("/api/storage/stats", tags=["Statistics"])
+async def get_storage_stats(current_user: dict = Depends(auth.get_current_user)):
+    return async_storage.committer.stats()
+
+@app.get("/api/responses/stats", tags=["Statistics"])
+async def get_response_stats(current_user: dict = Depends(auth.get_current_user)):
+    return conditional.responses.stats()
+
+@app.get("/api/inbound/stats", tags=["Statistics"])
+async def get_inbound_stats(current_user: dict = Depends(auth.get_current_user)):
+    # Counts for this worker; only the leader receives updates.
+    return {**bot.inbound.stats(), "keyword_cache_hits": bot.reply_cache.hits}
+
+# Keywords
+async def keywords_changed(upserted=(), removed=()):
+    """Hand saved keyword changes to the worker running the bot, which patches its matcher in place."""
+    await election.run_on_leader("keywords_changed", {"upserted": list(upserted), "removed": list(removed)}, wait=False)
+
+@app.get("/api/keywords", tags=["Keywords"])
+async def get_keywords(current_user: dict = Depends(auth.get_current_user)):
+    return await async_storage.read(bot.load_keyword_rules)
+
+@app.get("/api/keywords/{keyword}", tags=["Keywords"])
+async def get_keyword_api(keyword: str, current_user: dict = Depends(auth.get_current_user)):
+    rule = await async_storage.read(bot.get_keyword, keyword)
+    if not rule:
+        raise HTTPException(status_code=404, detail="Keyword not found")
+    return rule
+
+@app.post("/api/keywords", tags=["Keywords"])
+async def create_keyword(keyword: KeywordCreate, current_user: dict = Depends(auth.get_current_user)):
+    rule = await async_storage.write(functools.partial(bot.save_keyword, **keyword.model_dump()))
+    await keywords_changed(upserted=[rule])
+    return {"status": "success", "keyword": rule["keyword"]}
+
+@app.post("/api/keywords/bulk", tags=["Keywords"])
+async def bulk_upsert_keywords(request: KeywordBulkUpsert, current_user: dict = Depends(auth.get_current_user)):
+    rules = await async_storage.write(bot.save_keywords, [keyword.model_dump() for keyword in request.keywords])
+    await keywords_changed(upserted=rules)
+    return {"status": "success", "count": len(rules)}
+
+@app.delete("/api/keywords/{keyword}", tags=["Keywords"])
+async def delete_keyword_api(keyword: str, current_user: dict = Depends(auth.get_current_user)):
+    if await async_storage.write(bot.delete_keyword, keyword):
+        await keywords_changed(removed=[keyword])
+        return {"status": "success"}
+    else:
+        raise HTTPException(status_code=404, detail="Keyword not found")
+
+# Segments
+@app.get("/api/segments/count", tags=["Segments"])
+async def count_segment_api(query: str, current_user: dict = Depends(auth.get_current_user)):
+    """Number of subscribers matching a segment query like "lang=es AND active<30d"."""
+    try:
+        segments.parse_segment(query)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    return await election.run_on_leader("segment_count", {"query": query})
+
+@app.post("/api/segments/tags", tags=["Segments"])
+async def tag_users_api(request: SegmentTagRequest, current_user: dict = Depends(auth.get_current_user)):
+    result = await election.run_on_leader("tag_users", request.model_dump())
+    return {"status": "success", **result}
+
+# Import and Export
+def _transfer_format(kind: str, format: Optional[str], content_type: str = "") -> str:
+    if kind not in transfer.IMPORTERS:
+        raise HTTPException(status_code=404, detail="Unknown data kind; use users, chats or templates")
+    format = format or ("csv" if "csv" in content_type else "ndjson")
+    if format not in transfer.FORMATS:
+        raise HTTPException(status_code=422, detail="format must be ndjson or csv")
+    return format
+
+@app.post("/api/import/{kind}", tags=["Import and Export"])
+async def import_api(kind: str, request: Request, format: Optional[str] = None, current_user: dict = Depends(auth.get_current_user)):
+    format = _transfer_format(kind, format, request.headers.get("content-type", ""))
+    report = await transfer.import_stream(kind, request.stream(), format)
+    if "stopped" in report:
+        # The rows before the unreadable part are stored; say how far the import got.
+        return JSONResponse(status_code=422, content={"detail": f"Import stopped: {report['stopped']}", **report})
+    return {"status": "success", **report}
+
+@app.get("/api/export/{kind}", tags=["Import and Export"])
+async def export_api(kind: str, format: str = "ndjson", current_user: dict = Depends(auth.get_current_user)):
+    format = _transfer_format(kind, format)
+    return StreamingResponse(
+        transfer.export_stream(kind, format),
+        media_type=transfer.FORMATS[format],
+        headers={"Content-Disposition": f'attachment; filename="{kind}.{format}"'},
+    )
+
+# Broadcast Jobs
+@app.get("/api/jobs", tags=["Jobs"])
+async def list_jobs_api(current_user: dict = Depends(auth.get_current_user)):
+    return await jobs.list_progress()
+
+@app.get("/api/jobs/{job_id}", tags=["Jobs"])
+async def get_job_api(job_id: str, current_user: dict = Depends(auth.get_current_user)):
+    progress = await jobs.get_progress(job_id)
+    if not progress:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return progress
+
+@app.get("/api/jobs/{job_id}/events", tags=["Jobs"])
+async def job_events_api(job_id: str, request: Request, current_user: dict = Depends(auth.get_current_user)):
+    """Stream a job's per-recipient results and throughput as Server-Sent Events."""
+    if not await jobs.get_progress(job_id):
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    async def stream():
+        async for event, data in jobs.events(job_id):
+            if event == "progress" and await request.is_disconnected():
+                return
+            yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+@app.get("/api/jobs/{job_id}/ledger", tags=["Jobs"])
+async def get_job_ledger_api(job_id: str, current_user: dict = Depends(auth.get_current_user)):
+    """Count a job's messages by their latest state: delivered, edited, deleted or failed."""
+    summary = await jobs.get_ledger_summary(job_id)
+    if summary is None:
+        raise HTTPException(status_code=404, detail="Job has no delivery ledger")
+    return summary
+
+@app.post("/api/jobs/{job_id}/edit", tags=["Jobs"])
+async def edit_job_messages_api(job_id: str, request: LedgerEditRequest, current_user: dict = Depends(auth.get_current_user)):
+    """Edit the text of every message a finished job delivered."""
+    result = await election.run_on_leader("ledger_operation", {"job_id": job_id, "action": "edit", "text": request.text})
+    return {"status": "success", **result, "progress": f"/api/operations/{result['operation_id']}"}
+
+@app.post("/api/jobs/{job_id}/retract", tags=["Jobs"])
+async def retract_job_messages_api(job_id: str, current_user: dict = Depends(auth.get_current_user)):
+    """Delete every message a finished job delivered."""
+    result = await election.run_on_leader("ledger_operation", {"job_id": job_id, "action": "delete"})
+    return {"status": "success", **result, "progress": f"/api/operations/{result['operation_id']}"}
+
+@app.get("/api/operations/{operation_id}", tags=["Jobs"])
+async def get_operation_api(operation_id: str, current_user: dict = Depends(auth.get_current_user)):
+    progress = await jobs.get_operation_progress(operation_id)
+    if not progress:
+        raise HTTPException(status_code=404, detail="Operation not found")
+    return progress
+
+# Metrics and Profiling
+@app.get("/metrics", include_in_schema=False)
+async def metrics_endpoint(request: Request):
+    """Metrics of this worker in the Prometheus text format."""
+    if metrics.METRICS_TOKEN and not hmac.compare_digest(
+        request.headers.get("authorization", ""), f"Bearer {metrics.METRICS_TOKEN}"
+    ):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid metrics token")
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.post("/api/profiler/start", tags=["Statistics"])
+async def start_profiler_api(interval: float = metrics.PROFILER_INTERVAL, current_user: dict = Depends(auth.get_current_user)):
+    """Start sampling this worker's event loop every `interval` seconds."""
+    if not metrics.PROFILER_MIN_INTERVAL <= interval <= 1:
+        raise HTTPException(status_code=422, detail=f"Interval must be between {metrics.PROFILER_MIN_INTERVAL} and 1 seconds")
+    metrics.profiler.start(interval)
+    return {"status": "success", **metrics.profiler.report(top=0)}
+
+@app.post("/api/profiler/stop", tags=["Statistics"])
+async def stop_profiler_api(current_user: dict = Depends(auth.get_current_user)):
+    await asyncio.to_thread(metrics.profiler.stop)
+    return {"status": "success", **metrics.profiler.report(top=0)}
+
+@app.get("/api/profiler", tags=["Statistics"])
+async def get_profile_api(top: int = 50, collapsed: bool = False, current_user: dict = Depends(auth.get_current_user)):
+    """The most sampled stacks, or every stack in collapsed format for flame graph tools."""
+    if collapsed:
+        return PlainTextResponse(metrics.profiler.collapsed())
+    return metrics.profiler.report(top)
+
+# Scheduled Messages
+@app.get("/api/schedule", tags=["Scheduling"])
+async def list_scheduled_api(limit: int = 100, current_user: dict = Depends(auth.get_current_user)):
+    return {
+        "pending": await async_storage.read(bot.count_scheduled_jobs),
+        "jobs": [scheduler.describe(job) for job in await async_storage.read(bot.load_scheduled_jobs, "pending", limit)],
+    }
+
+@app.post("/api/schedule", tags=["Scheduling"])
+async def create_scheduled_api(request: ScheduleCreate, current_user: dict = Depends(auth.get_current_user)):
+    if request.target.startswith("segment:"):
+        try:
+            segments.parse_segment(request.target[len("segment:"):])
+        except ValueError as e:
+            raise HTTPException(status_code=422, detail=str(e))
+    recurrence = None
+    if request.recurrence:
+        try:
+            recurrence = scheduler.parse_recurrence(request.recurrence)
+        except ValueError as e:
+            raise HTTPException(status_code=422, detail=str(e))
+    if request.run_at:
+        run_at = request.run_at.timestamp()
+    elif recurrence:
+        run_at = scheduler.next_run_after(recurrence, time.time(), time.time())
+    else:
+        raise HTTPException(status_code=422, detail="Either run_at or recurrence is required")
+    job = await async_storage.write(bot.add_scheduled_job, request.target, request.message, run_at, recurrence)
+    await election.run_on_leader("reload_scheduled", {"id": job["id"]}, wait=False)
+    return {"status": "success", "job": scheduler.describe(job)}
+
+@app.delete("/api/schedule/{job_id}", tags=["Scheduling"])
+async def cancel_scheduled_api(job_id: int, current_user: dict = Depends(auth.get_current_user)):
+    if await async_storage.write(bot.cancel_scheduled_job, job_id):
+        await election.run_on_leader("reload_scheduled", {"id": job_id}, wait=False)
+        return {"status": "success"}
+    else:
+        raise HTTPException(status_code=404, detail="Scheduled message not found")
+
 # Messaging
 @app.post("/api/send", tags=["Messaging"])
 async def send_message_api(request: SendMessageRequest, current_user: dict = Depends(auth.get_current_user)):
-    templates = bot.load_templates()
-    template = templates.get(request.template_name)
-    if not template:
-        raise HTTPException(status_code=404, detail="Template not found")
+    usable_template(request.template_name)
+    await election.run_on_leader("send", {"chat_id": request.chat_id, "template_name": request.template_name})
+    return {"status": "success", "detail": f"Message sent to {request.chat_id}"}
 
-    reply_markup = None
-    if "button_text" in template and "button_url" in template:
-        button = InlineKeyboardButton(template["button_text"], url=template["button_url"])
-        reply_markup = InlineKeyboardMarkup([[button]])
-
-    try:
-        await ptb_app.bot.send_message(
-            chat_id=request.chat_id,
-            text=template['content'],
-            reply_markup=reply_markup,
-            parse_mode='HTML'
-        )
-        return {"status": "success", "detail": f"Message sent to {request.chat_id}"}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+@app.post("/api/send/bulk", tags=["Messaging"])
+async def bulk_send_api(request: BulkSendRequest, current_user: dict = Depends(auth.get_current_user)):
+    if [request.chat_ids, request.audience, request.segment].count(None) != 2:
+        raise HTTPException(status_code=422, detail="Provide exactly one of chat_ids, audience or segment")
+    if request.segment:
+        try:
+            segments.parse_segment(request.segment)
+        except ValueError as e:
+            raise HTTPException(status_code=422, detail=str(e))
+    usable_template(request.template_name)
+    result = await election.run_on_leader("bulk_send", request.model_dump())
+    return {"status": "success", **result, "events": f"/api/jobs/{result['job_id']}/events"}
@@ -0,0 +1,211 @@
+import asyncio
+import contextlib
+import logging
+import os
+import time
+import uuid
+
+from dotenv import load_dotenv
+from telegram import InputMediaPhoto, InputMediaVideo
+from telegram.error import BadRequest
+
+import async_storage
+import storage
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+# Uploaded media files, referenced from templates by name.
+MEDIA_DIR = os.getenv("MEDIA_DIR", "media")
+# Seconds a cached file_id is trusted before the file is uploaded again.
+FILE_ID_TTL = float(os.getenv("MEDIA_FILE_ID_TTL", 30 * 86400))
+
+MEDIA_TYPES = ("photo", "video", "document", "album")
+ALBUM_SIZE = (2, 10)  # Telegram's limits for a media group
+VIDEO_EXTENSIONS = (".mp4", ".mov", ".webm", ".mkv")
+
+
+def is_url(source: str) -> bool:
+    return source.startswith(("http://", "https://"))
+
+
+def media_path(source: str) -> str:
+    """Path of an uploaded media file. Only the base name is used."""
+    return os.path.join(MEDIA_DIR, os.path.basename(source))
+
+
+def save_upload(filename: str, data) -> str:
+    """Store an uploaded file under a unique name and return that name."""
+    os.makedirs(MEDIA_DIR, exist_ok=True)
+    name = f"{uuid.uuid4().hex[:12]}-{os.path.basename(filename or 'file')}"
+    with open(media_path(name), "wb") as f:
+        while True:
+            chunk = data.read(1 << 20)
+            if not chunk:
+                break
+            f.write(chunk)
+    return name
+
+
+def check_media(media_type: str, sources) -> None:
+    """Raise ValueError if a template's media can't be sent."""
+    if media_type not in MEDIA_TYPES:
+        raise ValueError(f"Media type must be one of: {', '.join(MEDIA_TYPES)}")
+    if media_type == "album":
+        if not ALBUM_SIZE[0] <= len(sources) <= ALBUM_SIZE[1]:
+            raise ValueError(f"An album needs {ALBUM_SIZE[0]} to {ALBUM_SIZE[1]} files")
+    elif len(sources) != 1:
+        raise ValueError(f"A {media_type} template needs exactly one file")
+    for source in sources:
+        if not is_url(source) and not os.path.isfile(media_path(source)):
+            raise ValueError(f"Media file '{source}' not found; upload it first")
+
+
+def is_file_id_error(error: BadRequest) -> bool:
+    """True if Telegram rejected a file_id (expired, or from another bot)."""
+    message = error.message.lower()
+    return "file identifier" in message or "file_id" in message or "wrong remote file" in message
+
+
+def _attachment_file_id(message) -> str:
+    attachment = message.effective_attachment
+    if isinstance(attachment, (list, tuple)):  # photo sizes, largest last
+        attachment = attachment[-1]
+    return attachment.file_id
+
+
+class FileIdCache:
+    """Telegram file_ids of media already uploaded, stored in the database.
+
+    The first send of a file uploads its bytes (or lets Telegram fetch its
+    URL) and caches the returned file_id; later sends reference it. Sends
+    that start while the first upload is running wait for it instead of
+    uploading the same file again.
+    """
+
+    def __init__(self):
+        self._file_ids = {}  # source -> (file_id, uploaded_at)
+        self._locks = {}
+        self.hits = 0
+        self.uploads = 0
+        self.reuploads = 0
+
+    async def get(self, source: str):
+        """Return the cached file_id for source, or None if missing or expired."""
+        entry = self._file_ids.get(source)
+        if entry is None:
+            entry = await async_storage.read(storage.get_media_file, source)
+            if entry is None:
+                return None
+            self._file_ids[source] = entry
+        file_id, uploaded_at = entry
+        if time.time() - uploaded_at > FILE_ID_TTL:
+            return None
+        return file_id
+
+    def put(self, source: str, file_id: str) -> None:
+        uploaded_at = time.time()
+        self._file_ids[source] = (file_id, uploaded_at)
+        async_storage.write_later(storage.save_media_file, source, file_id, uploaded_at)
+
+    def forget(self, source: str) -> None:
+        self._file_ids.pop(source, None)
+        async_storage.write_later(storage.delete_media_file, source)
+
+    def lock(self, key) -> asyncio.Lock:
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+        return lock
+
+    def stats(self) -> dict:
+        return {
+            "cached": len(self._file_ids),
+            "hits": self.hits,
+            "uploads": self.uploads,
+            "reuploads": self.reuploads,
+        }
+
+
+file_ids = FileIdCache()
+
+
+def _open(source, stack: contextlib.ExitStack):
+    return source if is_url(source) else stack.enter_context(open(media_path(source), "rb"))
+
+
+async def _send_single(bot, chat_id, media_type, source, **kwargs):
+    send = getattr(bot, f"send_{media_type}")
+    file_id = await file_ids.get(source)
+    if file_id:
+        try:
+            message = await send(chat_id, file_id, **kwargs)
+            file_ids.hits += 1
+            return message
+        except BadRequest as e:
+            if not is_file_id_error(e):
+                raise
+            logger.warning(f"Cached file_id for '{source}' was rejected, uploading again: {e}")
+            file_ids.forget(source)
+            file_ids.reuploads += 1
+    async with file_ids.lock(source):
+        file_id = await file_ids.get(source)
+        if file_id:  # uploaded by another send while we waited
+            file_ids.hits += 1
+            return await send(chat_id, file_id, **kwargs)
+        with contextlib.ExitStack() as stack:
+            message = await send(chat_id, _open(source, stack), **kwargs)
+        file_ids.uploads += 1
+        file_ids.put(source, _attachment_file_id(message))
+        return message
+
+
+def _album_item(source, media, caption, parse_mode):
+    if source.lower().endswith(VIDEO_EXTENSIONS):
+        return InputMediaVideo(media, caption=caption, parse_mode=parse_mode)
+    return InputMediaPhoto(media, caption=caption, parse_mode=parse_mode)
+
+
+async def _send_album(bot, chat_id, sources, caption, parse_mode):
+    def items(media):
+        # The caption goes on the first item, as Telegram shows it for the album.
+        return [
+            _album_item(source, item, caption if index == 0 else None, parse_mode)
+            for index, (source, item) in enumerate(zip(sources, media))
+        ]
+
+    cached = [await file_ids.get(source) for source in sources]
+    if all(cached):
+        try:
+            messages = await bot.send_media_group(chat_id, items(cached))
+            file_ids.hits += len(sources)
+            return messages
+        except BadRequest as e:
+            if not is_file_id_error(e):
+                raise
+            logger.warning(f"Cached album file_ids were rejected, uploading again: {e}")
+            for source in sources:
+                file_ids.forget(source)
+            file_ids.reuploads += 1
+    async with file_ids.lock(tuple(sources)):
+        with contextlib.ExitStack() as stack:
+            media = [await file_ids.get(source) or _open(source, stack) for source in sources]
+            messages = await bot.send_media_group(chat_id, items(media))
+        for source, item, message in zip(sources, media, messages):
+            if not isinstance(item, str) or is_url(item):
+                file_ids.uploads += 1
+                file_ids.put(source, _attachment_file_id(message))
+        return messages
+
+
+async def send_media(bot, chat_id, media_type, sources, caption=None, parse_mode=None, reply_markup=None):
+    """Send a photo, video, document or album, reusing cached file_ids.
+
+    Albums can't carry a reply markup, so a template's button is dropped for them.
+    """
+    if media_type == "album":
+        return await _send_album(bot, chat_id, sources, caption, parse_mode)
+    return await _send_single(
+        bot, chat_id, media_type, sources[0], caption=caption, parse_mode=parse_mode, reply_markup=reply_markup
+    )
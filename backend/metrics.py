@@ -0,0 +1,319 @@
+import functools
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter as StackCounter
+
+from dotenv import load_dotenv
+from telegram.ext import ApplicationHandlerStop, ConversationHandler
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+# When set, /metrics requires "Authorization: Bearer <METRICS_TOKEN>"; when empty it is open to anyone.
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+PROFILER_MIN_INTERVAL = 0.001  # shorter intervals would keep the sampler thread holding the GIL
+PROFILER_INTERVAL = max(float(os.getenv("PROFILER_INTERVAL", 0.005)), PROFILER_MIN_INTERVAL)  # seconds between samples
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+PROFILER_MAX_STACKS = 10000  # distinct stacks kept; further ones are counted as "(other)"
+PROFILER_MAX_DEPTH = 64
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names, values, extra=None) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value) -> str:
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Metric:
+    """Base for metrics exposed in the Prometheus text format."""
+
+    kind = "untyped"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        registry.append(self)
+
+    def samples(self):
+        return []
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        self.values = {}
+
+    def inc(self, *labels, amount=1) -> None:
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        return [f"{self.name}{_labels(self.labels, key)} {_number(value)}" for key, value in self.values.items()]
+
+
+class Gauge(Metric):
+    """A value read from `function` when metrics are collected."""
+
+    kind = "gauge"
+
+    def __init__(self, name, help, function):
+        super().__init__(name, help)
+        self.function = function
+
+    def samples(self):
+        try:
+            value = self.function()
+        except Exception as e:
+            logger.debug(f"Gauge {self.name} unavailable: {e}")
+            return []
+        return [f"{self.name} {_number(value)}"]
+
+
+class Histogram(Metric):
+    """Observations counted into fixed buckets, as Prometheus histograms."""
+
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        self.values = {}  # label values -> [count per bucket (+Inf last), sum]
+
+    def observe(self, value, *labels) -> None:
+        entry = self.values.get(labels)
+        if entry is None:
+            entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def samples(self):
+        lines = []
+        for key, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                le = 'le="+Inf"' if bound == "+Inf" else f'le="{_number(bound)}"'
+                lines.append(f"{self.name}_bucket{_labels(self.labels, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, key)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.labels, key)} {cumulative}")
+        return lines
+
+
+registry = []
+
+
+def render() -> str:
+    """All metrics of this process in the Prometheus text format."""
+    return "\n".join(metric.render() for metric in registry) + "\n"
+
+
+# --- Metrics ---
+handler_seconds = Histogram("bot_handler_seconds", "Time spent in each bot handler.", ["handler"])
+handler_errors = Counter("bot_handler_errors_total", "Bot handler exceptions by type.", ["handler", "error"])
+http_seconds = Histogram(
+    "http_request_seconds", "Time until an API route sends its response headers.", ["method", "route", "status"]
+)
+send_seconds = Histogram("telegram_send_seconds", "Duration of Telegram send calls made by the send engine.")
+sends = Counter("telegram_sends_total", "Messages sent by the send engine, by outcome.", ["outcome"])
+send_failures = Counter("telegram_send_failures_total", "Failed Telegram sends by error type.", ["error"])
+retry_afters = Counter("telegram_retry_after_total", "Flood limit (RetryAfter) responses from Telegram.")
+storage_seconds = Histogram("storage_seconds", "Time spent in SQLite calls.", ["operation"])
+
+
+# --- Instrumentation ---
+def _timed_callback(name, callback):
+    @functools.wraps(callback)
+    async def timed(update, context):
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except ApplicationHandlerStop:
+            raise
+        except Exception as e:
+            handler_errors.inc(name, type(e).__name__)
+            raise
+        finally:
+            handler_seconds.observe(time.perf_counter() - started, name)
+    return timed
+
+
+def _instrument(handler) -> None:
+    if isinstance(handler, ConversationHandler):
+        for inner in (*handler.entry_points, *handler.fallbacks):
+            _instrument(inner)
+        for handlers in handler.states.values():
+            for inner in handlers:
+                _instrument(inner)
+    else:
+        handler.callback = _timed_callback(handler.callback.__name__, handler.callback)
+
+
+def instrument_handlers(application) -> None:
+    """Time every handler registered on the application, labelled by its callback's name."""
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            _instrument(handler)
+
+
+class MetricsMiddleware:
+    """ASGI middleware timing every HTTP request by method, route template and status."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        started = time.perf_counter()
+        observed = False
+
+        def observe(status_code):
+            nonlocal observed
+            observed = True
+            route = scope.get("route")
+            path = route.path if route is not None else "unmatched"
+            http_seconds.observe(time.perf_counter() - started, scope["method"], path, str(status_code))
+
+        async def send_timed(message):
+            # Observed at the response start, so streamed responses count their setup only.
+            if message["type"] == "http.response.start":
+                observe(message["status"])
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_timed)
+        finally:
+            if not observed:
+                observe(500)
+
+
+class TimedConnection(sqlite3.Connection):
+    """SQLite connection that records how long each statement and commit takes."""
+
+    def execute(self, *args):
+        started = time.perf_counter()
+        try:
+            return super().execute(*args)
+        finally:
+            storage_seconds.observe(time.perf_counter() - started, "execute")
+
+    def executemany(self, *args):
+        started = time.perf_counter()
+        try:
+            return super().executemany(*args)
+        finally:
+            storage_seconds.observe(time.perf_counter() - started, "executemany")
+
+    def commit(self):
+        started = time.perf_counter()
+        try:
+            return super().commit()
+        finally:
+            storage_seconds.observe(time.perf_counter() - started, "commit")
+
+    def __exit__(self, *exc):
+        # Leaving `with conn:` commits (or rolls back) the transaction.
+        started = time.perf_counter()
+        try:
+            return super().__exit__(*exc)
+        finally:
+            storage_seconds.observe(time.perf_counter() - started, "commit")
+
+
+# --- Sampling profiler ---
+class SamplingProfiler:
+    """Samples the event loop thread's stack at a fixed interval while enabled.
+
+    A background thread reads the thread's current frame, so the profiled
+    code runs unmodified; the cost is one stack walk per sample. Samples are
+    aggregated as collapsed stacks ("module:function;module:function") that
+    flame graph tools accept.
+    """
+
+    def __init__(self):
+        self.stacks = StackCounter()
+        self.samples = 0
+        self.interval = PROFILER_INTERVAL
+        self.started_at = None
+        self._target = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, interval: float = None) -> None:
+        """Start sampling the calling thread, clearing earlier samples."""
+        if self.running:
+            return
+        self.interval = max(interval or PROFILER_INTERVAL, PROFILER_MIN_INTERVAL)
+        self.stacks.clear()
+        self.samples = 0
+        self.started_at = time.time()
+        self._target = threading.get_ident()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+        logger.info(f"Sampling profiler started ({self.interval * 1000:g}ms interval)")
+
+    def stop(self) -> None:
+        if self.running:
+            self._stop.set()
+            self._thread.join()
+            logger.info(f"Sampling profiler stopped after {self.samples} samples")
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._target)
+            if frame is None:
+                continue
+            names = []
+            while frame is not None and len(names) < PROFILER_MAX_DEPTH:
+                code = frame.f_code
+                names.append(f"{frame.f_globals.get('__name__', '?')}:{code.co_name}")
+                frame = frame.f_back
+            stack = ";".join(reversed(names))
+            if stack not in self.stacks and len(self.stacks) >= PROFILER_MAX_STACKS:
+                stack = "(other)"
+            self.stacks[stack] += 1
+            self.samples += 1
+
+    def report(self, top: int = 50) -> dict:
+        return {
+            "running": self.running,
+            "interval": self.interval,
+            "started_at": self.started_at,
+            "samples": self.samples,
+            "stacks": [{"stack": stack, "samples": count} for stack, count in self.stacks.most_common(top)],
+        }
+
+    def collapsed(self) -> str:
+        """Every sampled stack with its count, one per line, for flame graph tools."""
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+profiler = SamplingProfiler()
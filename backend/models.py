@@ -1,12 +1,49 @@
-from pydantic import BaseModel, HttpUrl
-from typing import Optional
+from datetime import datetime
+from pydantic import BaseModel, Field, HttpUrl
+from typing import List, Literal, Optional
 
 class TemplateCreate(BaseModel):
     name: str
     content: str
     button_text: Optional[str] = None
     button_url: Optional[HttpUrl] = None
+    media_type: Optional[Literal["photo", "video", "document", "album"]] = None
+    media: List[str] = [] # Names returned by /api/media, or URLs
 
 class SendMessageRequest(BaseModel):
     chat_id: str # Can be a numeric ID or a @username
     template_name: str
+
+class BulkSendRequest(BaseModel):
+    template_name: str
+    chat_ids: Optional[List[int]] = None # Explicit numeric chat IDs
+    audience: Optional[Literal["chats", "users"]] = None # All saved chats or all users
+    segment: Optional[str] = None # Users matching a segment query, e.g. "lang=es AND active<30d"
+    include_inactive: bool = False # Also send to recipients that blocked the bot or can't be reached
+
+class LedgerEditRequest(BaseModel):
+    text: str = Field(min_length=1) # New text; template jobs re-render it with the template's button
+
+class ApiKeyCreate(BaseModel):
+    name: str = Field(min_length=1, max_length=64) # What the key is for, e.g. "crm-sync"
+
+class SegmentTagRequest(BaseModel):
+    tag: str = Field(pattern=r"^[\w.\-]{1,64}$")
+    user_ids: List[int]
+    remove: bool = False
+
+class KeywordCreate(BaseModel):
+    keyword: str = Field(min_length=1)
+    response: str = Field(min_length=1)
+    priority: int = 0 # Higher priority wins when several keywords match
+    case_sensitive: bool = False
+    locale: Optional[str] = None # Only reply to users with this language code, e.g. "es"
+
+class KeywordBulkUpsert(BaseModel):
+    keywords: List[KeywordCreate]
+
+class ScheduleCreate(BaseModel):
+    target: str # "all", "segment:<query>", a chat ID or a @username
+    message: str = Field(min_length=1)
+    run_at: Optional[datetime] = None # When to send; defaults to the first recurrence
+    recurrence: Optional[str] = None # Interval like "1d" or a cron expression like "0 9 * * 1"
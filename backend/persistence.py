@@ -0,0 +1,180 @@
+import hashlib
+import json
+import logging
+import os
+import pickle
+import time
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+import async_storage
+import storage
+
+logger = logging.getLogger(__name__)
+
+
+def _digest(blob: bytes) -> bytes:
+    return hashlib.blake2b(blob, digest_size=16).digest()
+
+
+class SQLitePersistence(BasePersistence):
+    """PTB persistence that writes only what changed.
+
+    Each user, chat and conversation entry is its own row in the shared
+    database. User and chat data are loaded lazily the first time an update
+    for them is processed, and a row is rewritten only when its pickled form
+    differs from what was last loaded or written. Reads run in the storage
+    thread pool and writes go through the group committer, so the rows
+    changed in one persistence run are committed together, off the event loop.
+    """
+
+    def __init__(self, store_data: PersistenceInput = None, update_interval: float = 60):
+        super().__init__(store_data=store_data, update_interval=update_interval)
+        self._digests = {}  # (kind, key) -> digest of the stored pickle
+        self._loaded = {"user": set(), "chat": set()}
+        self._in_flight = 0
+        self._batch_started = None
+        self._batch_rows = 0
+        self.rows_written = 0
+        self.rows_skipped = 0
+        self.last_flush_ms = 0.0
+        self.last_flush_rows = 0
+
+    # --- Reading ---
+    async def _fetch(self, kind, key):
+        blob = await async_storage.read(storage.load_persistence, kind, key)
+        if blob is None:
+            return None
+        self._digests[(kind, str(key))] = _digest(blob)
+        return pickle.loads(blob)
+
+    async def _load_into(self, kind, key, data: dict) -> None:
+        """Merge the stored entry into data the first time key is seen."""
+        if key in self._loaded[kind]:
+            return
+        stored = await self._fetch(kind, key)
+        self._loaded[kind].add(key)
+        if stored:
+            for name, value in stored.items():
+                data.setdefault(name, value)
+
+    async def get_user_data(self):
+        return {}  # loaded per user in refresh_user_data
+
+    async def get_chat_data(self):
+        return {}  # loaded per chat in refresh_chat_data
+
+    async def get_bot_data(self):
+        return await self._fetch("bot", "") or {}
+
+    async def get_callback_data(self):
+        return await self._fetch("callback", "")
+
+    async def get_conversations(self, name):
+        kind = f"conversation:{name}"
+        conversations = {}
+        for key, blob in await async_storage.read(storage.load_persistence_kind, kind):
+            self._digests[(kind, key)] = _digest(blob)
+            conversations[tuple(json.loads(key))] = pickle.loads(blob)
+        return conversations
+
+    async def refresh_user_data(self, user_id, user_data):
+        await self._load_into("user", user_id, user_data)
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        await self._load_into("chat", chat_id, chat_data)
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    # --- Writing ---
+    async def _store(self, function, *args) -> None:
+        # Application.update_persistence() writes every changed entry at
+        # once; they share a commit, timed from the first to the last.
+        if self._in_flight == 0:
+            self._batch_started = time.perf_counter()
+            self._batch_rows = 0
+        self._in_flight += 1
+        self._batch_rows += 1
+        self.rows_written += 1
+        try:
+            await async_storage.write(function, *args)
+        finally:
+            self._in_flight -= 1
+            if self._in_flight == 0:
+                self.last_flush_ms = (time.perf_counter() - self._batch_started) * 1000
+                self.last_flush_rows = self._batch_rows
+
+    async def _write(self, kind, key, value) -> None:
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        digest = _digest(blob)
+        if self._digests.get((kind, key)) == digest:
+            self.rows_skipped += 1
+            return
+        self._digests[(kind, key)] = digest
+        try:
+            await self._store(storage.save_persistence, kind, key, blob)
+        except Exception:
+            self._digests.pop((kind, key), None)  # write it again next time
+            raise
+
+    async def _delete(self, kind, key) -> None:
+        self._digests.pop((kind, key), None)
+        await self._store(storage.delete_persistence, kind, key)
+
+    async def _write_mapping(self, kind, key, data) -> None:
+        await self._load_into(kind, key, data)
+        if not data and (kind, str(key)) not in self._digests:
+            return  # nothing stored and nothing to store
+        await self._write(kind, str(key), data)
+
+    async def update_user_data(self, user_id, data):
+        await self._write_mapping("user", user_id, data)
+
+    async def update_chat_data(self, chat_id, data):
+        await self._write_mapping("chat", chat_id, data)
+
+    async def update_bot_data(self, data):
+        await self._write("bot", "", data)
+
+    async def update_callback_data(self, data):
+        await self._write("callback", "", data)
+
+    async def update_conversation(self, name, key, new_state):
+        kind, row_key = f"conversation:{name}", json.dumps(list(key))
+        if new_state is None:
+            await self._delete(kind, row_key)
+        else:
+            await self._write(kind, row_key, new_state)
+
+    async def drop_user_data(self, user_id):
+        self._loaded["user"].discard(user_id)
+        await self._delete("user", str(user_id))
+
+    async def drop_chat_data(self, chat_id):
+        self._loaded["chat"].discard(chat_id)
+        await self._delete("chat", str(chat_id))
+
+    async def flush(self):
+        await async_storage.write(lambda: None)  # wait for writes still queued
+
+    async def stats(self) -> dict:
+        """Write counters and on-disk size for the API."""
+        size = 0
+        for suffix in ("", "-wal"):
+            try:
+                size += os.path.getsize(storage.DB_FILE + suffix)
+            except OSError:
+                pass
+        rows, data_bytes = await async_storage.read(storage.persistence_size)
+        return {
+            "rows": rows,
+            "data_bytes": data_bytes,
+            "database_bytes": size,
+            "rows_written": self.rows_written,
+            "rows_skipped": self.rows_skipped,
+            "last_flush_ms": round(self.last_flush_ms, 3),
+            "last_flush_rows": self.last_flush_rows,
+            "loaded_users": len(self._loaded["user"]),
+            "loaded_chats": len(self._loaded["chat"]),
+        }
@@ -0,0 +1,128 @@
+from bisect import bisect_left
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+# --- Constants ---
+PAGE_SIZE = 8  # choices per keyboard page
+LABEL_LENGTH = 60  # longer button labels are shortened
+MESSAGE_LENGTH = 4096  # Telegram's limit for one message
+LIST_MAX_MESSAGES = 5  # list output beyond this is cut off with a hint to search
+PREVIEW_LENGTH = 300  # longer values in list entries are shortened
+TOO_LONG = "(entry too long to show)\n"
+
+# Callback data stays a few bytes however long the names are: "s:<tag>:<slot>"
+# picks the slot-th choice shown and "p:<tag>:<page>" turns the page, where
+# <tag> identifies the rendering so buttons of an outdated keyboard are ignored.
+SELECT = "s"
+PAGE = "p"
+NOOP = "noop"
+
+
+class PickerIndex:
+    """Choices sorted by label, for paged keyboards with prefix search.
+
+    Labels are compared case-insensitively, so a prefix search is two
+    bisections and a page is a slice, however many choices there are.
+    """
+
+    def __init__(self, entries):
+        self.entries = sorted(entries, key=lambda entry: entry[0].casefold())  # (label, value)
+        self.keys = [label.casefold() for label, _ in self.entries]
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def matches(self, prefix: str = "") -> range:
+        """Positions of the choices whose label starts with `prefix`."""
+        if not prefix:
+            return range(len(self.entries))
+        prefix = prefix.casefold()
+        start = bisect_left(self.keys, prefix)
+        end = bisect_left(self.keys, prefix[:-1] + chr(ord(prefix[-1]) + 1), start)
+        return range(start, end)
+
+
+class IndexCache:
+    """The PickerIndex of the latest data, rebuilt only when the data changes.
+
+    The storage caches hand out the same object until they reload, so a
+    different object means different data.
+    """
+
+    def __init__(self, entries):
+        self._entries = entries  # data -> (label, value) pairs
+        self._data = None
+        self._index = None
+
+    def get(self, data) -> PickerIndex:
+        if data is not self._data or self._index is None:
+            self._index = PickerIndex(self._entries(data))
+            self._data = data
+        return self._index
+
+
+def shorten(text: str, length: int = PREVIEW_LENGTH) -> str:
+    """Cut text to at most `length` characters, marking the cut. Shorten before escaping HTML."""
+    return text if len(text) <= length else text[:length - 1] + "…"
+
+
+def _label(text: str) -> str:
+    return shorten(text, LABEL_LENGTH)
+
+
+def parse_callback(data: str):
+    """Split picker callback data into (action, tag, number), or None if it isn't a picker button."""
+    action, _, rest = data.partition(":")
+    tag, _, number = rest.partition(":")
+    if action not in (SELECT, PAGE) or not tag.isdigit() or not number.isdigit():
+        return None
+    return action, int(tag), int(number)
+
+
+def render_page(index: PickerIndex, query: str = "", page: int = 0, tag: int = 0):
+    """Build one page of a picker.
+
+    Returns the keyboard (None if nothing matches) and the values of the
+    choices shown, which the caller keeps so a select callback can be
+    resolved even if the index changes in between.
+    """
+    matches = index.matches(query)
+    pages = max((len(matches) + PAGE_SIZE - 1) // PAGE_SIZE, 1)
+    page = min(max(page, 0), pages - 1)
+    shown = matches[page * PAGE_SIZE:(page + 1) * PAGE_SIZE]
+    if not shown:
+        return None, []
+    keyboard = [
+        [InlineKeyboardButton(_label(index.entries[position][0]), callback_data=f"{SELECT}:{tag}:{slot}")]
+        for slot, position in enumerate(shown)
+    ]
+    if pages > 1:
+        keyboard.append([
+            InlineKeyboardButton("◀", callback_data=f"{PAGE}:{tag}:{page - 1}" if page > 0 else NOOP),
+            InlineKeyboardButton(f"{page + 1}/{pages}", callback_data=NOOP),
+            InlineKeyboardButton("▶", callback_data=f"{PAGE}:{tag}:{page + 1}" if page + 1 < pages else NOOP),
+        ])
+    return InlineKeyboardMarkup(keyboard), [index.entries[position][1] for position in shown]
+
+
+def chunk_messages(header: str, entries, max_messages: int = LIST_MAX_MESSAGES, limit: int = MESSAGE_LENGTH):
+    """Join entries into messages that fit Telegram's length limit, never splitting an entry.
+
+    Stops after `max_messages` messages. Returns the messages and how many
+    entries they hold. An entry too long for a message on its own is shown
+    as TOO_LONG, since cutting HTML could leave a tag open.
+    """
+    messages, current, length, used = [], [header], len(header), 0
+    for entry in entries:
+        if len(header) + len(entry) > limit:
+            entry = TOO_LONG
+        if length + len(entry) > limit:  # fits a message of its own, as it is checked above
+            messages.append("".join(current))
+            if len(messages) == max_messages:
+                return messages, used
+            current, length = [], 0
+        current.append(entry)
+        length += len(entry)
+        used += 1
+    messages.append("".join(current))
+    return messages, used
@@ -0,0 +1,105 @@
+import asyncio
+import logging
+import os
+
+from dotenv import load_dotenv
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", 64))
+
+
+class _Lane:
+    __slots__ = ("lock", "pending")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.pending = 0  # updates waiting or running in this lane
+
+
+class ChatLaneUpdateProcessor(BaseUpdateProcessor):
+    """Processes updates concurrently while keeping each chat's updates in order.
+
+    Every update is routed to a lane keyed by its chat (or by its user when
+    it has no chat, e.g. inline queries). Updates in the same lane run one at
+    a time in arrival order, so conversation state never races; different
+    lanes share the `max_concurrent_updates` slots. Lanes are dropped as soon
+    as they are empty.
+    """
+
+    def __init__(self, max_concurrent_updates: int = UPDATE_CONCURRENCY):
+        super().__init__(max_concurrent_updates)
+        self._lanes = {}
+        self.pending = 0  # updates taken off the update queue and not finished yet
+        self.running = 0
+        self.processed = 0
+
+    @staticmethod
+    def lane_key(update):
+        if not isinstance(update, Update):
+            return None
+        if update.effective_chat:
+            return ("chat", update.effective_chat.id)
+        if update.effective_user:
+            return ("user", update.effective_user.id)
+        return None
+
+    async def process_update(self, update, coroutine) -> None:
+        # Take the lane before a concurrency slot, so updates queued behind a
+        # busy chat don't hold slots other chats could use.
+        key = self.lane_key(update)
+        self.pending += 1
+        try:
+            if key is None:
+                await super().process_update(update, coroutine)
+                return
+            lane = self._lanes.get(key)
+            if lane is None:
+                lane = self._lanes[key] = _Lane()
+            lane.pending += 1
+            try:
+                async with lane.lock:
+                    await super().process_update(update, coroutine)
+            finally:
+                lane.pending -= 1
+                if not lane.pending:
+                    del self._lanes[key]
+        finally:
+            self.pending -= 1
+
+    async def do_process_update(self, update, coroutine) -> None:
+        self.running += 1
+        try:
+            await coroutine
+        finally:
+            self.running -= 1
+            self.processed += 1
+
+    @property
+    def queued(self) -> int:
+        """Updates waiting for their lane or a concurrency slot."""
+        return max(self.pending - self.running, 0)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def stats(self, top: int = 10) -> dict:
+        """Concurrency and per-lane queue depth, busiest lanes first."""
+        busiest = sorted(self._lanes.items(), key=lambda item: item[1].pending, reverse=True)[:top]
+        return {
+            "max_concurrent_updates": self.max_concurrent_updates,
+            "running": self.running,
+            "processed": self.processed,
+            "lanes": len(self._lanes),
+            "queued": self.queued,
+            "busiest_lanes": [
+                {"kind": kind, "id": lane_id, "depth": lane.pending} for (kind, lane_id), lane in busiest
+            ],
+        }
@@ -0,0 +1,103 @@
+import logging
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+
+import async_storage
+import storage
+
+logger = logging.getLogger(__name__)
+
+# --- Constants ---
+# Failures that will repeat on every send until the recipient comes back.
+PERMANENT_FAILURES = {"blocked", "deactivated", "forbidden", "not_found"}
+
+
+def classify_error(error) -> str:
+    """Classify a send error.
+
+    Returns "blocked", "deactivated", "forbidden" (kicked from a group, or a
+    user who never started the bot), "not_found", "transient" (flood limit or
+    network) or "error" for anything else.
+    """
+    message = str(error).lower()
+    if isinstance(error, Forbidden):
+        if "blocked" in message:
+            return "blocked"
+        if "deactivated" in message:
+            return "deactivated"
+        return "forbidden"
+    if isinstance(error, BadRequest) and "chat not found" in message:
+        return "not_found"
+    if isinstance(error, (RetryAfter, NetworkError)):
+        return "transient"
+    return "error"
+
+
+class InactiveRecipients:
+    """Users and chats that can't be reached, skipped by every broadcast.
+
+    IDs are kept in a set mirrored from the database and reloaded in the
+    storage thread pool when the store's version counter changes, checked at
+    most once per RELOAD_CHECK_INTERVAL. A recipient is marked inactive after
+    a permanent failure and reactivated when they start the bot again or
+    re-add it.
+    """
+
+    def __init__(self):
+        self._snapshot = async_storage.BackgroundSnapshot(storage.load_inactive_ids, storage.inactive_version)
+
+    async def refresh(self) -> None:
+        await self._snapshot.refresh()
+
+    def __contains__(self, chat_id) -> bool:
+        try:
+            return int(chat_id) in self._snapshot.current()
+        except (TypeError, ValueError):
+            return False  # @usernames aren't tracked
+
+    def record_failure(self, chat_id, error) -> str:
+        """Classify a send error and mark the recipient inactive if it is permanent."""
+        reason = classify_error(error)
+        if reason in PERMANENT_FAILURES and str(chat_id).lstrip("-").isdigit():
+            self.mark(chat_id, reason, str(error))
+        return reason
+
+    def _write(self, ids: set, changes: int, function, *args) -> None:
+        # Stored through the group committer, so a broadcast hitting many
+        # blocked users doesn't commit once per recipient on the event loop.
+        def write():
+            function(*args)
+            return storage.inactive_version()
+
+        def done(future):
+            # Skip the reload our own write would trigger, unless another writer changed the list too.
+            if not future.cancelled() and future.exception() is None:
+                self._snapshot.advance(ids, changes, future.result())
+        async_storage.write_later(write).add_done_callback(done)
+
+    def mark(self, chat_id, reason: str, error: str = None) -> None:
+        """Mark a recipient inactive. Must be called from the event loop."""
+        ids = self._snapshot.current()
+        is_new = int(chat_id) not in ids
+        ids.add(int(chat_id))
+        self._write(ids, 1 if is_new else 0, storage.mark_inactive, chat_id, reason, error)
+        logger.info(f"Marked {chat_id} inactive ({reason})")
+
+    def reactivate(self, chat_id) -> bool:
+        """Clear a recipient's failure record. Returns False if it wasn't inactive."""
+        ids = self._snapshot.current()
+        if int(chat_id) not in ids:
+            return False
+        ids.discard(int(chat_id))
+        self._write(ids, 1, storage.reactivate, chat_id)
+        logger.info(f"Reactivated {chat_id}")
+        return True
+
+    def counts(self, total_users: int, total_chats: int, inactive: dict) -> dict:
+        """Active and inactive users and chats, given the stored inactive counters."""
+        return {
+            "active_users": max(total_users - inactive["users"], 0),
+            "inactive_users": inactive["users"],
+            "active_chats": max(total_chats - inactive["chats"], 0),
+            "inactive_chats": inactive["chats"],
+        }
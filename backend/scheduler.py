@@ -0,0 +1,278 @@
+import asyncio
+import heapq
+import logging
+import os
+import re
+import time
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+from dotenv import load_dotenv
+
+import async_storage
+import storage
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+# Time zone used to evaluate cron expressions.
+SCHEDULE_TIMEZONE = ZoneInfo(os.getenv("SCHEDULE_TIMEZONE", "UTC"))
+DISPATCH_RETRY_DELAY = 5  # seconds before a job whose run couldn't be recorded is tried again
+
+_CRON_FIELDS = (  # (name, minimum, maximum)
+    ("minute", 0, 59),
+    ("hour", 0, 23),
+    ("day", 1, 31),
+    ("month", 1, 12),
+    ("weekday", 0, 6),  # 0 = Sunday, 7 is accepted as Sunday too
+)
+
+
+def parse_time(time_str: str) -> int:
+    """Parse a time string like 1d2h3m4s into seconds."""
+    parts = re.findall(r'(\d+)([dhms])', time_str.lower())
+    if not parts:
+        return 0
+
+    total_seconds = 0
+    for value, unit in parts:
+        value = int(value)
+        if unit == 'd':
+            total_seconds += value * 86400
+        elif unit == 'h':
+            total_seconds += value * 3600
+        elif unit == 'm':
+            total_seconds += value * 60
+        elif unit == 's':
+            total_seconds += value
+    return total_seconds
+
+
+def _parse_cron_field(field: str, minimum: int, maximum: int) -> frozenset:
+    values = set()
+    for part in field.split(","):
+        step = 1
+        if "/" in part:
+            part, step_str = part.split("/", 1)
+            step = int(step_str)
+            if step <= 0:
+                raise ValueError(f"Invalid step in '{field}'")
+        if part == "*":
+            start, end = minimum, maximum
+        elif "-" in part:
+            start_str, end_str = part.split("-", 1)
+            start, end = int(start_str), int(end_str)
+        else:
+            start = int(part)
+            end = maximum if step > 1 else start
+        if maximum == 6 and end == 7:  # weekday 7 means Sunday
+            if (7 - start) % step == 0:
+                values.add(0)
+            if start == 7:
+                continue
+            end = 6
+        if start < minimum or end > maximum or start > end:
+            raise ValueError(f"Value out of range in '{field}'")
+        values.update(range(start, end + 1, step))
+    return frozenset(values)
+
+
+class CronExpression:
+    """Standard five-field cron expression: minute hour day month weekday."""
+
+    def __init__(self, expression: str):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError("A cron expression needs 5 fields: minute hour day month weekday")
+        self.expression = " ".join(fields)
+        self.minutes, self.hours, self.days, self.months, self.weekdays = (
+            _parse_cron_field(field, minimum, maximum)
+            for field, (_, minimum, maximum) in zip(fields, _CRON_FIELDS)
+        )
+        # As in cron, a restricted day and weekday match if either one does.
+        self._any_day = fields[2] == "*"
+        self._any_weekday = fields[4] == "*"
+
+    def _day_matches(self, moment: datetime) -> bool:
+        day_ok = moment.day in self.days
+        weekday_ok = (moment.isoweekday() % 7) in self.weekdays
+        if self._any_day or self._any_weekday:
+            return day_ok and weekday_ok
+        return day_ok or weekday_ok
+
+    def next_after(self, timestamp: float) -> float:
+        """Return the first matching minute strictly after timestamp."""
+        moment = datetime.fromtimestamp(timestamp, SCHEDULE_TIMEZONE).replace(second=0, microsecond=0)
+        moment += timedelta(minutes=1)
+        limit = moment + timedelta(days=366 * 5)
+        while moment < limit:
+            if moment.month not in self.months:
+                year, month = (moment.year + 1, 1) if moment.month == 12 else (moment.year, moment.month + 1)
+                moment = moment.replace(year=year, month=month, day=1, hour=0, minute=0)
+                continue
+            if not self._day_matches(moment):
+                moment = (moment + timedelta(days=1)).replace(hour=0, minute=0)
+                continue
+            if moment.hour not in self.hours:
+                moment = (moment + timedelta(hours=1)).replace(minute=0)
+                continue
+            if moment.minute not in self.minutes:
+                moment += timedelta(minutes=1)
+                continue
+            return moment.timestamp()
+        raise ValueError(f"Cron expression '{self.expression}' never matches")
+
+
+def parse_recurrence(text: str):
+    """Normalize a recurrence: an interval like 1d12h, or a cron expression.
+
+    Returns 'every:<seconds>' or 'cron:<expression>'. Raises ValueError if invalid.
+    """
+    text = text.strip()
+    if re.fullmatch(r"(\d+[dhms])+", text.lower()):
+        seconds = parse_time(text)
+        if seconds < 60:
+            raise ValueError("Recurring messages must be at least 1 minute apart")
+        return f"every:{seconds}"
+    cron = CronExpression(text)
+    cron.next_after(time.time())  # reject expressions that never match
+    return f"cron:{cron.expression}"
+
+
+def next_run_after(recurrence: str, previous_run: float, now: float) -> float:
+    """Next run time of a recurring job after `now`, skipping runs missed while down."""
+    kind, value = recurrence.split(":", 1)
+    if kind == "every":
+        interval = int(value)
+        missed = max(0, int((now - previous_run) // interval))
+        return previous_run + (missed + 1) * interval
+    return CronExpression(value).next_after(now)
+
+
+def describe(job: dict) -> dict:
+    """API representation of a scheduled message."""
+    return dict(
+        job,
+        next_run_at=datetime.fromtimestamp(job["next_run"], timezone.utc).isoformat(),
+    )
+
+
+class Scheduler:
+    """Durable scheduler for /schedule messages.
+
+    Jobs are stored in the database and kept in a min-heap ordered by next run
+    time, served by a single background task: adding or firing a job is
+    O(log n) and no timer object exists per job. Cancelled jobs are left in the
+    heap and skipped when they reach the top.
+    """
+
+    def __init__(self):
+        self._heap = []  # (next_run, job_id)
+        self._jobs = {}  # job_id -> job dict, pending jobs only
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._fire = None
+        self._running = set()
+
+    def __len__(self) -> int:
+        return len(self._jobs)
+
+    def _push(self, job: dict) -> None:
+        self._jobs[job["id"]] = job
+        heapq.heappush(self._heap, (job["next_run"], job["id"]))
+
+    async def start(self, fire) -> None:
+        """Load pending jobs and start firing them with the `fire(job)` coroutine function."""
+        self._fire = fire
+        for job in await async_storage.read(storage.load_scheduled_jobs, "pending"):
+            self._push(job)
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"Scheduler started with {len(self._jobs)} pending messages")
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def add(self, target, message, run_at: float, recurrence: str = None) -> dict:
+        """Schedule a message for run_at (a Unix timestamp)."""
+        job = await async_storage.write(storage.add_scheduled_job, target, message, run_at, recurrence)
+        self._push(job)
+        self._wakeup.set()
+        return job
+
+    async def cancel(self, job_id: int) -> bool:
+        """Cancel a pending job. Its heap entry is skipped when it comes up."""
+        if not await async_storage.write(storage.cancel_scheduled_job, job_id):
+            return False
+        self._jobs.pop(job_id, None)
+        return True
+
+    async def reload_job(self, job_id: int) -> None:
+        """Pick up a job another worker added or cancelled in the database."""
+        job = await async_storage.read(storage.get_scheduled_job, job_id)
+        if job and job["status"] == "pending":
+            self._push(job)
+            self._wakeup.set()
+        else:
+            self._jobs.pop(job_id, None)
+
+    def pending(self, limit: int = 100) -> list:
+        """The next `limit` pending jobs, soonest first."""
+        return heapq.nsmallest(limit, self._jobs.values(), key=lambda job: job["next_run"])
+
+    async def _dispatch(self, job: dict, now: float) -> None:
+        if job["recurrence"]:
+            next_run = next_run_after(job["recurrence"], job["next_run"], now)
+            if not await async_storage.write(storage.update_scheduled_job, job["id"], next_run, "pending", now):
+                # Cancelled in the database before the reload reached this worker.
+                self._jobs.pop(job["id"], None)
+                return
+            task = asyncio.create_task(self._fire_job(dict(job)))
+            job["next_run"], job["last_run"] = next_run, now
+            heapq.heappush(self._heap, (job["next_run"], job["id"]))
+        else:
+            # Stays pending in the database until it was sent, so a crash or
+            # shutdown in between sends it again on the next start.
+            self._jobs.pop(job["id"], None)
+            task = asyncio.create_task(self._fire_job(dict(job), complete=True))
+        self._running.add(task)
+        task.add_done_callback(self._running.discard)
+
+    async def _fire_job(self, job: dict, complete: bool = False) -> None:
+        try:
+            await self._fire(job)
+        except Exception as e:
+            logger.error(f"Scheduled message {job['id']} to {job['target']} failed: {e}")
+            status = "failed"
+        else:
+            status = "done"
+        if complete:
+            async_storage.write_later(storage.update_scheduled_job, job["id"], job["next_run"], status, time.time())
+
+    async def _run(self) -> None:
+        while True:
+            now = time.time()
+            while self._heap and self._heap[0][0] <= now:
+                run_at, job_id = heapq.heappop(self._heap)
+                job = self._jobs.get(job_id)
+                if job is None or job["next_run"] != run_at:
+                    continue  # cancelled or rescheduled
+                try:
+                    await self._dispatch(job, now)
+                except Exception as e:
+                    # Still pending in the database; try again shortly.
+                    logger.error(f"Failed to record a run of scheduled message {job_id}: {e}")
+                    job["next_run"] = now + DISPATCH_RETRY_DELAY
+                    heapq.heappush(self._heap, (job["next_run"], job_id))
+            timeout = self._heap[0][0] - now if self._heap else None
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,364 @@
+import logging
+import re
+import time
+from array import array
+from bisect import bisect_left
+
+import async_storage
+import storage
+
+logger = logging.getLogger(__name__)
+
+# --- Constants ---
+DAY = 86400
+LAST_SEEN_DAYS = 90  # per-day activity bitmaps kept; older activity counts as inactive
+SOURCE_MAX_LENGTH = 64
+
+# Set bit positions of every byte value, for turning a bitmap into ordinals.
+_BYTE_BITS = tuple(tuple(bit for bit in range(8) if value >> bit & 1) for value in range(256))
+
+
+def _day(timestamp: float) -> int:
+    return int(timestamp // DAY)
+
+
+class Bitmap:
+    """Growable bitmap over subscriber ordinals.
+
+    Bits are stored in a bytearray so setting one is O(1); set operations
+    convert to Python ints, whose AND/OR/NOT run in C over 64-bit words.
+    """
+
+    __slots__ = ("bits",)
+
+    def __init__(self):
+        self.bits = bytearray()
+
+    def add(self, ordinal: int) -> None:
+        index = ordinal >> 3
+        if index >= len(self.bits):
+            self.bits.extend(bytes(index + 1 - len(self.bits)))
+        self.bits[index] |= 1 << (ordinal & 7)
+
+    def discard(self, ordinal: int) -> None:
+        index = ordinal >> 3
+        if index < len(self.bits):
+            self.bits[index] &= ~(1 << (ordinal & 7)) & 0xFF
+
+    def to_int(self) -> int:
+        return int.from_bytes(self.bits, "little")
+
+
+def iter_ordinals(bits: int):
+    """Yield the positions of the set bits of an int, in ascending order."""
+    data = bits.to_bytes((bits.bit_length() + 7) // 8, "little")
+    for index, byte in enumerate(data):
+        if byte:
+            base = index << 3
+            for bit in _BYTE_BITS[byte]:
+                yield base + bit
+
+
+# --- Query parsing ---
+_TOKEN = re.compile(r"\s*(\(|\)|[^\s()]+)")
+_ATOM = re.compile(r"(lang|tag|source)=([\w,.\-]+)|(active|joined)([<>])(\d+)d|all", re.IGNORECASE)
+
+
+def _tokenize(query: str) -> list:
+    tokens = []
+    position = 0
+    query = query.strip()
+    while position < len(query):
+        match = _TOKEN.match(query, position)
+        if not match:
+            raise ValueError(f"Can't parse segment at '{query[position:]}'")
+        tokens.append(match.group(1))
+        position = match.end()
+    return tokens
+
+
+def parse_segment(query: str):
+    """Parse a segment query into a nested tuple tree. Raises ValueError if invalid.
+
+    Terms: lang=es, tag=vip, source=promo (comma-separated values match any),
+    active<30d / active>30d (seen within / not within the last 30 days),
+    joined<7d / joined>7d, and all. Combine them with AND, OR, NOT and
+    parentheses; AND binds tighter than OR.
+    """
+    tokens = _tokenize(query)
+    if not tokens:
+        raise ValueError("Segment query is empty")
+    position = 0
+
+    def peek():
+        return tokens[position].upper() if position < len(tokens) else None
+
+    def take():
+        nonlocal position
+        position += 1
+        return tokens[position - 1]
+
+    def parse_or():
+        node = parse_and()
+        while peek() == "OR":
+            take()
+            node = ("or", node, parse_and())
+        return node
+
+    def parse_and():
+        node = parse_not()
+        while peek() == "AND":
+            take()
+            node = ("and", node, parse_not())
+        return node
+
+    def parse_not():
+        if peek() == "NOT":
+            take()
+            return ("not", parse_not())
+        if peek() == "(":
+            take()
+            node = parse_or()
+            if peek() != ")":
+                raise ValueError("Missing closing parenthesis")
+            take()
+            return node
+        if peek() is None:
+            raise ValueError("Segment query ends unexpectedly")
+        token = take()
+        match = _ATOM.fullmatch(token)
+        if not match:
+            raise ValueError(f"Unknown segment term '{token}'")
+        if match.group(1):
+            attribute = match.group(1).lower()
+            values = match.group(2).split(",")
+            if attribute == "lang":
+                values = [value.lower() for value in values]
+            return ("in", attribute, tuple(values))
+        if match.group(3):
+            return (match.group(3).lower(), match.group(4), int(match.group(5)))
+        return ("all",)
+
+    tree = parse_or()
+    if position != len(tokens):
+        raise ValueError(f"Unexpected '{tokens[position]}' in segment query")
+    return tree
+
+
+class SegmentIndex:
+    """In-memory bitmap index of subscriber attributes for audience queries.
+
+    Bit i of every bitmap stands for the i-th subscriber in join order (its
+    ordinal in the subscriber log). There is a bitmap per language, tag and
+    deep-link source, and one per day of activity over the last
+    LAST_SEEN_DAYS. Join times are kept in an array in ordinal order, which
+    is join order, so "joined in the last N days" is a range found by bisection.
+    The index is built from the database on first use and kept up to date by
+    the bot's handlers, so it only lives in the process running the bot.
+    """
+
+    def __init__(self):
+        self._subscribers = None
+        self._values = {}  # (attribute, value) -> Bitmap
+        self._seen = {}  # day -> Bitmap
+        self._last_seen = array("i")  # day each ordinal was last seen, 0 if unknown
+        self._joined = array("d")  # join time per ordinal, 0 for users from before profiles
+        self._pruned_before = 0
+
+    def _ensure(self):
+        if self._subscribers is None:
+            self.load()
+        self._sync()
+        return self._subscribers
+
+    def load(self) -> None:
+        """Build the index from the stored profiles and tags."""
+        started = time.perf_counter()
+        subscribers = storage.get_subscribers()
+        self._joined = array("d", [0.0]) * len(subscribers)
+        self._last_seen = array("i", [0]) * len(subscribers)
+        joined = {}
+        oldest_day = _day(time.time()) - LAST_SEEN_DAYS
+        for user_id, language_code, joined_at, last_seen, source in storage.iter_segment_attributes():
+            ordinal = subscribers.ordinal(user_id)
+            if ordinal is None:
+                continue
+            if language_code:
+                self._bitmap("lang", language_code.lower()).add(ordinal)
+            if source:
+                self._bitmap("source", source).add(ordinal)
+            if joined_at:
+                joined[ordinal] = joined_at
+            if last_seen:
+                day = _day(last_seen)
+                self._last_seen[ordinal] = day
+                if day > oldest_day:
+                    self._seen_bitmap(day).add(ordinal)
+        for tag, user_id in storage.iter_user_tags():
+            ordinal = subscribers.ordinal(user_id)
+            if ordinal is not None:
+                self._bitmap("tag", tag).add(ordinal)
+        # Keep join times non-decreasing so the array stays bisectable. A
+        # stored time later than the next subscriber's (a user from before
+        # profiles who started the bot again) is clamped down to it.
+        earliest = time.time()
+        for ordinal in range(len(self._joined) - 1, -1, -1):
+            earliest = min(earliest, joined.get(ordinal, 0.0))
+            self._joined[ordinal] = earliest
+        self._subscribers = subscribers
+        logger.info(
+            f"Built segment index for {len(subscribers)} subscribers "
+            f"in {(time.perf_counter() - started) * 1000:.0f}ms"
+        )
+
+    def _sync(self) -> None:
+        """Give subscribers added since the last call a join time and activity slot."""
+        missing = len(self._subscribers) - len(self._joined)
+        if missing > 0:
+            now = time.time()
+            self._joined.extend([now] * missing)
+            self._last_seen.extend([0] * missing)
+
+    def _bitmap(self, attribute, value) -> Bitmap:
+        bitmap = self._values.get((attribute, value))
+        if bitmap is None:
+            bitmap = self._values[(attribute, value)] = Bitmap()
+        return bitmap
+
+    def _seen_bitmap(self, day) -> Bitmap:
+        bitmap = self._seen.get(day)
+        if bitmap is None:
+            bitmap = self._seen[day] = Bitmap()
+            self._prune(day)
+        return bitmap
+
+    def _prune(self, today) -> None:
+        oldest = today - LAST_SEEN_DAYS
+        if oldest > self._pruned_before:
+            for day in [day for day in self._seen if day <= oldest]:
+                del self._seen[day]
+            self._pruned_before = oldest
+
+    # --- Updates from the bot ---
+    def on_start(self, user_id, language_code=None, source=None) -> None:
+        """Record a user who sent /start (after they were added to the subscriber log)."""
+        subscribers = self._ensure()
+        ordinal = subscribers.ordinal(user_id)
+        if ordinal is None:
+            return
+        if source:
+            self._bitmap("source", source).add(ordinal)
+        self._seen_now(ordinal, language_code)
+
+    def on_import(self, user_id, language_code=None, source=None) -> None:
+        """Record an imported subscriber's attributes, without counting them as active."""
+        if self._subscribers is None:
+            return  # picked up from the database when the index is built
+        subscribers = self._ensure()
+        ordinal = subscribers.ordinal(user_id)
+        if ordinal is None:
+            return
+        if language_code:
+            self._bitmap("lang", language_code.lower()).add(ordinal)
+        if source:
+            self._bitmap("source", source).add(ordinal)
+
+    def touch(self, user_id, language_code=None) -> None:
+        """Record activity from a user. Queues a database write at most once a day per user."""
+        subscribers = self._ensure()
+        ordinal = subscribers.ordinal(user_id)
+        if ordinal is None:
+            return
+        now = time.time()
+        if self._last_seen[ordinal] != _day(now):
+            self._seen_now(ordinal, language_code)
+            async_storage.write_later(storage.touch_user_profile, user_id, language_code, now)
+
+    def _seen_now(self, ordinal, language_code) -> None:
+        today = _day(time.time())
+        previous = self._last_seen[ordinal]
+        if previous != today:
+            if previous in self._seen:
+                self._seen[previous].discard(ordinal)
+            self._seen_bitmap(today).add(ordinal)
+            self._last_seen[ordinal] = today
+        if language_code and not self._has("lang", language_code.lower(), ordinal):
+            for (attribute, _), bitmap in self._values.items():
+                if attribute == "lang":
+                    bitmap.discard(ordinal)
+            self._bitmap("lang", language_code.lower()).add(ordinal)
+
+    def _has(self, attribute, value, ordinal) -> bool:
+        bitmap = self._values.get((attribute, value))
+        if bitmap is None:
+            return False
+        index = ordinal >> 3
+        return index < len(bitmap.bits) and bool(bitmap.bits[index] >> (ordinal & 7) & 1)
+
+    async def tag(self, tag, user_ids, remove=False) -> int:
+        """Add or remove a tag for users and store it. Returns the number of rows changed."""
+        changed = await async_storage.write(storage.tag_users, tag, user_ids, remove)
+        if self._subscribers is not None:
+            bitmap = self._bitmap("tag", tag)
+            for user_id in user_ids:
+                ordinal = self._subscribers.ordinal(int(user_id))
+                if ordinal is not None:
+                    (bitmap.discard if remove else bitmap.add)(ordinal)
+        return changed
+
+    # --- Queries ---
+    def _evaluate(self, node, universe: int) -> int:
+        kind = node[0]
+        if kind == "all":
+            return universe
+        if kind == "and":
+            return self._evaluate(node[1], universe) & self._evaluate(node[2], universe)
+        if kind == "or":
+            return self._evaluate(node[1], universe) | self._evaluate(node[2], universe)
+        if kind == "not":
+            return universe & ~self._evaluate(node[1], universe)
+        if kind == "in":
+            bits = 0
+            for value in node[2]:
+                bitmap = self._values.get((node[1], value))
+                if bitmap is not None:
+                    bits |= bitmap.to_int()
+            return bits
+        if kind == "active":
+            _, operator, days = node
+            if days > LAST_SEEN_DAYS:
+                raise ValueError(f"Activity is only tracked for the last {LAST_SEEN_DAYS} days")
+            since = _day(time.time()) - days
+            bits = 0
+            for day, bitmap in self._seen.items():
+                if day > since:
+                    bits |= bitmap.to_int()
+            return bits if operator == "<" else universe & ~bits
+        if kind == "joined":
+            _, operator, days = node
+            first_recent = bisect_left(self._joined, time.time() - days * DAY)
+            recent = universe & ~((1 << first_recent) - 1)
+            return recent if operator == "<" else universe & ~recent
+        raise ValueError(f"Unknown segment node {kind}")
+
+    def resolve(self, query: str) -> int:
+        """Return the bitmap of subscribers matching a segment query."""
+        tree = parse_segment(query)
+        subscribers = self._ensure()
+        return self._evaluate(tree, (1 << len(subscribers)) - 1)
+
+    def count(self, query: str) -> int:
+        return self.resolve(query).bit_count()
+
+    def members(self, query: str):
+        """Yield the user IDs matching a segment query, in join order."""
+        subscribers = self._ensure()
+        bits = self.resolve(query)
+        return (subscribers.id_at(ordinal) for ordinal in iter_ordinals(bits))
+
+    def stats(self) -> dict:
+        return {
+            "subscribers": len(self._joined),
+            "bitmaps": len(self._values) + len(self._seen),
+            "bytes": sum(len(bitmap.bits) for bitmap in (*self._values.values(), *self._seen.values())),
+        }
@@ -0,0 +1,972 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from dotenv import load_dotenv
+
+import metrics
+from subscribers import SubscriberLog
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+# --- Constants ---
+DB_FILE = os.getenv("DB_FILE", "bot.db")
+SUBSCRIBERS_FILE = os.getenv("SUBSCRIBERS_FILE", "users.log")
+
+# Legacy JSON files, imported once into the database.
+USERS_FILE = "users.json"
+KEYWORDS_FILE = "keywords.json"
+CHATS_FILE = "chats.json"
+TEMPLATES_FILE = "templates.json"
+
+SCHEMA = """
+-- Legacy user list; subscribers now live in the append-only log (see subscribers.py).
+CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS chats (
+    chat_id TEXT PRIMARY KEY,
+    title TEXT,
+    type TEXT
+);
+CREATE INDEX IF NOT EXISTS chats_title ON chats (title);
+CREATE TABLE IF NOT EXISTS templates (
+    name TEXT PRIMARY KEY,
+    content TEXT NOT NULL,
+    button_text TEXT,
+    button_url TEXT,
+    media_type TEXT,
+    media TEXT
+);
+-- Telegram file_ids of uploaded media, so each file is uploaded once.
+CREATE TABLE IF NOT EXISTS media_files (
+    source TEXT PRIMARY KEY,
+    file_id TEXT NOT NULL,
+    uploaded_at REAL NOT NULL
+);
+-- Attributes of users who started the bot, for personalized templates and segments.
+CREATE TABLE IF NOT EXISTS user_profiles (
+    user_id INTEGER PRIMARY KEY,
+    first_name TEXT,
+    last_name TEXT,
+    username TEXT,
+    language_code TEXT,
+    joined_at REAL,
+    last_seen REAL,
+    source TEXT
+);
+CREATE TABLE IF NOT EXISTS user_tags (
+    tag TEXT NOT NULL,
+    user_id INTEGER NOT NULL,
+    PRIMARY KEY (tag, user_id)
+) WITHOUT ROWID;
+-- Recipients that can't receive messages: blocked the bot, deleted, or the chat is gone.
+CREATE TABLE IF NOT EXISTS inactive_recipients (
+    chat_id INTEGER PRIMARY KEY,
+    reason TEXT NOT NULL,
+    error TEXT,
+    failed_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS keywords (
+    keyword TEXT PRIMARY KEY,
+    response TEXT NOT NULL,
+    priority INTEGER NOT NULL DEFAULT 0,
+    case_sensitive INTEGER NOT NULL DEFAULT 0,
+    locale TEXT
+);
+CREATE TABLE IF NOT EXISTS scheduled_jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    target TEXT NOT NULL,
+    message TEXT NOT NULL,
+    next_run REAL NOT NULL,
+    recurrence TEXT,
+    status TEXT NOT NULL DEFAULT 'pending',
+    created_at REAL NOT NULL,
+    last_run REAL,
+    broadcast_id TEXT
+);
+CREATE INDEX IF NOT EXISTS scheduled_jobs_status ON scheduled_jobs (status, next_run);
+CREATE TABLE IF NOT EXISTS leases (
+    name TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+-- Tasks queued for the leader worker. A task is claimed (status, claimed_by,
+-- claimed_at) in the transaction that picks it, so it is never run twice.
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    created_at REAL NOT NULL,
+    claimed_by TEXT,
+    claimed_at REAL
+);
+CREATE INDEX IF NOT EXISTS outbox_status ON outbox (status, id);
+-- python-telegram-bot user/chat/bot data and conversation states, one row per entry.
+CREATE TABLE IF NOT EXISTS persistence (
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    data BLOB NOT NULL,
+    PRIMARY KEY (kind, key)
+) WITHOUT ROWID;
+-- Hashed API keys for machine clients of the web API.
+CREATE TABLE IF NOT EXISTS api_keys (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL,
+    key_hash TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+
+-- Row counts kept up to date by triggers so stats never scan a table.
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO counters (name, value) VALUES
+    ('chats', 0), ('chats_version', 0), ('keywords_version', 0), ('templates_version', 0),
+    ('inactive_users', 0), ('inactive_chats', 0), ('inactive_version', 0), ('api_keys_version', 0);
+CREATE TRIGGER IF NOT EXISTS chats_count_insert AFTER INSERT ON chats
+BEGIN UPDATE counters SET value = value + 1 WHERE name = 'chats'; END;
+CREATE TRIGGER IF NOT EXISTS chats_count_delete AFTER DELETE ON chats
+BEGIN UPDATE counters SET value = value - 1 WHERE name = 'chats'; END;
+CREATE TRIGGER IF NOT EXISTS chats_version_insert AFTER INSERT ON chats
+BEGIN UPDATE counters SET value = value + 1 WHERE name = 'chats_version'; END;
+CREATE TRIGGER IF NOT EXISTS chats_version_update AFTER UPDATE ON chats
+BEGIN UPDATE counters SET value = value + 1 WHERE name = 'chats_version'; END;
+CREATE TRIGGER IF NOT EXISTS chats_version_delete AFTER DELETE ON chats
+BEGIN UPDATE counters SET value = value + 1 WHERE name = 'chats_version'; END;
+
+-- User IDs are positive and group/channel IDs negative.
+CREATE TRIGGER IF NOT EXISTS inactive_count_insert AFTER INSERT ON inactive_recipients
+BEGIN
+    UPDATE counters SET value = value + 1
+    WHERE name = CASE WHEN NEW.chat_id > 0 THEN 'inactive_users' ELSE 'inactive_chats' END;
+    UPDATE counters SET value = value + 1 WHERE name = 'inactive_version';
+END;
+CREATE TRIGGER IF NOT EXISTS inactive_count_delete AFTER DELETE ON inactive_recipients
+BEGIN
+    UPDATE counters SET value = value - 1
+    WHERE name = CASE WHEN OLD.chat_id > 0 THEN 'inactive_users' ELSE 'inactive_chats' END;
+    UPDATE counters SET value = value + 1 WHERE name = 'inactive_version';
+END;
+
+-- Bumped on any template change so compiled templates are reloaded.
+CREATE TRIGGER IF NOT EXISTS templates_version_insert AFTER INSERT ON templates
+BEGIN UPDATE counters SET value = value + 1 WHERE name = 'templates_version'; END;
+CREATE TRIGGER IF NOT EXISTS templates_version_update AFTER UPDATE ON templates
+BEGIN UPDATE counters SET value = value + 1 WHERE name = 'templates_version'; END;
+CREATE TRIGGER IF NOT EXISTS templates_version_delete AFTER DELETE ON templates
+BEGIN UPDATE counters SET value = value + 1 WHERE name = 'templates_version'; END;
+
+-- Bumped when an API key is revoked so every worker drops it from its verification cache.
+CREATE TRIGGER IF NOT EXISTS api_keys_version_delete AFTER DELETE ON api_keys
+BEGIN UPDATE counters SET value = value + 1 WHERE name = 'api_keys_version'; END;
+
+-- Bumped on any keyword change so the compiled matcher knows when to rebuild.
+CREATE TRIGGER IF NOT EXISTS keywords_version_insert AFTER INSERT ON keywords
+BEGIN UPDATE counters SET value = value + 1 WHERE name = 'keywords_version'; END;
+CREATE TRIGGER IF NOT EXISTS keywords_version_update AFTER UPDATE ON keywords
+BEGIN UPDATE counters SET value = value + 1 WHERE name = 'keywords_version'; END;
+CREATE TRIGGER IF NOT EXISTS keywords_version_delete AFTER DELETE ON keywords
+BEGIN UPDATE counters SET value = value + 1 WHERE name = 'keywords_version'; END;
+"""
+
+# Columns added after a table was first released, created on older databases.
+ADDED_COLUMNS = {
+    "user_profiles": [
+        ("joined_at", "REAL"),
+        ("last_seen", "REAL"),
+        ("source", "TEXT"),
+    ],
+    "templates": [
+        ("media_type", "TEXT"),
+        ("media", "TEXT"),
+    ],
+    "keywords": [
+        ("priority", "INTEGER NOT NULL DEFAULT 0"),
+        ("case_sensitive", "INTEGER NOT NULL DEFAULT 0"),
+        ("locale", "TEXT"),
+    ],
+    "scheduled_jobs": [
+        ("broadcast_id", "TEXT"),
+    ],
+    "outbox": [
+        ("claimed_by", "TEXT"),
+        ("claimed_at", "REAL"),
+    ],
+}
+
+_local = threading.local()
+_schema_lock = threading.Lock()
+_schema_ready = False
+_subscribers = None
+
+
+def get_connection() -> sqlite3.Connection:
+    """Return this thread's database connection, opening it on first use.
+
+    Each thread gets its own connection, so a transaction on one thread
+    never picks up another's writes. The first connection creates the
+    schema and migrates old JSON files.
+    """
+    global _schema_ready
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(DB_FILE, check_same_thread=False, factory=metrics.TimedConnection)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        with _schema_lock:
+            if not _schema_ready:
+                conn.executescript(SCHEMA)
+                upgrade_schema(conn)
+                migrate_json(conn)
+                _schema_ready = True
+        _local.conn = conn
+    return conn
+
+
+@contextmanager
+def transaction():
+    """Commit the writes made inside the block, or roll them back on an error.
+
+    Inside run_batch() the block joins the batch's transaction instead.
+    """
+    conn = get_connection()
+    if getattr(_local, "in_batch", False):
+        yield conn
+        return
+    with conn:
+        yield conn
+
+
+def run_batch(calls) -> list:
+    """Run storage writes in one transaction and commit once (group commit).
+
+    `calls` is a list of (function, args). Each runs in its own savepoint, so
+    a failing call is rolled back without losing the others. Returns a
+    (result, error) pair per call.
+    """
+    conn = get_connection()
+    results = []
+    _local.in_batch = True
+    try:
+        with conn:
+            conn.execute("BEGIN")
+            for function, args in calls:
+                conn.execute("SAVEPOINT batch_call")
+                try:
+                    results.append((function(*args), None))
+                except Exception as e:
+                    conn.execute("ROLLBACK TO batch_call")
+                    results.append((None, e))
+                conn.execute("RELEASE batch_call")
+    finally:
+        _local.in_batch = False
+    return results
+
+
+def upgrade_schema(conn: sqlite3.Connection) -> None:
+    """Add columns that are missing from tables created by an older version."""
+    for table, columns in ADDED_COLUMNS.items():
+        existing = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+        for name, definition in columns:
+            if name not in existing:
+                conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {definition}")
+    conn.commit()
+
+
+def _read_json(path, default):
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return default
+
+
+def migrate_json(conn: sqlite3.Connection) -> None:
+    """Import the legacy JSON files into the database, once."""
+    if conn.execute("SELECT 1 FROM meta WHERE key = 'json_migrated'").fetchone():
+        return
+    users = _read_json(USERS_FILE, [])
+    chats = _read_json(CHATS_FILE, {})
+    templates = _read_json(TEMPLATES_FILE, {})
+    keywords = _read_json(KEYWORDS_FILE, {})
+    with conn:
+        conn.executemany("INSERT OR IGNORE INTO users (user_id) VALUES (?)", ((uid,) for uid in users))
+        conn.executemany(
+            "INSERT OR IGNORE INTO chats (chat_id, title, type) VALUES (?, ?, ?)",
+            ((chat_id, info.get("title"), info.get("type")) for chat_id, info in chats.items()),
+        )
+        conn.executemany(
+            "INSERT OR IGNORE INTO templates (name, content, button_text, button_url) VALUES (?, ?, ?, ?)",
+            ((name, data["content"], data.get("button_text"), data.get("button_url"))
+             for name, data in templates.items()),
+        )
+        conn.executemany("INSERT OR IGNORE INTO keywords (keyword, response) VALUES (?, ?)", keywords.items())
+        conn.execute("INSERT INTO meta (key, value) VALUES ('json_migrated', '1')")
+    logger.info(
+        f"Migrated {len(users)} users, {len(chats)} chats, {len(templates)} templates "
+        f"and {len(keywords)} keywords from JSON into {DB_FILE}"
+    )
+
+
+def _count(name) -> int:
+    row = get_connection().execute("SELECT value FROM counters WHERE name = ?", (name,)).fetchone()
+    return row[0] if row else 0
+
+
+def load_counters(names) -> dict:
+    """Read several counters in one query."""
+    placeholders = ", ".join("?" * len(names))
+    rows = get_connection().execute(f"SELECT name, value FROM counters WHERE name IN ({placeholders})", tuple(names))
+    return {name: 0 for name in names} | dict(rows)
+
+
+# --- Templates ---
+def _template_data(content, button_text, button_url, media_type, media):
+    template_data = {"content": content}
+    if button_text and button_url:
+        template_data["button_text"] = button_text
+        template_data["button_url"] = button_url
+    if media_type and media:
+        template_data["media_type"] = media_type
+        template_data["media"] = json.loads(media)
+    return template_data
+
+
+def load_templates():
+    """Load all templates, keyed by name."""
+    return {
+        name: _template_data(*row)
+        for name, *row in get_connection().execute(
+            "SELECT name, content, button_text, button_url, media_type, media FROM templates ORDER BY rowid"
+        )
+    }
+
+
+def load_templates_page(after=0, limit=100):
+    """Load up to `limit` templates saved after the cursor `after`.
+
+    Returns the templates keyed by name and the cursor of the next page, or
+    None after the last one.
+    """
+    rows = get_connection().execute(
+        "SELECT rowid, name, content, button_text, button_url, media_type, media FROM templates "
+        "WHERE rowid > ? ORDER BY rowid LIMIT ?",
+        (after, limit + 1),
+    ).fetchall()
+    page = {name: _template_data(*row) for _, name, *row in rows[:limit]}
+    return page, rows[limit - 1][0] if len(rows) > limit else None
+
+
+def save_template(name, content, button_text=None, button_url=None, media_type=None, media=None):
+    """Save a template, with optional button data and media (a list of file names or URLs)."""
+    if not (button_text and button_url):
+        button_text, button_url = None, None
+    if not (media_type and media):
+        media_type, media = None, None
+    with transaction() as conn:
+        conn.execute(
+            "INSERT INTO templates (name, content, button_text, button_url, media_type, media) "
+            "VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (name) DO UPDATE SET content = excluded.content, "
+            "button_text = excluded.button_text, button_url = excluded.button_url, "
+            "media_type = excluded.media_type, media = excluded.media",
+            (name, content, button_text, button_url, media_type, json.dumps(media) if media else None),
+        )
+
+
+def delete_template_from_file(name):
+    """Delete a template. Returns False if it didn't exist."""
+    with transaction() as conn:
+        return conn.execute("DELETE FROM templates WHERE name = ?", (name,)).rowcount > 0
+
+
+def import_templates(rows) -> int:
+    """Save templates whose name isn't taken yet. Returns how many were new."""
+    with transaction() as conn:
+        return conn.executemany(
+            "INSERT OR IGNORE INTO templates (name, content, button_text, button_url, media_type, media) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            ((row["name"], row["content"], row["button_text"], row["button_url"], row["media_type"],
+              json.dumps(row["media"]) if row["media"] else None) for row in rows),
+        ).rowcount
+
+
+def templates_version() -> int:
+    """Counter that changes whenever a template is added, changed or removed."""
+    return _count("templates_version")
+
+
+# --- Media ---
+def get_media_file(source):
+    """Return (file_id, uploaded_at) for an uploaded media file, or None."""
+    return get_connection().execute(
+        "SELECT file_id, uploaded_at FROM media_files WHERE source = ?", (source,)
+    ).fetchone()
+
+
+def save_media_file(source, file_id, uploaded_at):
+    """Remember the file_id Telegram returned for a media file."""
+    with transaction() as conn:
+        conn.execute(
+            "INSERT INTO media_files (source, file_id, uploaded_at) VALUES (?, ?, ?) "
+            "ON CONFLICT (source) DO UPDATE SET file_id = excluded.file_id, uploaded_at = excluded.uploaded_at",
+            (source, file_id, uploaded_at),
+        )
+
+
+def delete_media_file(source):
+    """Forget a media file's file_id so it's uploaded again."""
+    with transaction() as conn:
+        conn.execute("DELETE FROM media_files WHERE source = ?", (source,))
+
+
+# --- Chats ---
+def load_chats():
+    """Load all saved chats, keyed by chat ID."""
+    return {
+        chat_id: {"title": title, "type": chat_type}
+        for chat_id, title, chat_type in get_connection().execute(
+            "SELECT chat_id, title, type FROM chats ORDER BY rowid"
+        )
+    }
+
+
+def load_chats_page(after=0, limit=100):
+    """Load up to `limit` chats saved after the cursor `after`.
+
+    Returns the chats keyed by chat ID and the cursor of the next page, or
+    None after the last one.
+    """
+    rows = get_connection().execute(
+        "SELECT rowid, chat_id, title, type FROM chats WHERE rowid > ? ORDER BY rowid LIMIT ?", (after, limit + 1)
+    ).fetchall()
+    page = {chat_id: {"title": title, "type": chat_type} for _, chat_id, title, chat_type in rows[:limit]}
+    return page, rows[limit - 1][0] if len(rows) > limit else None
+
+
+def save_chat(chat_id, chat_title, chat_type):
+    """Save or update a chat."""
+    with transaction() as conn:
+        conn.execute(
+            "INSERT INTO chats (chat_id, title, type) VALUES (?, ?, ?) "
+            "ON CONFLICT (chat_id) DO UPDATE SET title = excluded.title, type = excluded.type",
+            (str(chat_id), chat_title, chat_type),
+        )
+
+
+def import_chats(rows) -> int:
+    """Save chats that aren't saved yet. Returns how many were new."""
+    with transaction() as conn:
+        return conn.executemany(
+            "INSERT OR IGNORE INTO chats (chat_id, title, type) VALUES (?, ?, ?)",
+            ((row["chat_id"], row["title"], row["type"]) for row in rows),
+        ).rowcount
+
+
+def chats_version() -> int:
+    """Counter that changes whenever a chat is added, changed or removed."""
+    return _count("chats_version")
+
+
+# --- Keywords ---
+KEYWORD_COLUMNS = "rowid, keyword, response, priority, case_sensitive, locale"
+
+
+def _keyword_rule(row):
+    seq, keyword, response, priority, case_sensitive, locale = row
+    return {
+        "keyword": keyword,
+        "response": response,
+        "priority": priority,
+        "case_sensitive": bool(case_sensitive),
+        "locale": locale,
+        "seq": seq,
+    }
+
+
+def load_keyword_rules():
+    """Load every keyword with its matching options, highest priority first."""
+    rows = get_connection().execute(
+        f"SELECT {KEYWORD_COLUMNS} FROM keywords ORDER BY priority DESC, rowid"
+    )
+    return [_keyword_rule(row) for row in rows]
+
+
+def get_keyword(keyword):
+    """Load one keyword rule, or None if it doesn't exist."""
+    row = get_connection().execute(
+        f"SELECT {KEYWORD_COLUMNS} FROM keywords WHERE keyword = ?", (keyword,)
+    ).fetchone()
+    return _keyword_rule(row) if row else None
+
+
+def save_keywords(rules):
+    """Insert or update keyword rules in one transaction. Returns the stored rules.
+
+    If the same keyword appears more than once, the last rule wins.
+    """
+    rules = list({
+        rule["keyword"]: {
+            "keyword": rule["keyword"],
+            "response": rule["response"],
+            "priority": rule.get("priority", 0),
+            "case_sensitive": bool(rule.get("case_sensitive", False)),
+            "locale": rule["locale"].lower() if rule.get("locale") else None,
+        }
+        for rule in rules
+    }.values())
+    with transaction() as conn:
+        conn.executemany(
+            "INSERT INTO keywords (keyword, response, priority, case_sensitive, locale) "
+            "VALUES (:keyword, :response, :priority, :case_sensitive, :locale) "
+            "ON CONFLICT (keyword) DO UPDATE SET response = excluded.response, "
+            "priority = excluded.priority, case_sensitive = excluded.case_sensitive, "
+            "locale = excluded.locale",
+            rules,
+        )
+    saved = []
+    for start in range(0, len(rules), 500):
+        batch = [rule["keyword"] for rule in rules[start:start + 500]]
+        saved.extend(_keyword_rule(row) for row in conn.execute(
+            f"SELECT {KEYWORD_COLUMNS} FROM keywords WHERE keyword IN ({','.join('?' * len(batch))})",
+            batch,
+        ))
+    return saved
+
+
+def save_keyword(keyword, response, priority=0, case_sensitive=False, locale=None):
+    """Insert or update one keyword rule. Returns the stored rule."""
+    return save_keywords([{
+        "keyword": keyword,
+        "response": response,
+        "priority": priority,
+        "case_sensitive": case_sensitive,
+        "locale": locale,
+    }])[0]
+
+
+def delete_keyword(keyword):
+    """Delete a keyword. Returns False if it didn't exist."""
+    with transaction() as conn:
+        return conn.execute("DELETE FROM keywords WHERE keyword = ?", (keyword,)).rowcount > 0
+
+
+def keywords_version() -> int:
+    """Counter that changes whenever a keyword is added, changed or removed."""
+    return _count("keywords_version")
+
+
+# --- Users ---
+def get_subscribers() -> SubscriberLog:
+    """Load the subscriber log on first use, seeding it from the legacy users table."""
+    global _subscribers
+    if _subscribers is None:
+        subscribers = SubscriberLog(SUBSCRIBERS_FILE)
+        if subscribers.exists():
+            subscribers.refresh()
+        else:
+            rows = get_connection().execute("SELECT user_id FROM users ORDER BY rowid")
+            subscribers.claim()
+            subscribers.add_many(row[0] for row in rows)
+            subscribers.release()
+        _subscribers = subscribers
+    return _subscribers
+
+
+def claim_subscribers() -> None:
+    """Make this process the subscriber log's writer. Called when it starts running the bot."""
+    get_subscribers().claim()
+
+
+def release_subscribers() -> None:
+    """Give up writing the subscriber log, e.g. when another worker takes over the bot."""
+    get_subscribers().release()
+
+
+def _read_subscribers() -> SubscriberLog:
+    subscribers = get_subscribers()
+    if not subscribers.is_writer:
+        # Another worker owns the log (or none does yet); pick up what was appended.
+        subscribers.refresh()
+    return subscribers
+
+
+def get_user_ids():
+    """Return the subscribed user IDs as a set-like view that streams in join order."""
+    return _read_subscribers()
+
+
+def add_user_id(user_id):
+    """Add a user ID if it isn't stored yet."""
+    get_subscribers().add(user_id)
+
+
+def add_user_ids(user_ids) -> list:
+    """Add the user IDs that aren't stored yet in one append. Returns the new ones."""
+    subscribers = get_subscribers()
+    new = [user_id for user_id in dict.fromkeys(user_ids) if user_id not in subscribers]
+    subscribers.add_many(new)
+    return new
+
+
+USER_PROFILE_COLUMNS = (
+    "user_id", "first_name", "last_name", "username", "language_code", "joined_at", "last_seen", "source",
+)
+
+
+def save_user_profile(user_id, first_name=None, last_name=None, username=None, language_code=None, source=None):
+    """Store or update a user's profile.
+
+    The join time and the deep-link source are kept from the first time the user started the bot.
+    """
+    now = time.time()
+    with transaction() as conn:
+        conn.execute(
+            "INSERT INTO user_profiles (user_id, first_name, last_name, username, language_code, "
+            "joined_at, last_seen, source) VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (user_id) DO UPDATE SET first_name = excluded.first_name, "
+            "last_name = excluded.last_name, username = excluded.username, language_code = excluded.language_code, "
+            "joined_at = COALESCE(user_profiles.joined_at, excluded.joined_at), last_seen = excluded.last_seen, "
+            "source = COALESCE(user_profiles.source, excluded.source)",
+            (int(user_id), first_name, last_name, username, language_code, now, now, source),
+        )
+
+
+def touch_user_profile(user_id, language_code, last_seen):
+    """Record when a user was last seen, and their current language."""
+    with transaction() as conn:
+        conn.execute(
+            "INSERT INTO user_profiles (user_id, language_code, last_seen) VALUES (?, ?, ?) "
+            "ON CONFLICT (user_id) DO UPDATE SET language_code = excluded.language_code, "
+            "last_seen = excluded.last_seen",
+            (int(user_id), language_code, last_seen),
+        )
+
+
+def iter_segment_attributes():
+    """Yield (user_id, language_code, joined_at, last_seen, source) for every stored profile."""
+    return get_connection().execute(
+        "SELECT user_id, language_code, joined_at, last_seen, source FROM user_profiles"
+    )
+
+
+def iter_user_tags():
+    """Yield (tag, user_id) for every tagged user."""
+    return get_connection().execute("SELECT tag, user_id FROM user_tags")
+
+
+def tag_users(tag, user_ids, remove=False) -> int:
+    """Add or remove a tag for the given users. Returns the number of rows changed."""
+    conn = get_connection()
+    sql = (
+        "DELETE FROM user_tags WHERE tag = ? AND user_id = ?" if remove
+        else "INSERT OR IGNORE INTO user_tags (tag, user_id) VALUES (?, ?)"
+    )
+    with transaction():
+        return conn.executemany(sql, ((tag, int(user_id)) for user_id in user_ids)).rowcount
+
+
+def get_user_profile(user_id):
+    """Load a user's stored profile, or None if there is none."""
+    row = get_connection().execute(
+        f"SELECT {', '.join(USER_PROFILE_COLUMNS)} FROM user_profiles WHERE user_id = ?", (int(user_id),)
+    ).fetchone()
+    return dict(zip(USER_PROFILE_COLUMNS, row)) if row else None
+
+
+def count_users() -> int:
+    """Number of subscribed users."""
+    return len(_read_subscribers())
+
+
+def load_user_rows(user_ids) -> list:
+    """Profiles of the given users in the given order; users without a profile get only their ID."""
+    user_ids = list(user_ids)
+    profiles = {}
+    for start in range(0, len(user_ids), 500):  # stay below SQLite's variable limit
+        chunk = user_ids[start:start + 500]
+        rows = get_connection().execute(
+            f"SELECT {', '.join(USER_PROFILE_COLUMNS)} FROM user_profiles "
+            f"WHERE user_id IN ({', '.join('?' * len(chunk))})",
+            chunk,
+        )
+        profiles.update((row[0], dict(zip(USER_PROFILE_COLUMNS, row))) for row in rows)
+    empty = dict.fromkeys(USER_PROFILE_COLUMNS)
+    return [profiles.get(user_id) or {**empty, "user_id": user_id} for user_id in user_ids]
+
+
+def import_user_profiles(rows) -> None:
+    """Store profiles of imported users, keeping any profile that is already stored."""
+    joined_at = time.time()
+    with transaction() as conn:
+        conn.executemany(
+            "INSERT OR IGNORE INTO user_profiles (user_id, first_name, last_name, username, language_code, "
+            "joined_at, source) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            ((row["user_id"], row["first_name"], row["last_name"], row["username"], row["language_code"],
+              joined_at, row["source"]) for row in rows),
+        )
+
+
+# --- Inactive Recipients ---
+def mark_inactive(chat_id, reason, error=None):
+    """Record a permanent delivery failure for a user or chat."""
+    with transaction() as conn:
+        conn.execute(
+            "INSERT INTO inactive_recipients (chat_id, reason, error, failed_at) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (chat_id) DO UPDATE SET reason = excluded.reason, error = excluded.error, "
+            "failed_at = excluded.failed_at",
+            (int(chat_id), reason, error, time.time()),
+        )
+
+
+def reactivate(chat_id) -> bool:
+    """Clear a recipient's failure record. Returns False if it wasn't inactive."""
+    with transaction() as conn:
+        return conn.execute("DELETE FROM inactive_recipients WHERE chat_id = ?", (int(chat_id),)).rowcount > 0
+
+
+def load_inactive_ids() -> set:
+    """IDs of every inactive user and chat."""
+    return {row[0] for row in get_connection().execute("SELECT chat_id FROM inactive_recipients")}
+
+
+def inactive_version() -> int:
+    """Counter that changes whenever a recipient is marked inactive or reactivated."""
+    return _count("inactive_version")
+
+
+# --- Scheduled Messages ---
+SCHEDULED_JOB_COLUMNS = (
+    "id", "target", "message", "next_run", "recurrence", "status", "created_at", "last_run", "broadcast_id",
+)
+
+
+def add_scheduled_job(target, message, next_run, recurrence=None):
+    """Store a new pending scheduled message and return it."""
+    conn = get_connection()
+    created_at = time.time()
+    with transaction():
+        cursor = conn.execute(
+            "INSERT INTO scheduled_jobs (target, message, next_run, recurrence, created_at) VALUES (?, ?, ?, ?, ?)",
+            (str(target), message, next_run, recurrence, created_at),
+        )
+    return {
+        "id": cursor.lastrowid,
+        "target": str(target),
+        "message": message,
+        "next_run": next_run,
+        "recurrence": recurrence,
+        "status": "pending",
+        "created_at": created_at,
+        "last_run": None,
+        "broadcast_id": None,
+    }
+
+
+def load_scheduled_jobs(status="pending", limit=-1):
+    """Load scheduled messages with the given status, soonest first."""
+    rows = get_connection().execute(
+        f"SELECT {', '.join(SCHEDULED_JOB_COLUMNS)} FROM scheduled_jobs WHERE status = ? "
+        "ORDER BY next_run LIMIT ?",
+        (status, limit),
+    )
+    return [dict(zip(SCHEDULED_JOB_COLUMNS, row)) for row in rows]
+
+
+def get_scheduled_job(job_id):
+    """Load one scheduled message, or None if it doesn't exist."""
+    row = get_connection().execute(
+        f"SELECT {', '.join(SCHEDULED_JOB_COLUMNS)} FROM scheduled_jobs WHERE id = ?", (job_id,)
+    ).fetchone()
+    return dict(zip(SCHEDULED_JOB_COLUMNS, row)) if row else None
+
+
+def count_scheduled_jobs(status="pending") -> int:
+    """Number of scheduled messages with the given status."""
+    return get_connection().execute(
+        "SELECT COUNT(*) FROM scheduled_jobs WHERE status = ?", (status,)
+    ).fetchone()[0]
+
+
+def update_scheduled_job(job_id, next_run, status, last_run) -> bool:
+    """Record a run of a pending scheduled message and its next run time.
+
+    Returns False if the job is no longer pending, e.g. it was cancelled
+    through another worker, so it isn't brought back.
+    """
+    with transaction() as conn:
+        return conn.execute(
+            "UPDATE scheduled_jobs SET next_run = ?, status = ?, last_run = ? WHERE id = ? AND status = 'pending'",
+            (next_run, status, last_run, job_id),
+        ).rowcount > 0
+
+
+def claim_scheduled_broadcast(job_id, broadcast_id) -> bool:
+    """Record the broadcast job a pending one-shot message is about to start.
+
+    Returns False if the message is no longer pending or already has one.
+    """
+    with transaction() as conn:
+        return conn.execute(
+            "UPDATE scheduled_jobs SET broadcast_id = ? WHERE id = ? AND status = 'pending' AND broadcast_id IS NULL",
+            (broadcast_id, job_id),
+        ).rowcount > 0
+
+
+def cancel_scheduled_job(job_id):
+    """Cancel a pending scheduled message. Returns False if there was none."""
+    with transaction() as conn:
+        return conn.execute(
+            "UPDATE scheduled_jobs SET status = 'cancelled' WHERE id = ? AND status = 'pending'", (job_id,)
+        ).rowcount > 0
+
+
+# --- Leader Lease ---
+def acquire_lease(name, owner, ttl) -> bool:
+    """Take or renew a named lease. Returns True if `owner` holds it afterwards."""
+    conn = get_connection()
+    now = time.time()
+    with transaction():
+        conn.execute(
+            "INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?) "
+            "ON CONFLICT (name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at "
+            "WHERE leases.owner = excluded.owner OR leases.expires_at < ?",
+            (name, owner, now + ttl, now),
+        )
+        row = conn.execute("SELECT owner FROM leases WHERE name = ?", (name,)).fetchone()
+    return row is not None and row[0] == owner
+
+
+def release_lease(name, owner) -> None:
+    """Give up a lease so another worker can take it right away."""
+    with transaction() as conn:
+        conn.execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, owner))
+
+
+# --- Outbox ---
+def enqueue_outbox(kind, payload) -> int:
+    """Queue a task for the leader worker. Returns its ID."""
+    with transaction() as conn:
+        return conn.execute(
+            "INSERT INTO outbox (kind, payload, created_at) VALUES (?, ?, ?)",
+            (kind, json.dumps(payload), time.time()),
+        ).lastrowid
+
+
+def claim_outbox(worker_id, limit=100) -> list:
+    """Claim the oldest pending tasks for worker_id. Returns (id, kind, payload) tuples."""
+    with transaction() as conn:
+        rows = conn.execute(
+            "SELECT id, kind, payload FROM outbox WHERE status = 'pending' ORDER BY id LIMIT ?", (limit,)
+        ).fetchall()
+        now = time.time()
+        conn.executemany(
+            "UPDATE outbox SET status = 'claimed', claimed_by = ?, claimed_at = ? WHERE id = ?",
+            ((worker_id, now, task_id) for task_id, _, _ in rows),
+        )
+    return [(task_id, kind, json.loads(payload)) for task_id, kind, payload in rows]
+
+
+def complete_outbox(task_id) -> None:
+    """Delete a task the leader finished."""
+    with transaction() as conn:
+        conn.execute("DELETE FROM outbox WHERE id = ?", (task_id,))
+
+
+def drop_claimed_outbox() -> list:
+    """Delete tasks claimed but never finished, e.g. by a leader that crashed.
+
+    They may have run already, so they are dropped instead of run again.
+    Returns (id, kind, claimed_by) for each.
+    """
+    with transaction() as conn:
+        rows = conn.execute("SELECT id, kind, claimed_by FROM outbox WHERE status != 'pending'").fetchall()
+        conn.execute("DELETE FROM outbox WHERE status != 'pending'")
+    return rows
+
+
+# --- API Keys ---
+API_KEY_COLUMNS = ("id", "name", "key_hash", "created_at")
+
+
+def add_api_key(name, key_hash):
+    """Store a new API key hash and return the key's ID, name and creation time."""
+    created_at = time.time()
+    with transaction() as conn:
+        cursor = conn.execute(
+            "INSERT INTO api_keys (name, key_hash, created_at) VALUES (?, ?, ?)", (name, key_hash, created_at)
+        )
+    return {"id": cursor.lastrowid, "name": name, "created_at": created_at}
+
+
+def get_api_key(key_id):
+    """Load one API key with its hash, or None if it doesn't exist."""
+    row = get_connection().execute(
+        f"SELECT {', '.join(API_KEY_COLUMNS)} FROM api_keys WHERE id = ?", (key_id,)
+    ).fetchone()
+    return dict(zip(API_KEY_COLUMNS, row)) if row else None
+
+
+def load_api_keys():
+    """List API keys without their hashes, oldest first."""
+    rows = get_connection().execute("SELECT id, name, created_at FROM api_keys ORDER BY id")
+    return [{"id": key_id, "name": name, "created_at": created_at} for key_id, name, created_at in rows]
+
+
+def delete_api_key(key_id):
+    """Revoke an API key. Returns False if it didn't exist."""
+    with transaction() as conn:
+        return conn.execute("DELETE FROM api_keys WHERE id = ?", (key_id,)).rowcount > 0
+
+
+def api_keys_version() -> int:
+    """Counter that changes whenever an API key is revoked."""
+    return _count("api_keys_version")
+
+
+# --- Bot Persistence ---
+def load_persistence(kind, key):
+    """Return the pickled python-telegram-bot data stored for kind and key, or None."""
+    row = get_connection().execute(
+        "SELECT data FROM persistence WHERE kind = ? AND key = ?", (kind, str(key))
+    ).fetchone()
+    return None if row is None else row[0]
+
+
+def load_persistence_kind(kind) -> list:
+    """Return (key, pickled data) for every entry of a kind."""
+    return get_connection().execute("SELECT key, data FROM persistence WHERE kind = ?", (kind,)).fetchall()
+
+
+def save_persistence(kind, key, data) -> None:
+    """Store pickled data for kind and key, replacing what was there."""
+    with transaction() as conn:
+        conn.execute(
+            "INSERT INTO persistence (kind, key, data) VALUES (?, ?, ?) "
+            "ON CONFLICT (kind, key) DO UPDATE SET data = excluded.data",
+            (kind, key, data),
+        )
+
+
+def delete_persistence(kind, key) -> None:
+    """Delete the entry for kind and key."""
+    with transaction() as conn:
+        conn.execute("DELETE FROM persistence WHERE kind = ? AND key = ?", (kind, key))
+
+
+def persistence_size() -> tuple:
+    """Number of stored entries and their total pickled size in bytes."""
+    return get_connection().execute("SELECT COUNT(*), COALESCE(SUM(LENGTH(data)), 0) FROM persistence").fetchone()
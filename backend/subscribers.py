@@ -0,0 +1,218 @@
+import logging
+import os
+import sys
+import threading
+from array import array
+from itertools import islice
+
+logger = logging.getLogger(__name__)
+
+# --- Constants ---
+RECORD_SIZE = 8  # one little-endian signed 64-bit ID per record
+COMPACT_RATIO = 1.25  # compact once the file holds this many records per live ID
+
+
+def _decode(data: bytes) -> array:
+    records = array("q")
+    records.frombytes(data)
+    if sys.byteorder != "little":
+        records.byteswap()
+    return records
+
+
+def _encode(records: array) -> bytes:
+    if sys.byteorder != "little":
+        records = array("q", records)
+        records.byteswap()
+    return records.tobytes()
+
+
+class SubscriberLog:
+    """Append-only log of subscriber IDs.
+
+    New IDs are appended as fixed-width records instead of rewriting the whole
+    list, and every ID is kept in a dict mapping it to its ordinal (its position
+    in join order) for O(1) membership checks. The log has
+    a single writer; other processes can call `refresh()` to pick up appended
+    records. Duplicate and torn records (left by crashes) are dropped by
+    compaction, which runs in a background thread and swaps the file atomically.
+
+    Only the process that called `claim()` appends or compacts; in a
+    multi-worker deployment that is the worker running the bot, which
+    `release()`s the log when it stops, so readers never go stale.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._ids = array("q")  # insertion order, without duplicates
+        self._members = {}  # ID -> ordinal
+        self._offset = 0  # bytes of the file already read
+        self._records = 0  # records read, duplicates included
+        self._inode = None
+        self._file = None
+        self._lock = threading.Lock()
+        self._compacting = False
+        self._owner = False
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    @property
+    def is_writer(self) -> bool:
+        """True while this process owns the log."""
+        return self._owner
+
+    def claim(self) -> None:
+        """Become the log's writer, first reading what the previous writer appended."""
+        self.refresh()
+        self._owner = True
+        if self.needs_compaction():
+            self.compact_in_background()
+
+    def release(self) -> None:
+        """Stop writing; refresh() then picks up the next writer's appends."""
+        with self._lock:
+            self._owner = False
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def refresh(self) -> int:
+        """Read records appended since the last call. Returns the number of new IDs."""
+        with self._lock:
+            try:
+                f = open(self.path, "rb")
+            except FileNotFoundError:
+                return 0
+            with f:
+                stat = os.fstat(f.fileno())
+                if stat.st_ino != self._inode or stat.st_size < self._offset:
+                    # First load, or the file was compacted by another process.
+                    self._ids, self._members = array("q"), {}
+                    self._offset = self._records = 0
+                    self._inode = stat.st_ino
+                f.seek(self._offset)
+                data = f.read()
+            usable = len(data) - len(data) % RECORD_SIZE
+            records = _decode(data[:usable])
+            before = len(self._ids)
+            if not self._members:
+                # Fast path for a full rebuild: dedupe in C, keeping first-seen order.
+                unique = dict.fromkeys(records)
+                self._ids = records if len(unique) == len(records) else array("q", unique)
+                self._members = dict(zip(unique, range(len(unique))))
+            else:
+                for user_id in records:
+                    if user_id not in self._members:
+                        self._members[user_id] = len(self._ids)
+                        self._ids.append(user_id)
+            self._offset += usable
+            self._records += len(records)
+            added = len(self._ids) - before
+        if self._owner and self.needs_compaction():
+            self.compact_in_background()
+        return added
+
+    def _append_handle(self):
+        if not self._owner:
+            raise RuntimeError(f"This process doesn't own the subscriber log {self.path}; claim() it first")
+        if self._file is None:
+            self._file = open(self.path, "ab")
+            size = self._file.tell()
+            if size % RECORD_SIZE:
+                # Drop a record torn by a crash so appends stay aligned.
+                self._file.truncate(size - size % RECORD_SIZE)
+                self._file.seek(0, os.SEEK_END)
+            self._inode = os.fstat(self._file.fileno()).st_ino
+        return self._file
+
+    def add(self, user_id: int) -> bool:
+        """Append a new ID. Returns False if it was already subscribed."""
+        if user_id in self._members:
+            return False
+        with self._lock:
+            if user_id in self._members:
+                return False
+            f = self._append_handle()
+            f.write(_encode(array("q", [user_id])))
+            f.flush()
+            self._members[user_id] = len(self._ids)
+            self._ids.append(user_id)
+            self._offset += RECORD_SIZE
+            self._records += 1
+        return True
+
+    def add_many(self, user_ids) -> int:
+        """Append every ID that isn't subscribed yet in one write. Returns how many were new."""
+        with self._lock:
+            new = array("q")
+            for user_id in user_ids:
+                if user_id not in self._members:
+                    self._members[user_id] = len(self._ids) + len(new)
+                    new.append(user_id)
+            if new:
+                f = self._append_handle()
+                f.write(_encode(new))
+                f.flush()
+                self._ids.extend(new)
+                self._offset += len(new) * RECORD_SIZE
+                self._records += len(new)
+        return len(new)
+
+    def __contains__(self, user_id) -> bool:
+        return user_id in self._members
+
+    def ordinal(self, user_id):
+        """Position of user_id in join order, or None if it isn't subscribed."""
+        return self._members.get(user_id)
+
+    def id_at(self, ordinal: int) -> int:
+        return self._ids[ordinal]
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def __iter__(self):
+        """Stream the IDs subscribed at the time of the call, in join order."""
+        return islice(self._ids, len(self._ids))
+
+    def needs_compaction(self) -> bool:
+        return self._records > len(self._ids) * COMPACT_RATIO and self._records - len(self._ids) > 1000
+
+    def compact(self) -> None:
+        """Rewrite the log without duplicates and atomically replace the old file."""
+        tmp_path = f"{self.path}.tmp"
+        with self._lock:
+            count = len(self._ids)
+            snapshot = _encode(self._ids[:count])
+        with open(tmp_path, "wb") as f:
+            f.write(snapshot)
+            with self._lock:
+                # IDs added while the snapshot was written go at the end.
+                f.write(_encode(self._ids[count:]))
+                f.flush()
+                os.fsync(f.fileno())
+                if self._file is not None:
+                    self._file.close()
+                    self._file = None
+                os.replace(tmp_path, self.path)
+                self._offset = len(self._ids) * RECORD_SIZE
+                self._records = len(self._ids)
+                self._inode = os.stat(self.path).st_ino
+        logger.info(f"Compacted subscriber log {self.path} to {len(self._ids)} records")
+
+    def compact_in_background(self) -> None:
+        """Run `compact()` in a daemon thread unless one is already running."""
+        if self._compacting:
+            return
+        self._compacting = True
+
+        def run():
+            try:
+                self.compact()
+            except OSError as e:
+                logger.error(f"Failed to compact subscriber log {self.path}: {e}")
+            finally:
+                self._compacting = False
+
+        threading.Thread(target=run, name="subscriber-compaction", daemon=True).start()
@@ -0,0 +1,216 @@
+import html
+import logging
+import re
+from functools import lru_cache
+from html.parser import HTMLParser
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+import async_storage
+import media
+import storage
+
+logger = logging.getLogger(__name__)
+
+# --- Constants ---
+RENDER_CACHE_SIZE = 4096  # rendered texts kept per personalized template
+
+# Tags Telegram accepts with parse_mode=HTML.
+ALLOWED_TAGS = {
+    "b", "strong", "i", "em", "u", "ins", "s", "strike", "del", "span",
+    "tg-spoiler", "a", "code", "pre", "blockquote", "tg-emoji",
+}
+
+# Placeholders a template may use, filled from the recipient's stored profile.
+PLACEHOLDERS = {"first_name", "last_name", "full_name", "username", "user_id"}
+_BRACES = re.compile(r"\{\{|\}\}|\{([^{}]*)\}|[{}]")
+
+
+class _HTMLChecker(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.open_tags = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag not in ALLOWED_TAGS:
+            raise ValueError(f"Unsupported HTML tag <{tag}>")
+        self.open_tags.append(tag)
+
+    def handle_endtag(self, tag):
+        if not self.open_tags or self.open_tags[-1] != tag:
+            raise ValueError(f"Unexpected closing tag </{tag}>")
+        self.open_tags.pop()
+
+
+def check_html(text: str) -> None:
+    """Raise ValueError if text isn't HTML that Telegram will accept."""
+    checker = _HTMLChecker()
+    checker.feed(text)
+    checker.close()
+    if checker.open_tags:
+        raise ValueError(f"Unclosed tag <{checker.open_tags[-1]}>")
+
+
+def _split(content: str, strict: bool) -> list:
+    """Split content into (literal, field, fallback) parts.
+
+    {{ and }} are literal braces. Other braced text that isn't a known
+    placeholder raises ValueError when `strict`; otherwise it stays as it is,
+    the way templates saved before placeholders existed were sent.
+    """
+    parts, literal, position = [], [], 0
+    for match in _BRACES.finditer(content):
+        literal.append(content[position:match.start()])
+        position = match.end()
+        token = match.group()
+        if token in ("{{", "}}"):
+            literal.append(token[0])
+            continue
+        field, _, fallback = (match.group(1) or "").partition("|")
+        if match.group(1) is not None and field in PLACEHOLDERS:
+            parts.append(("".join(literal), field, html.escape(fallback)))
+            literal = []
+            continue
+        if strict:
+            if match.group(1) is None:
+                raise ValueError(f"Single '{token}' in content; use {{{{ and }}}} for literal braces")
+            raise ValueError(f"Unknown placeholder {token}; use one of: {', '.join(sorted(PLACEHOLDERS))}")
+        literal.append(token)
+    literal.append(content[position:])
+    parts.append(("".join(literal), None, None))
+    return parts
+
+
+def _profile_values(profile) -> dict:
+    profile = profile or {}
+    first_name = profile.get("first_name") or ""
+    last_name = profile.get("last_name") or ""
+    return {
+        "first_name": first_name,
+        "last_name": last_name,
+        "full_name": f"{first_name} {last_name}".strip(),
+        "username": profile.get("username") or "",
+        "user_id": str(profile.get("user_id") or ""),
+    }
+
+
+class CompiledTemplate:
+    """A template checked and prepared once, then rendered for each recipient.
+
+    The content is split into literal text and placeholders like {first_name}
+    or {first_name|friend} (with a fallback when the value is missing); use
+    {{ and }} for literal braces. Static templates render to one prebuilt set
+    of send_message() arguments without any per-recipient work. Templates
+    with media send the rendered text as the caption.
+
+    New templates are compiled with `strict`, rejecting unknown placeholders.
+    Stored ones are compiled without it, so text like {SALE} in templates
+    saved before placeholders existed is still sent as written.
+    """
+
+    def __init__(self, name: str, data: dict, strict: bool = True):
+        self.name = name
+        self.data = data
+        self._parts = _split(data["content"], strict)  # (literal, field, fallback)
+        self.fields = {field for _, field, _ in self._parts if field}
+        # Check the markup with placeholders removed, as it will be sent.
+        check_html("".join(literal for literal, _, _ in self._parts))
+
+        self.media_type = data.get("media_type")
+        self.media = data.get("media") or []
+        if self.media_type:
+            media.check_media(self.media_type, self.media)
+
+        self.reply_markup = None
+        if data.get("button_text") and data.get("button_url"):
+            button = InlineKeyboardButton(data["button_text"], url=data["button_url"])
+            self.reply_markup = InlineKeyboardMarkup([[button]])
+        self._static = None
+        if not self.fields:
+            self._static = self._kwargs("".join(literal for literal, _, _ in self._parts))
+        else:
+            self._render_text = lru_cache(maxsize=RENDER_CACHE_SIZE)(self._render_text)
+
+    def _kwargs(self, text: str) -> dict:
+        return {"text": text, "parse_mode": "HTML", "reply_markup": self.reply_markup}
+
+    def _render_text(self, values: tuple) -> str:
+        values = dict(values)
+        out = []
+        for literal, field, fallback in self._parts:
+            out.append(literal)
+            if field:
+                value = values[field]
+                out.append(html.escape(value) if value else fallback)
+        return "".join(out)
+
+    def render(self, profile: dict = None) -> dict:
+        """send_message() arguments for a recipient with this stored profile."""
+        if self._static is not None:
+            return self._static
+        values = _profile_values(profile)
+        return self._kwargs(self._render_text(tuple((field, values[field]) for field in sorted(self.fields))))
+
+    async def render_for(self, chat_id) -> dict:
+        """Like render(), loading the recipient's profile only if the template needs it."""
+        if self._static is not None:
+            return self._static
+        if not str(chat_id).lstrip("-").isdigit():
+            return self.render(None)
+        profile = await async_storage.read(storage.get_user_profile, chat_id)
+        return self.render(profile or {"user_id": chat_id})
+
+    async def send(self, bot, chat_id):
+        """Send this template to chat_id, personalized for the recipient."""
+        kwargs = await self.render_for(chat_id)
+        if not self.media_type:
+            return await bot.send_message(chat_id=chat_id, **kwargs)
+        return await media.send_media(
+            bot, chat_id, self.media_type, self.media,
+            caption=kwargs["text"], parse_mode=kwargs["parse_mode"], reply_markup=kwargs["reply_markup"],
+        )
+
+
+def _compile_stored() -> tuple:
+    templates, problems = {}, {}
+    for name, data in storage.load_templates().items():
+        try:
+            templates[name] = CompiledTemplate(name, data, strict=False)
+        except ValueError as e:
+            logger.error(f"Template '{name}' can't be sent: {e}")
+            problems[name] = str(e)
+    return templates, problems
+
+
+class TemplateCache:
+    """Compiled templates, kept in sync with the stored ones.
+
+    The stored templates are loaded and compiled in the storage thread pool
+    when the store's template version changes, checked at most once per
+    RELOAD_CHECK_INTERVAL. Await refresh() after saving or deleting a
+    template so this process sees it right away. Templates that fail to
+    compile (e.g. HTML Telegram rejects) can't be sent; they are kept with
+    the reason in problems(), so the API and /list_templates can show them.
+    """
+
+    def __init__(self):
+        self._snapshot = async_storage.BackgroundSnapshot(_compile_stored, storage.templates_version)
+
+    async def refresh(self) -> None:
+        await self._snapshot.refresh()
+
+    def get(self, name: str):
+        """Return the compiled template, or None if it doesn't exist."""
+        return self._snapshot.current()[0].get(name)
+
+    def problem(self, name: str):
+        """Why a stored template can't be sent, or None."""
+        return self._snapshot.current()[1].get(name)
+
+    def problems(self) -> dict:
+        """Stored templates that can't be sent, with the reason, by name."""
+        return self._snapshot.current()[1]
+
+    def all(self) -> dict:
+        """Compiled templates by name. The same dict is returned until the templates are reloaded."""
+        return self._snapshot.current()[0]
@@ -0,0 +1,31 @@
+import os
+import sys
+import tempfile
+import threading
+
+import pytest
+
+# The backend is a flat set of modules run from backend/; make them importable
+# and keep anything a module opens at import time out of the working tree.
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND)
+
+_data_dir = tempfile.mkdtemp(prefix="bot-tests-")
+for name, filename in (("DB_FILE", "bot.db"), ("SUBSCRIBERS_FILE", "users.log"), ("MEDIA_DIR", "media")):
+    os.environ.setdefault(name, os.path.join(_data_dir, filename))
+os.environ.setdefault("SCHEDULE_TIMEZONE", "UTC")
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """A fresh, empty database in tmp_path for the storage module."""
+    import storage
+
+    monkeypatch.setattr(storage, "DB_FILE", str(tmp_path / "bot.db"))
+    monkeypatch.setattr(storage, "SUBSCRIBERS_FILE", str(tmp_path / "users.log"))
+    for name in ("USERS_FILE", "CHATS_FILE", "TEMPLATES_FILE", "KEYWORDS_FILE"):
+        monkeypatch.setattr(storage, name, str(tmp_path / "missing.json"))  # nothing to migrate
+    monkeypatch.setattr(storage, "_local", threading.local())  # every thread opens a new connection
+    monkeypatch.setattr(storage, "_schema_ready", False)
+    monkeypatch.setattr(storage, "_subscribers", None)
+    return storage
@@ -0,0 +1,111 @@
+import asyncio
+from datetime import timedelta
+
+import pytest
+from fastapi import HTTPException
+from starlette.requests import Request
+
+import auth
+
+
+@pytest.fixture(autouse=True)
+def fresh_auth(monkeypatch):
+    monkeypatch.setattr(auth, "SECRET_KEY", "test-secret")
+    monkeypatch.setattr(auth, "API_USER", "admin")
+    monkeypatch.setattr(auth, "verified", auth.VerificationCache(100))
+    monkeypatch.setattr(auth, "rejected", auth.VerificationCache(100))
+    monkeypatch.setattr(auth, "failed_clients", auth.FailedClients(3, 60, 100))
+    monkeypatch.setattr(auth, "_api_keys_version", None)
+    monkeypatch.setattr(auth, "_api_keys_checked_at", 0.0)
+
+
+@pytest.fixture
+def bcrypt_calls(monkeypatch):
+    calls = []
+    verify = auth.pwd_context.verify
+
+    def counting(secret, key_hash):
+        calls.append(secret)
+        return verify(secret, key_hash)
+
+    monkeypatch.setattr(auth.pwd_context, "verify", counting)
+    return calls
+
+
+def request(client="10.0.0.1"):
+    return Request({"type": "http", "client": (client, 1234), "headers": []})
+
+
+async def user_for(token, client="10.0.0.1"):
+    try:
+        return await auth.get_current_user(request(client), token)
+    except HTTPException as e:
+        return e.status_code
+
+
+def test_authenticate_user(monkeypatch):
+    monkeypatch.setattr(auth, "API_PASSWORD", "pw")
+    assert auth.authenticate_user("admin", "pw")
+    assert not auth.authenticate_user("admin", "nope")
+    assert not auth.authenticate_user("root", "pw")
+
+
+def test_tokens_are_cached_until_they_expire():
+    token = auth.create_access_token({"sub": "admin"})
+    assert asyncio.run(user_for(token)) == {"username": "admin"}
+    assert asyncio.run(user_for(token)) == {"username": "admin"}
+    assert auth.verified.stats() == {"cached": 1, "hits": 1, "misses": 1}
+
+    expired = auth.create_access_token({"sub": "admin"}, timedelta(seconds=-1))
+    assert asyncio.run(user_for(expired)) == 401
+    assert asyncio.run(user_for(auth.create_access_token({"sub": "someone"}))) == 401
+    assert asyncio.run(user_for("not-a-token")) == 401
+
+
+def test_verification_cache_is_bounded():
+    cache = auth.VerificationCache(2)
+    for name in "abc":
+        cache.put(name, {"username": name}, float("inf"))
+    assert cache.get("a") is None
+    assert cache.get("c") == {"username": "c"}
+
+
+def test_api_key_checks(db, bcrypt_calls):
+    async def scenario():
+        key = await auth.create_api_key("script")
+        assert await user_for(key["key"]) == {"username": "key:script", "api_key_id": key["id"]}
+        assert await user_for(key["key"]) == {"username": "key:script", "api_key_id": key["id"]}
+        assert len(bcrypt_calls) == 1  # the second request was a cache hit
+
+        wrong = f"tmb_{key['id']}_guess"
+        assert await user_for(wrong) == 401
+        assert await user_for(wrong) == 401
+        assert len(bcrypt_calls) == 2  # a known-bad key isn't checked again
+        assert await user_for("tmb_999_x") == 401
+        assert await user_for("tmb_nonsense") == 401
+        assert len(bcrypt_calls) == 2
+
+        # A client guessing with new secrets is refused without bcrypt after the limit...
+        for attempt in range(5):
+            assert await user_for(f"tmb_{key['id']}_guess{attempt}", client="6.6.6.6") == 401
+        assert len(bcrypt_calls) == 5
+        assert auth.stats()["refused_key_guesses"] == 2
+        # ...while the owner, even with the key no longer cached, still gets in.
+        auth.verified.clear()
+        assert (await user_for(key["key"]))["api_key_id"] == key["id"]
+
+        assert await auth.revoke_api_key(key["id"])
+        assert not await auth.revoke_api_key(key["id"])
+        assert await user_for(key["key"]) == 401
+
+    asyncio.run(scenario())
+
+
+def test_failed_clients_are_bounded(monkeypatch):
+    clients = auth.FailedClients(limit=1, window=60, size=2)
+    clients.record("a")
+    clients.record("b")
+    assert clients.blocked("a")
+    clients.record("c")  # full of fresh entries: starts over
+    assert not clients.blocked("a")
+    assert clients.blocked("c")
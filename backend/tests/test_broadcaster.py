@@ -0,0 +1,99 @@
+import asyncio
+import time
+from datetime import timedelta
+
+import pytest
+from telegram.error import Forbidden, RetryAfter
+
+import broadcaster
+from broadcaster import Broadcaster, ChatLimiter, TokenBucket
+
+
+def timed(coroutine):
+    started = time.monotonic()
+    result = asyncio.run(coroutine)
+    return result, time.monotonic() - started
+
+
+# --- TokenBucket ---
+def test_bucket_hands_out_tokens_at_its_rate():
+    async def main():
+        bucket = TokenBucket(rate=100)
+        for _ in range(11):  # the first token is there already
+            await bucket.acquire()
+    _, elapsed = timed(main())
+    assert 0.09 <= elapsed < 0.5
+
+
+def test_paused_bucket_waits_for_everyone():
+    async def main():
+        bucket = TokenBucket(rate=1000)
+        bucket.pause(0.1)
+        bucket.pause(0.01)  # a shorter pause doesn't cut the longer one short
+        await bucket.acquire()
+    _, elapsed = timed(main())
+    assert elapsed >= 0.1
+
+
+# --- ChatLimiter ---
+def test_chat_limiter_spaces_sends_to_the_same_chat_only():
+    async def main():
+        chats = ChatLimiter(interval=0.1)
+        await chats.wait(1)
+        started = time.monotonic()
+        await chats.wait(2)
+        other_chat = time.monotonic() - started
+        await chats.wait(1)
+        return other_chat
+    other_chat, elapsed = timed(main())
+    assert other_chat < 0.05
+    assert elapsed >= 0.1
+
+
+# --- Broadcaster ---
+def test_retry_after_pauses_and_retries_the_same_recipient():
+    calls = []
+
+    async def send(chat_id):
+        calls.append(chat_id)
+        if len(calls) == 1:
+            raise RetryAfter(timedelta(milliseconds=100))
+        return f"sent to {chat_id}"
+
+    engine = Broadcaster(rate=1000, per_chat_interval=0)
+    message, elapsed = timed(engine.send(42, send))
+    assert message == "sent to 42"
+    assert calls == [42, 42]
+    assert elapsed >= 0.1
+    assert engine.stats()["retry_after"] == 1
+    assert engine.stats()["sent"] == 1
+
+
+def test_gives_up_after_max_retries(monkeypatch):
+    monkeypatch.setattr(broadcaster, "MAX_RETRIES", 2)
+
+    async def send(chat_id):
+        raise RetryAfter(timedelta(0))
+
+    engine = Broadcaster(rate=1000, per_chat_interval=0)
+    with pytest.raises(RetryAfter):
+        asyncio.run(engine.send(1, send))
+    assert engine.stats()["retry_after"] == 2
+    assert engine.stats()["failed"] == 1
+
+
+def test_run_reports_every_recipient():
+    async def send(chat_id):
+        if chat_id == 3:
+            raise Forbidden("Forbidden: bot was blocked by the user")
+        return chat_id
+
+    results = {}
+    engine = Broadcaster(rate=1000, per_chat_interval=0, concurrency=3)
+    result = asyncio.run(
+        engine.run(range(1, 6), send, lambda index, chat_id, message, error: results.update({index: (message, error)}))
+    )
+    assert (result.sent, result.failed) == (4, 1)
+    assert sorted(results) == [0, 1, 2, 3, 4]
+    assert results[0] == (1, None)
+    assert isinstance(results[2][1], Forbidden)
@@ -0,0 +1,78 @@
+import asyncio
+import json
+
+import pytest
+from fastapi import HTTPException, Request
+
+import conditional
+from conditional import VersionedResponses
+
+
+def request(if_none_match=None):
+    headers = [(b"if-none-match", if_none_match.encode())] if if_none_match else []
+    return Request({"type": "http", "method": "GET", "path": "/", "query_string": b"", "headers": headers})
+
+
+class Loader:
+    def __init__(self, data):
+        self.data = data
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return self.data
+
+
+def respond(responses, etag, load, if_none_match=None):
+    return asyncio.run(responses.respond(request(if_none_match), etag, load))
+
+
+# --- VersionedResponses ---
+def test_matching_etag_is_answered_without_loading():
+    responses, load = VersionedResponses(), Loader({"a": 1})
+    first = respond(responses, 'W/"chats-3"', load)
+    assert first.status_code == 200
+    assert first.headers["etag"] == 'W/"chats-3"'
+    assert json.loads(first.body) == {"a": 1}
+
+    for if_none_match in ('W/"chats-3"', '"chats-3"', '"chats-2", W/"chats-3"', "*"):
+        assert respond(responses, 'W/"chats-3"', load, if_none_match).status_code == 304
+    assert respond(responses, 'W/"chats-4"', load, 'W/"chats-3"').status_code == 200
+    assert load.calls == 2
+    assert responses.stats()["not_modified"] == 4
+
+
+def test_clients_share_one_rendering_per_etag():
+    responses, load = VersionedResponses(size=1), Loader([1, 2])
+    respond(responses, '"a"', load)
+    assert respond(responses, '"a"', load).body == b"[1,2]"
+    assert load.calls == 1
+    respond(responses, '"b"', load)  # evicts "a"
+    respond(responses, '"a"', load)
+    assert load.calls == 3
+    assert responses.stats() == {"not_modified": 0, "cache_hits": 1, "renders": 3, "cached": 1}
+
+
+# --- Listings ---
+def test_listing_pages_carry_their_cursor_in_the_etag(monkeypatch):
+    monkeypatch.setattr(conditional, "responses", VersionedResponses())
+    items = {str(i): {"title": f"Chat {i}"} for i in range(5)}
+
+    def load_page(cursor, limit):
+        keys = list(items)[cursor:cursor + limit]
+        next_cursor = cursor + limit if cursor + limit < len(items) else None
+        return {key: items[key] for key in keys}, next_cursor
+
+    def listing(cursor=0, limit=None, if_none_match=None):
+        return asyncio.run(conditional.listing(
+            request(if_none_match), "chats", lambda: 7, lambda: items, load_page, cursor, limit
+        ))
+
+    page = listing(cursor=2, limit=2)
+    assert page.headers["etag"] == 'W/"chats-7-2-2"'
+    assert json.loads(page.body) == {"chats": {"2": items["2"], "3": items["3"]}, "next_cursor": 4}
+    assert listing(cursor=2, limit=2, if_none_match='W/"chats-7-2-2"').status_code == 304
+    assert listing().headers["etag"] == 'W/"chats-7"'
+    with pytest.raises(HTTPException) as error:
+        listing(limit=conditional.MAX_PAGE_SIZE + 1)
+    assert error.value.status_code == 422
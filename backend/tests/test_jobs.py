@@ -0,0 +1,106 @@
+import asyncio
+import os
+
+import pytest
+
+import jobs
+from jobs import BroadcastJob, LedgerOperation
+from ledger import DELETED, DELIVERED, EDITED, FAILED, DeliveryLedger
+
+
+@pytest.fixture(autouse=True)
+def jobs_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(jobs, "JOBS_DIR", str(tmp_path))
+    monkeypatch.setattr(jobs, "active_jobs", {})
+    monkeypatch.setattr(jobs, "active_operations", {})
+    return tmp_path
+
+
+def saved(job_id):
+    jobs._checkpoints.submit(lambda: None).result()  # wait for queued checkpoints
+    return BroadcastJob.load(job_id).state
+
+
+def test_create_snapshots_recipients_and_skips():
+    job = BroadcastJob.create([1, 2, 3, 4], {"text": "hi"}, report_chat_id=7, skip={2})
+    assert list(job.recipients()) == [1, 3, 4]
+    state = saved(job.id)
+    assert (state["total"], state["skipped"], state["cursor"], state["status"]) == (3, 1, 0, "running")
+    assert BroadcastJob.load("../etc") is None
+    assert BroadcastJob.load("missing") is None
+
+
+def test_cursor_only_covers_confirmed_results():
+    job = BroadcastJob.create([10, 20, 30, 40], {"text": "hi"})
+    list(job.recipients())
+    job.record(1, True, 20, message_ids=[200])
+    job.record(2, False, 30, error="blocked")
+    assert job.state["cursor"] == 0  # recipient 0 isn't confirmed yet
+    job.record(0, True, 10, message_ids=[100])
+    assert (job.state["cursor"], job.state["sent"], job.state["failed"]) == (3, 2, 1)
+
+
+def test_suspend_and_resume_from_cursor():
+    job = BroadcastJob.create(range(1, 11), {"text": "hi"})
+    for offset, chat_id in zip(range(4), job.recipients()):
+        job.record(offset, True, chat_id, message_ids=[chat_id * 10])
+    asyncio.run(job.suspend())
+    assert job.id not in jobs.active_jobs
+
+    resumed = BroadcastJob.load(job.id)
+    assert resumed.state["cursor"] == 4
+    assert list(resumed.recipients()) == [5, 6, 7, 8, 9, 10]
+    resumed.record(0, True, 5, message_ids=[50])
+    assert resumed.state["cursor"] == 5
+    assert DeliveryLedger(jobs._ledger_path(job.id)).live_messages() == [(1, 10), (2, 20), (3, 30), (4, 40)]
+
+
+def test_checkpoints_every_n_results(monkeypatch):
+    monkeypatch.setattr(jobs, "CHECKPOINT_EVERY", 3)
+    job = BroadcastJob.create(range(1, 8), {"text": "hi"})
+    for offset, chat_id in zip(range(7), job.recipients()):
+        job.record(offset, True, chat_id, message_ids=[1])
+    state = saved(job.id)
+    assert state["cursor"] == 6  # the 7th result is after the last checkpoint
+    assert len(list(DeliveryLedger(jobs._ledger_path(job.id)).records())) == 6
+
+
+def test_finish_marks_done_and_drops_snapshot():
+    job = BroadcastJob.create([1, 2], {"text": "hi"})
+    for offset, chat_id in enumerate(job.recipients()):
+        job.record(offset, chat_id == 1, chat_id, message_ids=[5])
+    asyncio.run(job.finish())
+    assert not os.path.exists(jobs._recipients_path(job.id))
+    progress = asyncio.run(jobs.get_progress(job.id))
+    assert (progress["status"], progress["sent"], progress["failed"], progress["remaining"]) == ("done", 1, 1, 0)
+    assert asyncio.run(jobs.get_ledger_summary(job.id))["delivered"] == 1
+    assert [state["id"] for state in jobs.list_jobs()] == [job.id]
+
+
+def test_ledger_keeps_latest_state_per_message(tmp_path):
+    ledger = DeliveryLedger(str(tmp_path / "job.ledger"))
+    ledger.append(1, 10, DELIVERED)
+    ledger.append(2, 20, DELIVERED)
+    ledger.append(3, 0, FAILED)
+    ledger.flush()
+    ledger.append(1, 10, EDITED)
+    ledger.append(2, 20, DELETED)
+    assert ledger.live_messages() == [(1, 10)]
+    summary = ledger.summary()
+    assert (summary["edited"], summary["deleted"], summary["failed"], summary["delivered"]) == (1, 1, 1, 0)
+
+
+def test_ledger_operation_records_results():
+    job = BroadcastJob.create([1, 2, 3], {"text": "hi"})
+    for offset, chat_id in enumerate(job.recipients()):
+        job.record(offset, True, chat_id, message_ids=[chat_id * 10])
+    asyncio.run(job.finish())
+
+    operation = LedgerOperation.create(job.id, "delete", {})
+    assert operation.targets() == [(1, 10), (2, 20), (3, 30)]
+    operation.record(1, 10, True)
+    operation.record(2, 20, False)
+    asyncio.run(operation.finish())
+    progress = asyncio.run(jobs.get_operation_progress(operation.id))
+    assert (progress["status"], progress["done"], progress["failed"]) == ("done", 1, 1)
+    assert LedgerOperation.create(job.id, "delete", {}).targets() == [(2, 20), (3, 30)]
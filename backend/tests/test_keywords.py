@@ -0,0 +1,115 @@
+import asyncio
+
+import async_storage
+from keywords import KeywordMatcher, KeywordTrie
+
+
+def rule(keyword, response=None, priority=0, seq=0, case_sensitive=False, locale=None):
+    return {
+        "keyword": keyword, "response": response or keyword.upper(), "priority": priority,
+        "seq": seq, "case_sensitive": case_sensitive, "locale": locale,
+    }
+
+
+def test_matches_whole_words_only():
+    trie = KeywordTrie([rule("price"), rule("free shipping")])
+    assert trie.match("What is the price?") == "PRICE"
+    assert trie.match("Is there free shipping here") == "FREE SHIPPING"
+    assert trie.match("prices went up") is None
+    assert trie.match("carefree shipping") is None
+
+
+def test_case_sensitivity():
+    trie = KeywordTrie([rule("help"), rule("VIP", case_sensitive=True)])
+    assert trie.match("HELP me") == "HELP"
+    assert trie.match("am I a VIP") == "VIP"
+    assert trie.match("am I a vip") is None
+
+
+def test_highest_priority_then_first_stored_wins():
+    trie = KeywordTrie([
+        rule("order", "low", priority=0, seq=1),
+        rule("status", "high", priority=5, seq=2),
+        rule("track", "first", priority=0, seq=0),
+    ])
+    assert trie.match("order status") == "high"
+    assert trie.match("track my order") == "first"
+
+
+def test_locale():
+    trie = KeywordTrie([rule("hola", "es", locale="es"), rule("hello")])
+    assert trie.match("hola", "es") == "es"
+    assert trie.match("hola", "ES-mx") == "es"
+    assert trie.match("hola", "en") is None
+    assert trie.match("hola") is None
+    assert trie.match("hello", "es") == "HELLO"
+
+
+def test_add_replaces_and_remove_prunes():
+    trie = KeywordTrie([rule("sale", "old"), rule("sales")])
+    trie.add(rule("sale", "new"))
+    assert len(trie) == 2
+    assert trie.match("big sale") == "new"
+    assert trie.remove("sale")
+    assert not trie.remove("sale")
+    assert trie.match("big sale") is None
+    assert trie.match("big sales") == "SALES"
+    assert trie.remove("sales")
+    assert trie._roots[False] == {}
+
+
+# --- KeywordMatcher ---
+class Store:
+    def __init__(self, rules):
+        self.rules = {rule["keyword"]: rule for rule in rules}
+        self.version = len(self.rules)
+        self.loads = 0
+
+    def save(self, rule):
+        self.rules[rule["keyword"]] = rule
+        self.version += 1
+
+    def load(self):
+        self.loads += 1
+        return list(self.rules.values())
+
+
+def test_matcher_applies_changes_without_rebuilding():
+    store = Store([rule("price")])
+    matcher = KeywordMatcher(store.load, lambda: store.version)
+    assert matcher.match("price?") == "PRICE"
+    store.save(rule("hours", seq=1))
+
+    async def main():
+        await matcher.apply(upserted=[store.rules["hours"]])
+        await matcher.refresh()
+    asyncio.run(main())
+    assert matcher.match("opening hours") == "HOURS"
+    assert store.loads == 1
+
+
+def test_matcher_rebuilds_on_changes_it_was_not_told_about():
+    store = Store([rule("price")])
+    matcher = KeywordMatcher(store.load, lambda: store.version)
+    matcher.match("price")
+    store.save(rule("hours", seq=1))  # written by another worker
+    asyncio.run(matcher.refresh())
+    assert matcher.match("opening hours") == "HOURS"
+    assert store.loads == 2
+
+
+def test_matcher_rebuilds_in_the_background(monkeypatch):
+    monkeypatch.setattr(async_storage, "RELOAD_CHECK_INTERVAL", 0)
+    store = Store([rule("price")])
+    matcher = KeywordMatcher(store.load, lambda: store.version)
+    matcher.match("price")
+    store.save(rule("hours", seq=1))
+
+    async def main():
+        first = matcher.match("opening hours")  # answered from the old trie while it rebuilds
+        for _ in range(100):
+            await asyncio.sleep(0.01)
+            if store.loads == 2:
+                break
+        return first, matcher.match("opening hours")
+    assert asyncio.run(main()) == (None, "HOURS")
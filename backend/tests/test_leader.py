@@ -0,0 +1,117 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+import async_storage
+import leader
+from leader import LeaderElection
+
+
+@pytest.fixture
+def leader_socket(tmp_path, monkeypatch):
+    monkeypatch.setattr(leader, "LEADER_SOCKET", str(tmp_path / "leader.sock"))
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+async def echo(payload):
+    return payload
+
+
+async def reject(payload):
+    raise HTTPException(status_code=422, detail="Template 'x' not found")
+
+
+# --- Outbox ---
+def test_claimed_tasks_are_not_claimed_again(db):
+    first = db.enqueue_outbox("reload_scheduled", {"id": 1})
+    second = db.enqueue_outbox("keywords_changed", {"upserted": [], "removed": ["x"]})
+    assert db.claim_outbox("worker-1") == [
+        (first, "reload_scheduled", {"id": 1}),
+        (second, "keywords_changed", {"upserted": [], "removed": ["x"]}),
+    ]
+    assert db.claim_outbox("worker-2") == []
+    db.complete_outbox(first)
+    # The second task's leader died before finishing it: dropped, not run again.
+    assert db.drop_claimed_outbox() == [(second, "keywords_changed", "worker-1")]
+    assert db.claim_outbox("worker-2") == []
+
+
+def test_outbox_runs_each_kind_on_its_own(db):
+    election = LeaderElection()
+    election.is_leader = True
+    ran = []
+    fast_done = asyncio.Event()
+
+    async def slow(payload):
+        await asyncio.wait_for(fast_done.wait(), 5)  # would time out if kinds ran one after another
+        ran.append("slow")
+
+    async def fast(payload):
+        ran.append("fast")
+        fast_done.set()
+
+    election.register("slow", slow)
+    election.register("fast", fast)
+    db.enqueue_outbox("fast", {})
+    db.claim_outbox("dead-worker")  # interrupted: dropped when the new leader starts draining
+
+    async def main():
+        follower = LeaderElection()
+        await follower.run_on_leader("slow", {}, wait=False)
+        await follower.run_on_leader("fast", {}, wait=False)
+        drain = asyncio.create_task(election._drain_outbox())
+        try:
+            for _ in range(200):
+                await asyncio.sleep(0.02)
+                if len(ran) == 2:
+                    break
+            await async_storage.write(lambda: None)  # let the completions commit
+        finally:
+            drain.cancel()
+
+    run(main())
+    assert ran == ["fast", "slow"]
+    assert db.get_connection().execute("SELECT COUNT(*) FROM outbox").fetchone()[0] == 0
+
+
+# --- Direct Channel ---
+def forward(kind, payload, leader_is_current=True):
+    async def main():
+        election = LeaderElection()
+        election.register("echo", echo)
+        election.register("reject", reject)
+        election.is_leader = True
+        await election._listen()
+        election.is_leader = leader_is_current
+        try:
+            return await LeaderElection().run_on_leader(kind, payload)
+        finally:
+            election._server.close()
+    return run(main())
+
+
+def test_forwarded_task_returns_the_leaders_result(leader_socket):
+    assert forward("echo", {"chat_id": 5, "text": "hi"}) == {"chat_id": 5, "text": "hi"}
+
+
+def test_forwarded_task_raises_the_leaders_error(leader_socket):
+    with pytest.raises(HTTPException) as error:
+        forward("reject", {})
+    assert error.value.status_code == 422
+    assert error.value.detail == "Template 'x' not found"
+
+
+def test_demoted_leader_refuses_forwarded_tasks(leader_socket):
+    with pytest.raises(HTTPException) as error:
+        forward("echo", {}, leader_is_current=False)
+    assert error.value.status_code == 503
+
+
+def test_forward_without_a_leader_is_unavailable(leader_socket):
+    with pytest.raises(HTTPException) as error:
+        run(LeaderElection().run_on_leader("echo", {}))
+    assert error.value.status_code == 503
@@ -0,0 +1,44 @@
+from pickers import TOO_LONG, PickerIndex, chunk_messages
+
+NAMES = ["beta", "Alpha", "alphabet", "Gamma", "al", "b", "ÉCLAIR", "éclat", "zz"]
+
+
+def labels(index, prefix=""):
+    return [index.entries[position][0] for position in index.matches(prefix)]
+
+
+# --- PickerIndex.matches ---
+def test_sorted_case_insensitively():
+    index = PickerIndex((name, name) for name in NAMES)
+    assert labels(index) == ["al", "Alpha", "alphabet", "b", "beta", "Gamma", "zz", "ÉCLAIR", "éclat"]
+
+
+def test_prefix_matches():
+    index = PickerIndex((name, name) for name in NAMES)
+    assert labels(index, "al") == ["al", "Alpha", "alphabet"]
+    assert labels(index, "ALPHA") == ["Alpha", "alphabet"]
+    assert labels(index, "b") == ["b", "beta"]
+    assert labels(index, "écl") == ["ÉCLAIR", "éclat"]
+    assert labels(index, "zz") == ["zz"]
+    assert labels(index, "zzz") == []
+    assert labels(index, "c") == []
+
+
+def test_empty_index():
+    assert PickerIndex([]).matches("a") == range(0, 0)
+
+
+# --- chunk_messages ---
+def test_chunks_never_exceed_limit():
+    entries = [f"entry {i}\n" for i in range(30)] + ["x" * 500, "y\n", "z" * 80, "w" * 80]
+    messages, used = chunk_messages("Header\n", entries, max_messages=10, limit=100)
+    assert used == len(entries)
+    assert all(len(message) <= 100 for message in messages)
+    assert messages[0].startswith("Header\n")
+    assert "".join(messages) == "Header\n" + "".join(entries[:30]) + TOO_LONG + "y\n" + "z" * 80 + "w" * 80
+
+
+def test_chunks_stop_after_max_messages():
+    messages, used = chunk_messages("", ["a" * 40] * 10, max_messages=2, limit=100)
+    assert len(messages) == 2
+    assert used == 4
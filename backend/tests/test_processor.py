@@ -0,0 +1,71 @@
+import asyncio
+
+from telegram import Update
+
+from processor import ChatLaneUpdateProcessor
+
+
+def update(update_id, chat_id):
+    return Update.de_json(
+        {
+            "update_id": update_id,
+            "message": {"message_id": update_id, "date": 0, "chat": {"id": chat_id, "type": "private"}, "text": "hi"},
+        },
+        None,
+    )
+
+
+def run_updates(processor, updates, delay=0.02):
+    """Process updates concurrently; returns the (event, update_id) log."""
+    log = []
+
+    async def handle(update_id):
+        log.append(("start", update_id))
+        await asyncio.sleep(delay)
+        log.append(("end", update_id))
+
+    async def main():
+        await asyncio.gather(*(processor.process_update(u, handle(u.update_id)) for u in updates))
+    asyncio.run(main())
+    return log
+
+
+def test_updates_of_one_chat_run_in_order():
+    processor = ChatLaneUpdateProcessor(max_concurrent_updates=8)
+    log = run_updates(processor, [update(i, chat_id=5) for i in range(1, 4)])
+    assert log == [("start", 1), ("end", 1), ("start", 2), ("end", 2), ("start", 3), ("end", 3)]
+
+
+def test_different_chats_run_concurrently():
+    processor = ChatLaneUpdateProcessor(max_concurrent_updates=8)
+    log = run_updates(processor, [update(1, chat_id=5), update(2, chat_id=6), update(3, chat_id=5)])
+    assert log[:2] == [("start", 1), ("start", 2)]
+    assert log.index(("start", 3)) > log.index(("end", 1))
+
+
+def test_a_busy_chat_does_not_hold_slots_other_chats_need():
+    processor = ChatLaneUpdateProcessor(max_concurrent_updates=2)
+    updates = [update(i, chat_id=5) for i in range(1, 5)] + [update(9, chat_id=6)]
+    log = run_updates(processor, updates)
+    # Chat 6 starts while chat 5's first update runs, not after its queue drains.
+    assert log.index(("start", 9)) < log.index(("end", 1))
+
+
+def test_lanes_are_dropped_when_empty_and_counted_while_busy():
+    processor = ChatLaneUpdateProcessor(max_concurrent_updates=4)
+    seen = {}
+
+    async def main():
+        async def handle():
+            await asyncio.sleep(0.01)
+
+        tasks = [asyncio.create_task(processor.process_update(update(i, chat_id=5), handle())) for i in range(3)]
+        await asyncio.sleep(0.005)
+        seen.update(processor.stats())
+        await asyncio.gather(*tasks)
+    asyncio.run(main())
+    assert seen["busiest_lanes"] == [{"kind": "chat", "id": 5, "depth": 3}]
+    assert (seen["running"], seen["queued"]) == (1, 2)
+    stats = processor.stats()
+    assert (stats["lanes"], stats["processed"], stats["queued"]) == (0, 3, 0)
+    assert processor.pending == 0
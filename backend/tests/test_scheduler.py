@@ -0,0 +1,132 @@
+import asyncio
+import time
+from datetime import datetime, timezone
+
+import pytest
+
+import async_storage
+from scheduler import Scheduler, next_run_after, parse_recurrence
+
+
+def at(*args) -> float:
+    return datetime(*args, tzinfo=timezone.utc).timestamp()
+
+
+# --- next_run_after ---
+def test_interval_runs_after_previous():
+    assert next_run_after("every:300", 1000, 1000) == 1300
+    assert next_run_after("every:300", 1000, 1299) == 1300
+
+
+def test_interval_skips_runs_missed_while_down():
+    # Down from 1000 to 2000: runs at 1300..1900 are skipped, not sent in a burst.
+    assert next_run_after("every:300", 1000, 2000) == 2200
+    assert next_run_after("every:300", 1000, 1900) == 2200
+
+
+def test_cron_next_matching_minute():
+    now = at(2024, 3, 4, 8, 59, 30)  # a Monday
+    assert next_run_after("cron:0 9 * * *", 0, now) == at(2024, 3, 4, 9, 0)
+    assert next_run_after("cron:0 9 * * *", 0, at(2024, 3, 4, 9, 0)) == at(2024, 3, 5, 9, 0)
+    assert next_run_after("cron:*/15 * * * *", 0, now) == at(2024, 3, 4, 9, 0)
+
+
+def test_cron_weekdays_and_months():
+    now = at(2024, 3, 4, 12, 0)  # a Monday
+    assert next_run_after("cron:30 8 * * 1-5", 0, now) == at(2024, 3, 5, 8, 30)
+    assert next_run_after("cron:0 0 * * 7", 0, now) == at(2024, 3, 10, 0, 0)  # 7 is Sunday
+    assert next_run_after("cron:0 0 1 1 *", 0, now) == at(2025, 1, 1, 0, 0)
+    assert next_run_after("cron:0 0 29 2 *", 0, now) == at(2028, 2, 29, 0, 0)
+
+
+def test_cron_day_or_weekday():
+    # With both restricted, either one matching is enough, as in cron.
+    now = at(2024, 3, 4, 12, 0)  # a Monday
+    assert next_run_after("cron:0 0 15 * 3", 0, now) == at(2024, 3, 6, 0, 0)
+
+
+# --- parse_recurrence ---
+def test_parse_recurrence():
+    assert parse_recurrence("1d12h") == "every:129600"
+    assert parse_recurrence(" 0  9 * * 1-5 ") == "cron:0 9 * * 1-5"
+
+
+@pytest.mark.parametrize("text", ["30s", "0 9 * *", "61 * * * *", "0 0 31 2 *", "*/0 * * * *"])
+def test_parse_recurrence_rejects_invalid(text):
+    with pytest.raises(ValueError):
+        parse_recurrence(text)
+
+
+# --- Scheduler ---
+def run_scheduler(scenario, fire):
+    async def main():
+        scheduler = Scheduler()
+        await scheduler.start(fire)
+        try:
+            return await scenario(scheduler)
+        finally:
+            await scheduler.stop()
+            await async_storage.write(lambda: None)  # writes commit in order: wait for queued ones
+    return asyncio.run(main())
+
+
+def test_one_shot_job_fires_once_and_is_marked_done(db):
+    fired = []
+
+    async def fire(job):
+        fired.append(job["id"])
+
+    async def scenario(scheduler):
+        job = await scheduler.add("123", "hi", time.time() - 1)
+        await asyncio.sleep(0.2)
+        return job
+
+    job = run_scheduler(scenario, fire)
+    assert fired == [job["id"]]
+    assert db.get_scheduled_job(job["id"])["status"] == "done"
+
+
+def test_failed_one_shot_job_is_marked_failed(db):
+    async def fire(job):
+        raise RuntimeError("boom")
+
+    async def scenario(scheduler):
+        job = await scheduler.add("123", "hi", time.time() - 1)
+        await asyncio.sleep(0.2)
+        return job
+
+    job = run_scheduler(scenario, fire)
+    assert db.get_scheduled_job(job["id"])["status"] == "failed"
+
+
+def test_recurring_job_is_rescheduled_and_cancel_sticks(db):
+    fired = []
+
+    async def fire(job):
+        fired.append(job["id"])
+
+    async def scenario(scheduler):
+        job = await scheduler.add("123", "hi", time.time() - 1, "every:60")
+        await asyncio.sleep(0.2)
+        assert len(scheduler) == 1 and scheduler.pending()[0]["next_run"] > time.time()
+        assert await scheduler.cancel(job["id"])
+        assert not await scheduler.cancel(job["id"])
+        return job
+
+    job = run_scheduler(scenario, fire)
+    assert fired == [job["id"]]
+    stored = db.get_scheduled_job(job["id"])
+    assert stored["status"] == "cancelled" and stored["last_run"] is not None
+    # A run recorded late (e.g. by another worker) doesn't bring it back.
+    assert not db.update_scheduled_job(job["id"], time.time() + 60, "pending", time.time())
+    assert db.get_scheduled_job(job["id"])["status"] == "cancelled"
+
+
+def test_broadcast_is_claimed_once(db):
+    job = db.add_scheduled_job("all", "hi", time.time())
+    assert db.claim_scheduled_broadcast(job["id"], "abc")
+    assert not db.claim_scheduled_broadcast(job["id"], "def")
+    assert db.get_scheduled_job(job["id"])["broadcast_id"] == "abc"
+    cancelled = db.add_scheduled_job("all", "hi", time.time())
+    db.cancel_scheduled_job(cancelled["id"])
+    assert not db.claim_scheduled_broadcast(cancelled["id"], "abc")
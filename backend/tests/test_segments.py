@@ -0,0 +1,106 @@
+import time
+
+import pytest
+
+import segments
+import storage
+from segments import DAY, SegmentIndex, parse_segment
+from subscribers import SubscriberLog
+
+
+# --- parse_segment ---
+def test_parse_terms():
+    assert parse_segment("lang=ES,pt") == ("in", "lang", ("es", "pt"))
+    assert parse_segment("tag=VIP") == ("in", "tag", ("VIP",))
+    assert parse_segment("source=promo") == ("in", "source", ("promo",))
+    assert parse_segment("active<30d") == ("active", "<", 30)
+    assert parse_segment("joined>7d") == ("joined", ">", 7)
+    assert parse_segment("all") == ("all",)
+
+
+def test_parse_and_binds_tighter_than_or():
+    assert parse_segment("lang=es OR lang=pt AND tag=vip") == (
+        "or", ("in", "lang", ("es",)), ("and", ("in", "lang", ("pt",)), ("in", "tag", ("vip",))),
+    )
+
+
+def test_parse_not_and_parentheses():
+    assert parse_segment("NOT (lang=es or tag=vip) and all") == (
+        "and", ("not", ("or", ("in", "lang", ("es",)), ("in", "tag", ("vip",)))), ("all",),
+    )
+
+
+@pytest.mark.parametrize("query", ["", "   ", "lang=es AND", "(lang=es", "lang=es)", "country=es", "lang=es tag=vip"])
+def test_parse_rejects_invalid(query):
+    with pytest.raises(ValueError):
+        parse_segment(query)
+
+
+# --- SegmentIndex ---
+NOW = time.time()
+USERS = [  # user_id, language_code, joined_at, last_seen, source
+    (1, "es", NOW - 60 * DAY, NOW, "promo"),
+    (2, "en", NOW - 40 * DAY, NOW - 45 * DAY, None),
+    (3, "ES", NOW - 3 * DAY, NOW - 2 * DAY, "ads"),
+    (4, None, NOW - 1 * DAY, None, None),
+]
+TAGS = [("vip", 1), ("vip", 4)]
+
+
+@pytest.fixture
+def index(tmp_path, monkeypatch):
+    subscribers = SubscriberLog(str(tmp_path / "users.log"))
+    subscribers.claim()
+    subscribers.add_many(user_id for user_id, *_ in USERS)
+    monkeypatch.setattr(storage, "get_subscribers", lambda: subscribers)
+    monkeypatch.setattr(storage, "iter_segment_attributes", lambda: iter(USERS))
+    monkeypatch.setattr(storage, "iter_user_tags", lambda: iter(TAGS))
+    return SegmentIndex()
+
+
+def members(index, query):
+    return list(index.members(query))
+
+
+@pytest.mark.parametrize("query, expected", [
+    ("all", [1, 2, 3, 4]),
+    ("lang=es", [1, 3]),
+    ("lang=en,es", [1, 2, 3]),
+    ("tag=vip", [1, 4]),
+    ("source=promo,ads", [1, 3]),
+    ("active<30d", [1, 3]),
+    ("active>30d", [2, 4]),
+    ("joined<7d", [3, 4]),
+    ("joined>7d", [1, 2]),
+    ("NOT lang=es", [2, 4]),
+    ("lang=es AND active<1d", [1]),
+    ("tag=vip OR (lang=en AND joined>30d)", [1, 2, 4]),
+    ("tag=missing", []),
+])
+def test_resolve(index, query, expected):
+    assert members(index, query) == expected
+    assert index.count(query) == len(expected)
+
+
+def test_resolve_rejects_activity_beyond_tracked_days(index):
+    with pytest.raises(ValueError):
+        index.resolve(f"active<{segments.LAST_SEEN_DAYS + 1}d")
+
+
+def test_start_and_touch_update_index(index, monkeypatch):
+    writes = []
+    monkeypatch.setattr(segments.async_storage, "write_later", lambda *args: writes.append(args))
+    index.count("all")  # build from the stored attributes
+    storage.get_subscribers().add(5)
+    index.on_start(5, "pt", source="promo")
+    assert members(index, "lang=pt") == [5]
+    assert members(index, "source=promo") == [1, 5]
+    assert members(index, "joined<1d") == [5]
+
+    index.touch(2, "es")  # a language change replaces the old one
+    assert members(index, "lang=es") == [1, 2, 3]
+    assert members(index, "lang=en") == []
+    assert members(index, "active<1d") == [1, 2, 5]
+    assert len(writes) == 1
+    index.touch(2, "es")  # seen today already: no second write
+    assert len(writes) == 1
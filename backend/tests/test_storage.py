@@ -0,0 +1,98 @@
+import json
+
+
+def counters(db, *names):
+    return db.load_counters(names)
+
+
+# --- JSON Migration ---
+def test_legacy_json_files_are_imported_once(db, tmp_path, monkeypatch):
+    files = {
+        "USERS_FILE": [5, 6, 5],
+        "CHATS_FILE": {"-100": {"title": "Group", "type": "group"}},
+        "TEMPLATES_FILE": {"hello": {"content": "Hi", "button_text": "Go", "button_url": "https://example.com"}},
+        "KEYWORDS_FILE": {"price": "It's free"},
+    }
+    for name, data in files.items():
+        path = tmp_path / f"{name.lower()}.json"
+        path.write_text(json.dumps(data))
+        monkeypatch.setattr(db, name, str(path))
+
+    assert list(db.get_user_ids()) == [5, 6]
+    assert db.load_chats() == {"-100": {"title": "Group", "type": "group"}}
+    assert db.load_templates()["hello"]["button_url"] == "https://example.com"
+    assert [rule["response"] for rule in db.load_keyword_rules()] == ["It's free"]
+
+    db.migrate_json(db.get_connection())  # already done: nothing is imported twice
+    assert counters(db, "chats") == {"chats": 1}
+    assert len(db.load_keyword_rules()) == 1
+
+
+# --- Trigger-Maintained Counters ---
+def test_chat_count_and_version_follow_writes(db):
+    db.save_chat(-100, "Group", "group")
+    db.save_chat(-200, "Channel", "channel")
+    before = counters(db, "chats", "chats_version")
+    assert before["chats"] == 2
+
+    db.save_chat(-100, "Renamed", "supergroup")  # an update changes the version, not the count
+    after = counters(db, "chats", "chats_version")
+    assert after["chats"] == 2
+    assert after["chats_version"] == before["chats_version"] + 1
+    assert db.chats_version() == after["chats_version"]
+
+
+def test_inactive_counts_split_users_and_chats(db):
+    version = db.inactive_version()
+    db.mark_inactive(5, "blocked")
+    db.mark_inactive(-100, "forbidden")
+    db.mark_inactive(5, "deactivated")  # already inactive: counted once
+    assert counters(db, "inactive_users", "inactive_chats") == {"inactive_users": 1, "inactive_chats": 1}
+    assert db.load_inactive_ids() == {5, -100}
+    assert db.inactive_version() == version + 2
+
+    assert db.reactivate(5)
+    assert not db.reactivate(5)
+    assert counters(db, "inactive_users", "inactive_chats") == {"inactive_users": 0, "inactive_chats": 1}
+    assert db.inactive_version() == version + 3
+
+
+def test_template_and_keyword_versions_change_on_every_write(db):
+    templates, keywords = db.templates_version(), db.keywords_version()
+    db.save_template("hello", "Hi")
+    db.save_template("hello", "Hi there")
+    assert db.delete_template_from_file("hello")
+    assert not db.delete_template_from_file("hello")
+    assert db.templates_version() == templates + 3
+
+    db.save_keyword("price", "It's free")
+    db.save_keyword("price", "Still free")
+    assert db.delete_keyword("price")
+    assert db.keywords_version() == keywords + 3
+
+
+# --- Batches and Pages ---
+def test_failing_write_in_a_batch_keeps_the_others(db):
+    def fail():
+        db.save_chat(-300, "Lost", "group")
+        raise ValueError("bad row")
+
+    results = db.run_batch([
+        (db.save_chat, (-100, "Group", "group")),
+        (fail, ()),
+        (db.save_chat, (-200, "Channel", "channel")),
+    ])
+    assert [error is None for _, error in results] == [True, False, True]
+    assert isinstance(results[1][1], ValueError)
+    assert set(db.load_chats()) == {"-100", "-200"}
+    assert counters(db, "chats") == {"chats": 2}
+
+
+def test_chat_pages_follow_the_cursor(db):
+    for chat_id in range(1, 6):
+        db.save_chat(-chat_id, f"Chat {chat_id}", "group")
+    pages, cursor = [], 0
+    while cursor is not None:
+        page, cursor = db.load_chats_page(cursor, 2)
+        pages.append(list(page))
+    assert pages == [["-1", "-2"], ["-3", "-4"], ["-5"]]
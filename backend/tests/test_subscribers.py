@@ -0,0 +1,84 @@
+import pytest
+
+from subscribers import SubscriberLog
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "users.log")
+
+
+def test_appends_in_join_order_without_duplicates(path):
+    log = SubscriberLog(path)
+    log.claim()
+    assert log.add(5)
+    assert not log.add(5)
+    assert log.add_many([7, 5, 9, 7]) == 2
+    assert list(log) == [5, 7, 9]
+    assert log.ordinal(9) == 2 and log.id_at(1) == 7
+    assert 7 in log and 8 not in log
+
+    reader = SubscriberLog(path)
+    assert reader.refresh() == 3
+    assert list(reader) == [5, 7, 9]
+
+
+def test_only_the_owner_appends(path):
+    log = SubscriberLog(path)
+    with pytest.raises(RuntimeError):
+        log.add(1)
+    log.claim()
+    log.add(1)
+    log.release()
+    assert not log.is_writer
+    with pytest.raises(RuntimeError):
+        log.add(2)
+
+
+def test_ownership_moves_without_stale_readers(path):
+    first, second = SubscriberLog(path), SubscriberLog(path)
+    first.claim()
+    first.add_many([1, 2])
+    # The bot moves to the second process: it catches up before appending.
+    first.release()
+    second.claim()
+    assert list(second) == [1, 2]
+    second.add(3)
+    # The old writer is now a reader and sees the new appends.
+    first.refresh()
+    assert list(first) == [1, 2, 3]
+    assert second.ordinal(3) == first.ordinal(3) == 2
+
+
+def test_torn_record_is_dropped(path):
+    log = SubscriberLog(path)
+    log.claim()
+    log.add(1)
+    with open(path, "ab") as f:
+        f.write(b"\x01\x02\x03")  # a crash mid-append
+    reader = SubscriberLog(path)
+    reader.refresh()
+    assert list(reader) == [1]
+    log.release()
+    reader.claim()
+    reader.add(2)
+    check = SubscriberLog(path)
+    check.refresh()
+    assert list(check) == [1, 2]
+
+
+def test_compaction_drops_duplicates(path):
+    log = SubscriberLog(path)
+    log.claim()
+    log.add_many([1, 2, 3])
+    log.release()
+    other = SubscriberLog(path)
+    other.claim()
+    other._members.clear()  # a writer that didn't know the IDs appends them again
+    other._ids = other._ids[:0]
+    other.add_many([1, 2, 3, 4])
+    other.compact()
+    reader = SubscriberLog(path)
+    reader.refresh()
+    assert list(reader) == [1, 2, 3, 4]
+    assert reader._records == 4
@@ -0,0 +1,113 @@
+from datetime import datetime, timezone
+
+import pytest
+from telegram import Chat, Message, Update, User
+
+import throttle
+from throttle import InboundThrottle, ReplyCache, TokenBuckets
+
+OWNER = 7
+
+
+def update(text, user_id=1, chat_id=None, chat_type="private", message_id=1):
+    chat = Chat(chat_id or user_id, chat_type)
+    user = User(user_id, "u", False)
+    message = Message(message_id, datetime.now(timezone.utc), chat, from_user=user, text=text)
+    return Update(message_id, message=message)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(throttle.time, "monotonic", lambda: now[0])
+    return now
+
+
+# --- TokenBuckets ---
+def test_bucket_allows_burst_then_refills():
+    buckets = TokenBuckets(rate=2, burst=3)
+    assert [buckets.allow("a", 0) for _ in range(4)] == [True, True, True, False]
+    assert buckets.allow("b", 0)  # keys don't share a bucket
+    assert not buckets.allow("a", 0.4)
+    assert buckets.allow("a", 1.0)
+
+
+def test_bucket_rate_zero_never_limits():
+    buckets = TokenBuckets(rate=0, burst=1)
+    assert all(buckets.allow("a", 0) for _ in range(100))
+    assert len(buckets) == 0
+
+
+def test_idle_buckets_are_pruned(monkeypatch):
+    monkeypatch.setattr(throttle, "MAX_TRACKED", 3)
+    buckets = TokenBuckets(rate=1, burst=1)
+    for key in range(3):
+        buckets.allow(key, 0)
+    buckets.allow("new", 10)
+    assert len(buckets) == 1
+
+
+# --- InboundThrottle ---
+def throttled(queue_depth=0, **limits):
+    inbound = InboundThrottle(OWNER, lambda: queue_depth)
+    inbound.users = TokenBuckets(limits.get("user_rate", 0), 1)
+    inbound.chats = TokenBuckets(limits.get("chat_rate", 0), 1)
+    return inbound
+
+
+def test_repeated_start_is_coalesced(clock):
+    inbound = throttled()
+    assert inbound.check(update("/start")) is None
+    assert inbound.check(update("/start@bot promo")) == "duplicate_start"
+    assert inbound.check(update("/start", user_id=2)) is None
+    clock[0] += throttle.START_COALESCE_SECONDS
+    assert inbound.check(update("/start")) is None
+
+
+def test_sheds_non_commands_when_backlogged(monkeypatch, clock):
+    monkeypatch.setattr(throttle, "INBOUND_SHED_QUEUE_DEPTH", 10)
+    inbound = throttled(queue_depth=10)
+    assert inbound.check(update("hello")) == "shed"
+    assert inbound.check(update("/help")) is None
+    assert throttled(queue_depth=9).check(update("hello")) is None
+
+
+def test_user_and_chat_rates(clock):
+    inbound = throttled(user_rate=1)
+    assert inbound.check(update("hi")) is None
+    assert inbound.check(update("hi")) == "user_rate"
+    assert inbound.check(update("hi", user_id=OWNER)) is None  # the owner is never limited
+
+    inbound = throttled(chat_rate=1)
+    assert inbound.check(update("hi", user_id=1, chat_id=-5, chat_type="group")) is None
+    assert inbound.check(update("hi", user_id=2, chat_id=-5, chat_type="group")) == "chat_rate"
+
+
+# --- ReplyCache ---
+def test_reply_cache_caches_hits_only(clock):
+    calls = []
+
+    def matcher(text, language_code):
+        calls.append(text)
+        return "reply" if text == "price" else None
+
+    cache = ReplyCache(ttl=5)
+    assert cache.match("price", None, matcher) == "reply"
+    assert cache.match("price", None, matcher) == "reply"
+    assert cache.match("hello", None, matcher) is None
+    assert cache.match("hello", None, matcher) is None
+    assert calls == ["price", "hello", "hello"]
+    assert cache.hits == 1
+    clock[0] += 5
+    cache.match("price", None, matcher)
+    assert calls[-1] == "price"
+
+
+def test_each_message_is_answered_once(clock):
+    cache = ReplyCache(ttl=5)
+    assert cache.first_reply(1, 10)
+    assert not cache.first_reply(1, 10)  # the same update delivered again
+    assert cache.first_reply(1, 11)  # the same question asked again
+    assert cache.first_reply(2, 10)
+    clock[0] += 5
+    assert cache.first_reply(1, 10)
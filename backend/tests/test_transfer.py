@@ -0,0 +1,93 @@
+import asyncio
+import json
+
+import pytest
+
+import transfer
+
+
+async def chunked(data: bytes, size=7):
+    for start in range(0, len(data), size):
+        yield data[start:start + size]
+
+
+def import_bytes(kind, data, format):
+    return asyncio.run(transfer.import_stream(kind, chunked(data), format))
+
+
+def export(kind, format):
+    async def main():
+        return b"".join([chunk async for chunk in transfer.export_stream(kind, format)])
+    return asyncio.run(main()).decode()
+
+
+# --- Import ---
+def test_import_reports_invalid_lines_and_duplicates(db):
+    db.save_chat(-1, "Existing", "group")
+    lines = [
+        {"chat_id": "-1", "title": "Existing", "type": "group"},
+        {"chat_id": "-2", "title": "Ünïcode", "type": "channel"},
+        {"chat_id": "abc"},
+        "not json",
+        {"chat_id": "-3", "type": "forum"},
+        {"chat_id": "-4"},
+    ]
+    data = "\n".join(line if isinstance(line, str) else json.dumps(line) for line in lines).encode()
+    report = import_bytes("chats", data, "ndjson")
+    assert {key: report[key] for key in ("rows", "imported", "duplicates", "invalid", "last_line")} == {
+        "rows": 6, "imported": 2, "duplicates": 1, "invalid": 3, "last_line": 6,
+    }
+    assert [error["line"] for error in report["errors"]] == [3, 4, 5]
+    assert db.load_chats()["-2"] == {"title": "Ünïcode", "type": "channel"}
+    assert db.load_chats()["-4"]["type"] == "group"
+
+
+def test_csv_import_handles_a_bom_and_quoted_newlines(db):
+    data = (
+        "﻿name,content,button_text,button_url\n"
+        'welcome,"<b>Hi</b>\nsecond line",Open,https://example.com\n'
+        "broken,<b>unclosed,,\n"
+    ).encode()
+    report = import_bytes("templates", data, "csv")
+    assert (report["imported"], report["invalid"]) == (1, 1)
+    assert report["errors"][0]["line"] == 4
+    assert db.load_templates()["welcome"] == {
+        "content": "<b>Hi</b>\nsecond line", "button_text": "Open", "button_url": "https://example.com/",
+    }
+
+
+def test_unreadable_upload_keeps_the_rows_before_it(db, monkeypatch):
+    monkeypatch.setattr(transfer, "IMPORT_BATCH", 1)
+    data = b'{"chat_id": "-1"}\n{"chat_id": "-2"}\n{"chat_id": "-3", "title": "\xff"}\n{"chat_id": "-4"}\n'
+    report = import_bytes("chats", data, "ndjson")
+    assert "stopped" in report
+    assert report["last_line"] == 2
+    assert sorted(db.load_chats()) == ["-1", "-2"]
+
+
+# --- Export ---
+def test_export_streams_users_in_join_order(db, monkeypatch):
+    monkeypatch.setattr(transfer, "EXPORT_BATCH", 2)
+    db.claim_subscribers()
+    db.add_user_ids([30, 10, 20])
+    db.save_user_profile(10, first_name="Ada", language_code="en")
+    rows = [json.loads(line) for line in export("users", "ndjson").splitlines()]
+    assert [row["user_id"] for row in rows] == [30, 10, 20]
+    assert rows[1]["first_name"] == "Ada"
+    assert rows[0]["first_name"] is None  # subscribed without a stored profile
+
+
+MEDIA = ["https://example.com/a.jpg", "https://example.com/b.jpg"]
+
+
+@pytest.mark.parametrize("format", ["csv", "ndjson"])
+def test_exported_templates_import_again(db, format):
+    db.save_template("promo", 'Say "hi",\nthen go', "Go", "https://example.com", "album", MEDIA)
+    db.save_template("plain", "Hello")
+    exported = export("templates", format).encode()
+    db.delete_template_from_file("promo")
+    db.delete_template_from_file("plain")
+    report = import_bytes("templates", exported, format)
+    assert (report["imported"], report["invalid"]) == (2, 0)
+    assert db.load_templates()["promo"]["media"] == MEDIA
+    assert db.load_templates()["promo"]["content"] == 'Say "hi",\nthen go'
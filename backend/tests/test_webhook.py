@@ -0,0 +1,47 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import webhook
+
+
+def message(update_id, chat_id=5):
+    return {
+        "update_id": update_id,
+        "message": {"message_id": update_id, "date": 0, "chat": {"id": chat_id, "type": "private"}, "text": "hi"},
+    }
+
+
+@pytest.fixture
+def application(monkeypatch):
+    monkeypatch.setattr(webhook, "stats", webhook.IngestStats())
+    monkeypatch.setattr(webhook, "UPDATE_QUEUE_SIZE", 3)
+    return SimpleNamespace(bot=None, update_queue=asyncio.Queue())
+
+
+def test_updates_are_queued_until_the_backlog_is_full(application):
+    assert webhook.enqueue_update(application, message(1))
+    assert webhook.enqueue_update(application, message(2), in_flight=1)
+    # Two queued and one taken off the queue but not handled yet: full.
+    assert not webhook.enqueue_update(application, message(3), in_flight=1)
+    assert application.update_queue.get_nowait().update_id == 1
+    snapshot = webhook.stats.snapshot(application.update_queue, in_flight=1)
+    assert (snapshot["accepted"], snapshot["rejected"], snapshot["backlog"]) == (2, 1, 2)
+    assert snapshot["queue_high_water"] == 3
+
+
+@pytest.mark.parametrize("data", [{}, {"update_id": 1, "message": "hi"}, {"update_id": 1, "message": {}}])
+def test_malformed_updates_are_acknowledged_and_dropped(application, data):
+    assert webhook.enqueue_update(application, data)
+    assert application.update_queue.empty()
+    assert webhook.stats.invalid == 1
+
+
+def test_secret_header_must_match(monkeypatch):
+    monkeypatch.setattr(webhook, "WEBHOOK_SECRET", "s3cret")
+    assert webhook.check_secret("s3cret")
+    assert not webhook.check_secret("wrong")
+    assert not webhook.check_secret(None)
+    monkeypatch.setattr(webhook, "WEBHOOK_SECRET", "")
+    assert webhook.check_secret(None)
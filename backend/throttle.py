@@ -0,0 +1,179 @@
+import os
+import time
+from collections import Counter
+
+from dotenv import load_dotenv
+from telegram import Update
+
+import metrics
+
+load_dotenv()
+
+# --- Configuration ---
+# Sustained updates per second and burst allowed from one user, and in one group or channel.
+INBOUND_USER_RATE = float(os.getenv("INBOUND_USER_RATE", 1))
+INBOUND_USER_BURST = float(os.getenv("INBOUND_USER_BURST", 5))
+INBOUND_CHAT_RATE = float(os.getenv("INBOUND_CHAT_RATE", 10))
+INBOUND_CHAT_BURST = float(os.getenv("INBOUND_CHAT_BURST", 30))
+# Plain messages and button presses are dropped while this many updates are waiting; 0 never sheds.
+INBOUND_SHED_QUEUE_DEPTH = int(os.getenv("INBOUND_SHED_QUEUE_DEPTH", 1000))
+START_COALESCE_SECONDS = float(os.getenv("START_COALESCE_SECONDS", 10))  # repeated /starts within this are dropped
+KEYWORD_REPLY_TTL = float(os.getenv("KEYWORD_REPLY_TTL", 5))  # seconds a keyword reply is remembered
+MAX_TRACKED = 100000  # users, chats, texts or messages remembered before stale entries are pruned
+
+dropped = metrics.Counter("inbound_dropped_total", "Incoming updates dropped by flood control.", ["reason"])
+
+
+class TokenBuckets:
+    """A token bucket per key, refilled at `rate` tokens per second up to `burst`."""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self._buckets = {}  # key -> [tokens, updated]
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def allow(self, key, now: float) -> bool:
+        """Take a token for `key`. Returns False if its bucket is empty."""
+        if self.rate <= 0:
+            return True
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= MAX_TRACKED:
+                self._prune(now)
+            bucket = self._buckets[key] = [self.burst, now]
+        tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        if tokens < 1:
+            bucket[0] = tokens
+            return False
+        bucket[0] = tokens - 1
+        return True
+
+    def _prune(self, now: float) -> None:
+        # A bucket idle long enough to refill is the same as no bucket.
+        refill = self.burst / self.rate
+        self._buckets = {key: bucket for key, bucket in self._buckets.items() if now - bucket[1] < refill}
+        if len(self._buckets) >= MAX_TRACKED:
+            # Every key is busy (e.g. a raid from many accounts): start over rather than grow.
+            self._buckets.clear()
+
+
+class InboundThrottle:
+    """Decides which incoming updates are dropped before any handler runs.
+
+    The owner and chat member updates are never throttled. For everyone else,
+    in order:
+
+    * a /start from a user who sent one in the last START_COALESCE_SECONDS
+      is dropped, so repeated taps only subscribe and greet once;
+    * while INBOUND_SHED_QUEUE_DEPTH or more updates are waiting, updates
+      that aren't commands are dropped, keeping the bot responsive to
+      /start and the owner;
+    * each user, and each group or channel, gets a token bucket.
+    """
+
+    def __init__(self, owner_id: int, queue_depth):
+        self.owner_id = owner_id
+        self.queue_depth = queue_depth  # function returning the updates waiting
+        self.users = TokenBuckets(INBOUND_USER_RATE, INBOUND_USER_BURST)
+        self.chats = TokenBuckets(INBOUND_CHAT_RATE, INBOUND_CHAT_BURST)
+        self._starts = {}  # user ID -> when their last /start was let through
+        self.passed = 0
+        self.dropped = Counter()
+
+    def drop(self, reason: str) -> None:
+        self.dropped[reason] += 1
+        dropped.inc(reason)
+
+    def check(self, update: Update):
+        """Return why the update should be dropped, or None to handle it."""
+        user = update.effective_user
+        if user is None or user.id == self.owner_id or update.my_chat_member or update.chat_member:
+            return None
+        now = time.monotonic()
+        message = update.effective_message
+        text = message.text if message and message.text else ""
+        is_start = text.split(maxsplit=1)[0].split("@")[0] == "/start" if text else False
+
+        if is_start:
+            last = self._starts.get(user.id)
+            if last is not None and now - last < START_COALESCE_SECONDS:
+                return "duplicate_start"
+        elif not text.startswith("/") and INBOUND_SHED_QUEUE_DEPTH and self.queue_depth() >= INBOUND_SHED_QUEUE_DEPTH:
+            return "shed"
+        if not self.users.allow(user.id, now):
+            return "user_rate"
+        chat = update.effective_chat
+        if chat is not None and chat.type != "private" and not self.chats.allow(chat.id, now):
+            return "chat_rate"
+        if is_start:
+            if len(self._starts) >= MAX_TRACKED:
+                self._starts = {
+                    user_id: at for user_id, at in self._starts.items() if now - at < START_COALESCE_SECONDS
+                }
+            self._starts[user.id] = now
+        self.passed += 1
+        return None
+
+    def stats(self) -> dict:
+        return {
+            "passed": self.passed,
+            "dropped": dict(self.dropped),
+            "queue_depth": self.queue_depth(),
+            "tracked_users": len(self.users),
+            "tracked_chats": len(self.chats),
+        }
+
+
+class ReplyCache:
+    """Recent keyword replies, kept for KEYWORD_REPLY_TTL seconds.
+
+    Texts that matched a keyword get their reply from the cache instead of
+    the matcher (a keyword change shows after at most the TTL); misses are
+    not cached, so every distinct text doesn't take an entry. Each message
+    is answered once, so an update Telegram delivers again gets no second
+    reply, while a user who asks the same thing twice is answered twice.
+    """
+
+    def __init__(self, ttl: float = KEYWORD_REPLY_TTL):
+        self.ttl = ttl
+        self._matches = {}  # (text, language_code) -> (response, expires_at)
+        self._replied = {}  # (chat_id, message_id) -> expires_at
+        self.hits = 0
+
+    @staticmethod
+    def _prune(entries: dict, now: float, expires) -> dict:
+        if len(entries) < MAX_TRACKED:
+            return entries
+        return {key: value for key, value in entries.items() if expires(value) > now}
+
+    def match(self, text: str, language_code, matcher):
+        """The keyword reply for `text`, from the cache or from `matcher(text, language_code)`."""
+        if self.ttl <= 0:
+            return matcher(text, language_code)
+        now = time.monotonic()
+        key = (text, language_code)
+        cached = self._matches.get(key)
+        if cached is not None and cached[1] > now:
+            self.hits += 1
+            return cached[0]
+        response = matcher(text, language_code)
+        if response is not None:
+            self._matches = self._prune(self._matches, now, lambda value: value[1])
+            self._matches[key] = (response, now + self.ttl)
+        return response
+
+    def first_reply(self, chat_id, message_id) -> bool:
+        """True unless this message was already answered within the TTL."""
+        if self.ttl <= 0:
+            return True
+        now = time.monotonic()
+        key = (chat_id, message_id)
+        if self._replied.get(key, 0) > now:
+            return False
+        self._replied = self._prune(self._replied, now, lambda expires_at: expires_at)
+        self._replied[key] = now + self.ttl
+        return True
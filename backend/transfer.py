@@ -0,0 +1,283 @@
+import asyncio
+import csv
+import io
+import json
+import logging
+import time
+from itertools import islice
+
+from pydantic import ValidationError
+
+import async_storage
+import storage
+import templates
+from leader import election
+from models import TemplateCreate
+from segments import SOURCE_MAX_LENGTH
+
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+IMPORT_BATCH = 1000  # rows stored per transaction
+EXPORT_BATCH = 1000  # rows loaded and serialized per chunk of the response
+MAX_RECORD_LENGTH = 1024 * 1024  # longest line (or quoted CSV record) accepted
+MAX_REPORTED_ERRORS = 20
+
+FORMATS = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+COLUMNS = {
+    "users": storage.USER_PROFILE_COLUMNS,
+    "chats": ("chat_id", "title", "type"),
+    "templates": ("name", "content", "button_text", "button_url", "media_type", "media"),
+}
+CHAT_TYPES = ("private", "group", "supergroup", "channel")
+
+
+# --- Row Validation ---
+def _text(value, limit=None):
+    if value is None or value == "":
+        return None
+    return str(value)[:limit]
+
+
+def _user(row) -> dict:
+    try:
+        user_id = int(row.get("user_id"))
+    except (TypeError, ValueError):
+        raise ValueError("user_id must be a number")
+    if user_id <= 0:
+        raise ValueError("user_id must be positive")
+    return {
+        "user_id": user_id,
+        "first_name": _text(row.get("first_name")),
+        "last_name": _text(row.get("last_name")),
+        "username": _text(row.get("username")),
+        "language_code": _text(row.get("language_code"), 35),
+        "source": _text(row.get("source"), SOURCE_MAX_LENGTH),
+    }
+
+
+def _chat(row) -> dict:
+    chat_id = _text(row.get("chat_id"))
+    if not chat_id or not chat_id.lstrip("-").isdigit():
+        raise ValueError("chat_id must be a numeric chat ID")
+    chat_type = _text(row.get("type")) or "group"
+    if chat_type not in CHAT_TYPES:
+        raise ValueError(f"type must be one of {', '.join(CHAT_TYPES)}")
+    return {"chat_id": chat_id, "title": _text(row.get("title")), "type": chat_type}
+
+
+def _template(row) -> dict:
+    media = row.get("media")
+    if isinstance(media, str):  # CSV cells hold the list as JSON
+        media = json.loads(media) if media.strip() else []
+    template = TemplateCreate(
+        name=_text(row.get("name")) or "",
+        content=_text(row.get("content")) or "",
+        button_text=_text(row.get("button_text")),
+        button_url=_text(row.get("button_url")),
+        media_type=_text(row.get("media_type")),
+        media=media or [],
+    )
+    if not template.name or not template.content:
+        raise ValueError("name and content are required")
+    data = template.model_dump(mode="json")
+    templates.CompiledTemplate(template.name, data)
+    if not (data["button_text"] and data["button_url"]):
+        data["button_text"] = data["button_url"] = None
+    if not (data["media_type"] and data["media"]):
+        data["media_type"], data["media"] = None, []
+    return data
+
+
+def _describe(error: ValueError) -> str:
+    if isinstance(error, ValidationError):
+        first = error.errors()[0]
+        return f"{'.'.join(map(str, first['loc']))}: {first['msg']}"
+    return str(error)
+
+
+async def _store_users(rows) -> int:
+    # The subscriber log has one writer, the worker running the bot.
+    result = await election.run_on_leader("import_users", {"users": rows})
+    return result["imported"]
+
+
+async def _store_chats(rows) -> int:
+    return await async_storage.write(storage.import_chats, rows)
+
+
+async def _store_templates(rows) -> int:
+    return await async_storage.write(storage.import_templates, rows)
+
+
+IMPORTERS = {
+    "users": (_user, _store_users),
+    "chats": (_chat, _store_chats),
+    "templates": (_template, _store_templates),
+}
+
+
+# --- Import ---
+async def _lines(chunks):
+    """Decode a byte stream into lines without holding more than one line in memory.
+
+    Lines are split before decoding, so invalid UTF-8 stops the import at
+    the line holding it rather than at the chunk that brought it.
+    """
+    buffer, encoding = b"", "utf-8-sig"  # the first line drops the BOM spreadsheets write
+    async for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            yield line.decode(encoding)
+            encoding = "utf-8"
+        if len(buffer) > MAX_RECORD_LENGTH:
+            raise ValueError(f"A line is longer than {MAX_RECORD_LENGTH} bytes")
+    if buffer:
+        yield buffer.decode(encoding)
+
+
+async def _records(chunks, format):
+    """Yield (line number, row dict or None, error or None) for each record of an NDJSON or CSV stream."""
+    header = None
+    pending = ""  # start of a CSV record whose quoted field spans lines
+    number = 0
+    async for line in _lines(chunks):
+        number += 1
+        if format == "ndjson":
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                yield number, None, f"invalid JSON: {e}"
+                continue
+            if isinstance(row, dict):
+                yield number, row, None
+            else:
+                yield number, None, "each line must be a JSON object"
+            continue
+        record = pending + line
+        if record.count('"') % 2:  # a quoted field continues on the next line
+            if len(record) > MAX_RECORD_LENGTH:
+                raise ValueError(f"A CSV record is longer than {MAX_RECORD_LENGTH} bytes")
+            pending = record + "\n"
+            continue
+        pending = ""
+        if not record.strip():
+            continue
+        values = next(csv.reader([record]))
+        if header is None:
+            header = [name.strip() for name in values]
+            continue
+        yield number, dict(zip(header, values)), None
+    if pending:
+        yield number, None, "unterminated quoted field"
+
+
+async def import_stream(kind: str, chunks, format: str) -> dict:
+    """Validate and store the rows of an upload in batches, skipping ones that already exist.
+
+    `chunks` is an async iterator of bytes, such as `Request.stream()`, so
+    the upload is never held in memory as a whole. If the stream itself is
+    unreadable partway (bad encoding, an overlong line), the rows before it
+    are still stored and the report gets `stopped` with the reason.
+    """
+    validate, store = IMPORTERS[kind]
+    started = time.perf_counter()
+    report = {"rows": 0, "imported": 0, "duplicates": 0, "invalid": 0, "errors": [], "last_line": 0}
+
+    async def flush(batch):
+        imported = await store(batch)
+        report["imported"] += imported
+        report["duplicates"] += len(batch) - imported
+
+    # One batch is stored while the next is parsed; batches are stored in order.
+    batch, storing = [], None
+    try:
+        async for number, row, error in _records(chunks, format):
+            report["rows"] += 1
+            report["last_line"] = number
+            if error is None:
+                try:
+                    batch.append(validate(row))
+                except ValueError as e:  # pydantic's ValidationError included
+                    error = _describe(e)
+            if error is not None:
+                report["invalid"] += 1
+                if len(report["errors"]) < MAX_REPORTED_ERRORS:
+                    report["errors"].append({"line": number, "error": error})
+            if len(batch) >= IMPORT_BATCH:
+                if storing is not None:
+                    await storing
+                storing, batch = asyncio.ensure_future(flush(batch)), []
+    except ValueError as e:
+        report["stopped"] = str(e)
+    finally:
+        if storing is not None:
+            await asyncio.wait([storing])  # let it finish even if the upload failed
+    if storing is not None:
+        storing.result()
+    if batch:
+        await flush(batch)
+
+    seconds = time.perf_counter() - started
+    report["seconds"] = round(seconds, 3)
+    report["rows_per_second"] = round(report["rows"] / seconds, 1) if seconds else 0.0
+    logger.info(
+        f"Imported {report['imported']} of {report['rows']} {kind} rows "
+        f"({report['duplicates']} duplicates, {report['invalid']} invalid) at {report['rows_per_second']} rows/s"
+    )
+    if "stopped" in report:
+        logger.warning(f"Import of {kind} stopped after line {report['last_line']}: {report['stopped']}")
+    return report
+
+
+# --- Export ---
+def _serialize(rows, columns, format) -> bytes:
+    if format == "ndjson":
+        return "".join(json.dumps(row, ensure_ascii=False) + "\n" for row in rows).encode()
+    out = io.StringIO()
+    writer = csv.writer(out, lineterminator="\n")
+    for row in rows:
+        writer.writerow(
+            "" if row.get(column) is None
+            else json.dumps(row[column]) if isinstance(row[column], list)
+            else row[column]
+            for column in columns
+        )
+    return out.getvalue().encode()
+
+
+def _user_chunk(user_ids, format) -> bytes:
+    return _serialize(storage.load_user_rows(user_ids), COLUMNS["users"], format)
+
+
+def _page_chunk(kind, cursor, format):
+    if kind == "chats":
+        page, cursor = storage.load_chats_page(cursor, EXPORT_BATCH)
+        rows = [{"chat_id": chat_id, **chat} for chat_id, chat in page.items()]
+    else:
+        page, cursor = storage.load_templates_page(cursor, EXPORT_BATCH)
+        rows = [{"name": name, **template} for name, template in page.items()]
+    return _serialize(rows, COLUMNS[kind], format), cursor
+
+
+async def export_stream(kind: str, format: str):
+    """Yield an export of users, chats or templates in chunks of EXPORT_BATCH rows.
+
+    Each chunk is loaded and serialized in the storage thread pool, so memory
+    stays constant however many rows there are.
+    """
+    if format == "csv":
+        yield (",".join(COLUMNS[kind]) + "\n").encode()
+    if kind == "users":
+        user_ids = iter(await async_storage.read(storage.get_user_ids))  # the subscribers at the start of the export
+        while chunk := list(islice(user_ids, EXPORT_BATCH)):
+            yield await async_storage.read(_user_chunk, chunk, format)
+        return
+    cursor = 0
+    while cursor is not None:
+        data, cursor = await async_storage.read(_page_chunk, kind, cursor, format)
+        if data:
+            yield data
@@ -0,0 +1,118 @@
+import asyncio
+import hmac
+import logging
+import os
+import time
+
+from dotenv import load_dotenv
+from telegram import Update
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+# When WEBHOOK_URL is set, Telegram pushes updates to WEBHOOK_URL + WEBHOOK_PATH
+# instead of the bot long-polling for them.
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_PATH = "/telegram/webhook"
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", 40))
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", 10000))
+RETRY_AFTER_SECONDS = 1  # sent to Telegram when the backlog is full
+
+
+def is_enabled() -> bool:
+    return bool(WEBHOOK_URL)
+
+
+def check_secret(header_value) -> bool:
+    """Compare the X-Telegram-Bot-Api-Secret-Token header in constant time."""
+    if not WEBHOOK_SECRET:
+        return True
+    return hmac.compare_digest(header_value or "", WEBHOOK_SECRET)
+
+
+class IngestStats:
+    """Counters for webhook ingestion and update queue backpressure."""
+
+    def __init__(self):
+        self.accepted = 0
+        self.rejected = 0
+        self.invalid = 0
+        self.high_water = 0
+        self.latency_ewma = 0.0  # seconds spent enqueueing, smoothed
+
+    def observe(self, started: float, depth: int) -> None:
+        elapsed = time.perf_counter() - started
+        self.latency_ewma += (elapsed - self.latency_ewma) * 0.05
+        if depth > self.high_water:
+            self.high_water = depth
+
+    def snapshot(self, queue: asyncio.Queue, in_flight: int = 0) -> dict:
+        return {
+            "accepted": self.accepted,
+            "rejected": self.rejected,
+            "invalid": self.invalid,
+            "queue_depth": queue.qsize(),
+            "in_flight": in_flight,
+            "backlog": queue.qsize() + in_flight,
+            "queue_max": UPDATE_QUEUE_SIZE,
+            "queue_high_water": self.high_water,
+            "enqueue_latency_us": round(self.latency_ewma * 1e6, 1),
+        }
+
+
+stats = IngestStats()
+
+
+def enqueue_update(application, data: dict, in_flight: int = 0) -> bool:
+    """Put a raw update onto the application's update queue without waiting.
+
+    With concurrent updates the application takes updates off the queue as
+    soon as they arrive, so `in_flight` (updates taken but not handled yet)
+    counts against UPDATE_QUEUE_SIZE too. Returns False if that backlog is
+    full, so the caller can ask Telegram to retry.
+    """
+    started = time.perf_counter()
+    try:
+        update = Update.de_json(data, application.bot)
+    except (AttributeError, KeyError, TypeError, ValueError) as e:  # e.g. a field of the wrong type
+        update = None
+        logger.warning(f"Dropping malformed webhook update: {e}")
+    if update is None:
+        # Acknowledge anyway so Telegram doesn't keep redelivering it.
+        stats.invalid += 1
+        return True
+    queue = application.update_queue
+    if queue.qsize() + in_flight >= UPDATE_QUEUE_SIZE:
+        stats.rejected += 1
+        return False
+    try:
+        queue.put_nowait(update)
+    except asyncio.QueueFull:
+        stats.rejected += 1
+        return False
+    stats.accepted += 1
+    stats.observe(started, queue.qsize() + in_flight)
+    return True
+
+
+async def start(application) -> None:
+    """Register the webhook with Telegram, or fall back to long polling."""
+    if is_enabled():
+        await application.bot.set_webhook(
+            url=WEBHOOK_URL + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET or None,
+            allowed_updates=Update.ALL_TYPES,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+        )
+        logger.info(f"Receiving updates via webhook at {WEBHOOK_URL + WEBHOOK_PATH}")
+    else:
+        await application.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+        logger.info("Receiving updates via long polling")
+
+
+async def stop(application) -> None:
+    """Stop polling if it was started. The webhook stays registered for the next start."""
+    if application.updater and application.updater.running:
+        await application.updater.stop()